@@ -0,0 +1,208 @@
+import os
+import sys
+import json
+import pickle
+import datetime
+import threading
+import logging
+
+script_dir = os.path.dirname(__file__)
+sys.path.append(f'{script_dir}/..')
+
+from utils.metrics import metrics
+
+if not os.path.exists(os.path.join(script_dir, '../data')):
+    os.makedirs(os.path.join(script_dir, '../data'))
+token_path = os.path.join(script_dir, '../data/token.json')
+pickle_path = os.path.join(script_dir, '../data/token.pickle')
+
+TOKEN_FORMAT_VERSION = 1
+# Refresh this long before the access token expires, before google-auth's own 3m45s threshold,
+# so worker threads never find the token invalid and refresh it themselves all at once
+REFRESH_MARGIN = 300
+REFRESH_CHECK_INTERVAL = 60
+
+
+def save_credentials(credentials, path=None):
+    '''
+    Save OAuth credentials as versioned JSON, readable by the owner only, replacing the file atomically
+    so a crash never leaves half a token.
+
+    Args:
+    credentials (Credentials): The credentials
+    path (str): The file, data/token.json by default
+
+    Returns:
+    None
+    '''
+    path = path or token_path
+    data = {'version': TOKEN_FORMAT_VERSION, 'credentials': json.loads(credentials.to_json())}
+    fd = os.open(path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)  # The refresh token is a secret
+    with open(fd, 'w') as f:
+        json.dump(data, f, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+
+def load_credentials(scopes, path=None, legacy_path=None):
+    '''
+    Load OAuth credentials from data/token.json. Credentials pickled to data/token.pickle by older
+    versions are converted to JSON once, and the pickle is removed.
+
+    Args:
+    scopes (list): The OAuth scopes the credentials are for
+    path (str): The JSON file, data/token.json by default
+    legacy_path (str): The pickle file, data/token.pickle by default
+
+    Returns:
+    Credentials: The credentials, or None if there are none or they cannot be read
+    '''
+    from google.oauth2.credentials import Credentials
+    path = path or token_path
+    legacy_path = legacy_path or pickle_path
+
+    if os.path.exists(path):
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+            if data.get('version') != TOKEN_FORMAT_VERSION:
+                raise ValueError(f"unknown token format version {data.get('version')}")
+            return Credentials.from_authorized_user_info(data['credentials'], scopes)
+        except (ValueError, KeyError) as e:  # JSONDecodeError is a ValueError
+            logging.error(f"Could not read credentials from {path}: {e}")
+            return None
+
+    if os.path.exists(legacy_path):
+        with open(legacy_path, 'rb') as token:
+            credentials = pickle.load(token)
+        save_credentials(credentials, path)
+        os.remove(legacy_path)
+        logging.info(f"Moved credentials from {legacy_path} to {path}")
+        return credentials
+    return None
+
+
+class CredentialManager:
+    '''
+    Keeps the OAuth access token of one set of credentials valid for runs that last hours.
+    A background thread refreshes the token REFRESH_MARGIN seconds before it expires, and every
+    request checks it too through refresh_if_needed, so no call goes out with an expired token.
+    Refreshes are serialized with a lock, threads that wait for one reuse its new token.
+    '''
+
+    def __init__(self, credentials, path=None, margin=REFRESH_MARGIN):
+        self.credentials = credentials
+        self.path = path or token_path
+        self.margin = margin
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def needs_refresh(self):
+        '''
+        Check if the access token is missing, expired, or expires within the margin.
+
+        Returns:
+        bool: True if the token should be refreshed
+        '''
+        expiry = self.credentials.expiry
+        if not self.credentials.token:
+            return True
+        if expiry is None:  # Tokens without an expiry never go stale
+            return False
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)  # google-auth expiries are naive UTC
+        return expiry - now < datetime.timedelta(seconds=self.margin)
+
+    def refresh(self, force=False):
+        '''
+        Refresh the access token if it is about to expire, and save the new one.
+
+        Args:
+        force (bool): Refresh even if the token looks valid, e.g. after the API rejected it
+
+        Returns:
+        bool: True if the token is a new one, refreshed by this call or by another thread while it waited
+        '''
+        if not force and not self.needs_refresh():
+            return False
+        old_token = self.credentials.token
+        with self._lock:
+            if self.credentials.token != old_token:
+                return True  # Another thread refreshed it while this one waited
+            if not force and not self.needs_refresh():
+                return False
+            from google.auth.transport.requests import Request
+            with metrics.timed('youtube.token'):
+                self.credentials.refresh(Request())
+            save_credentials(self.credentials, self.path)
+        logging.info(f"Refreshed the YouTube access token, valid until {self.credentials.expiry}")
+        return True
+
+    def start(self, interval=REFRESH_CHECK_INTERVAL):
+        '''
+        Start refreshing the token in a background thread, checking it every interval seconds.
+
+        Args:
+        interval (int): Seconds between checks
+
+        Returns:
+        None
+        '''
+        if self._thread is not None:
+            return
+        self._stop.clear()
+
+        def run():
+            while not self._stop.wait(interval):
+                try:
+                    self.refresh()
+                except Exception as e:  # Keep checking, the next request will refresh and report it if it still fails
+                    logging.error(f"Background refresh of the YouTube access token failed: {e}")
+
+        self._thread = threading.Thread(target=run, name='credential-refresh', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+_active_manager = None
+
+
+def set_active_manager(manager):
+    '''
+    Make a CredentialManager the one refresh_if_needed uses, replacing and stopping the previous one.
+
+    Args:
+    manager (CredentialManager): The manager, or None
+
+    Returns:
+    None
+    '''
+    global _active_manager
+    if _active_manager is not None and _active_manager is not manager:
+        _active_manager.stop()
+    _active_manager = manager
+
+
+def active_manager():
+    return _active_manager
+
+
+def refresh_if_needed(force=False):
+    '''
+    Refresh the active credentials if their token is about to expire, called before every YouTube request.
+
+    Args:
+    force (bool): Refresh even if the token looks valid
+
+    Returns:
+    bool: True if the token is a new one, False if it was not refreshed or no manager is active
+    '''
+    if _active_manager is None:
+        return False
+    return _active_manager.refresh(force)
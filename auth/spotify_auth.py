@@ -1,15 +1,27 @@
 import requests
 import os
+import sys
+import json
+import time
+import threading
 from dotenv import load_dotenv
 
 script_dir = os.path.dirname(__file__)
+sys.path.append(f'{script_dir}/..')
+
+from utils.metrics import metrics
+
 load_dotenv(script_dir + "/../.env")
 client_id = os.getenv('SPOTIFY_CLIENT_ID')
 client_secret = os.getenv('SPOTIFY_CLIENT_SECRET')
+if not os.path.exists(os.path.join(script_dir, '../data')):
+    os.makedirs(os.path.join(script_dir, '../data'))
+token_cache_path = os.path.join(script_dir, '../data/spotify_token.json')
 
-def get_access_token(client_id, client_secret):
+
+def request_access_token(client_id, client_secret):
     '''
-    Obtain an access token for authenticating requests to the Spotify API.
+    Request a new access token from the Spotify API.
 
     Args:
     client_id (str): The client ID for your Spotify API app.
@@ -17,17 +29,109 @@ def get_access_token(client_id, client_secret):
 
     Returns:
     str: The access token for authenticating requests to the Spotify API.
+    int: The number of seconds the token is valid for.
     '''
     auth_url = 'https://accounts.spotify.com/api/token'
-    response = requests.post(auth_url, {
-        'grant_type': 'client_credentials',
-        'client_id': client_id,
-        'client_secret': client_secret,
-    })
+    with metrics.timed('spotify.token'):
+        response = requests.post(auth_url, {
+            'grant_type': 'client_credentials',
+            'client_id': client_id,
+            'client_secret': client_secret,
+        })
 
     if response.status_code == 200:  # If request was successful
         auth_response_data = response.json()
-        return auth_response_data.get('access_token')
+        return auth_response_data.get('access_token'), auth_response_data.get('expires_in', 3600)
     else:
         raise Exception("Failed to retrieve access token from Spotify API.")
-    
\ No newline at end of file
+
+
+def get_access_token(client_id, client_secret):
+    '''
+    Obtain an access token for authenticating requests to the Spotify API.
+
+    Args:
+    client_id (str): The client ID for your Spotify API app.
+    client_secret (str): The client secret for your Spotify API app.
+
+    Returns:
+    str: The access token for authenticating requests to the Spotify API.
+    '''
+    return request_access_token(client_id, client_secret)[0]
+
+
+class SpotifyTokenProvider:
+    '''
+    Hands out a cached Spotify access token, only going back to the token endpoint shortly before it expires.
+    The token is kept in memory and, if cache_path is set, on disk so that it survives between runs.
+    Safe to share between threads.
+    '''
+
+    def __init__(self, client_id, client_secret, cache_path=None, refresh_margin=60):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.cache_path = cache_path
+        self.refresh_margin = refresh_margin
+        self.access_token = None
+        self.expires_at = 0
+        self._lock = threading.Lock()
+        self._load()
+
+    def get_token(self):
+        '''
+        Get a valid access token, refreshing it if it expires within refresh_margin seconds.
+
+        Returns:
+        str: The access token
+        '''
+        with self._lock:
+            if self.access_token is None or time.time() >= self.expires_at - self.refresh_margin:
+                access_token, expires_in = request_access_token(self.client_id, self.client_secret)
+                self.access_token = access_token
+                self.expires_at = time.time() + expires_in
+                self._save()
+            return self.access_token
+
+    def invalidate(self, access_token=None):
+        '''
+        Drop the cached token, e.g. after the API rejected it with a 401.
+        Passing the rejected token avoids dropping a newer one another thread already fetched.
+
+        Args:
+        access_token (str): The token that was rejected
+
+        Returns:
+        None
+        '''
+        with self._lock:
+            if access_token is None or access_token == self.access_token:
+                self.access_token = None
+                self.expires_at = 0
+
+    def _load(self):
+        if not self.cache_path:
+            return
+        try:
+            with open(self.cache_path, 'r') as f:
+                data = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return
+        if data.get('client_id') == self.client_id:  # Ignore tokens cached for another app
+            self.access_token = data.get('access_token')
+            self.expires_at = data.get('expires_at', 0)
+
+    def _save(self):
+        if not self.cache_path:
+            return
+        # Readable by the owner only, and replaced atomically so a crash never leaves half a token
+        fd = os.open(self.cache_path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(fd, 'w') as f:
+            json.dump({
+                'client_id': self.client_id,
+                'access_token': self.access_token,
+                'expires_at': self.expires_at,
+            }, f)
+        os.replace(self.cache_path + '.tmp', self.cache_path)
+
+
+token_provider = SpotifyTokenProvider(client_id, client_secret, cache_path=token_cache_path)
@@ -1,53 +1,86 @@
 import os
-import pickle
+import sys
 from dotenv import load_dotenv
 import logging
 
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
+# googleapiclient and the oauth libraries are imported where they are used, they take most of the start up time
 
 script_dir = os.path.dirname(__file__)
+sys.path.append(f'{script_dir}/..')
+
+from auth.credential_manager import CredentialManager, load_credentials, save_credentials, set_active_manager
+
 if not os.path.exists(os.path.join(script_dir, '../data')):
     os.makedirs(os.path.join(script_dir, '../data'))
 
-pickle_path = os.path.join(script_dir, '../data/token.pickle')
+discovery_path = os.path.join(script_dir, '../data/youtube_v3_discovery.json')
+DISCOVERY_URL = 'https://www.googleapis.com/discovery/v1/apis/youtube/v3/rest'
 
 env_path = os.path.join(script_dir, '../.env')
 load_dotenv(env_path)
 client_secrets_json = os.getenv('YOUTUBE_CLIENT_SECRETS')
 
 
-def get_authenticated_service():
+def load_discovery_document():
+    '''
+    Get the YouTube API discovery document from data/youtube_v3_discovery.json, so the client is built offline.
+    The first run copies it from the document shipped with googleapiclient, or downloads it if that has none.
+
+    Returns:
+    str: The discovery document JSON
+    '''
+    if os.path.exists(discovery_path):
+        with open(discovery_path, 'r') as f:
+            return f.read()
+
+    from googleapiclient.discovery_cache import get_static_doc
+    document = get_static_doc('youtube', 'v3')
+    if document is None:
+        import requests
+        response = requests.get(DISCOVERY_URL)
+        response.raise_for_status()
+        document = response.text
+
+    with open(discovery_path + '.tmp', 'w') as f:
+        f.write(document)
+    os.replace(discovery_path + '.tmp', discovery_path)
+    logging.info(f"Saved the YouTube discovery document to {discovery_path}")
+    return document
+
+
+def get_authenticated_service(background_refresh=True):
     '''
     Get authenticated service for YouTube API
-    Stores the user's access and refresh tokens in a file called 'token.pickle'
+    Stores the user's access and refresh tokens in data/token.json, converting a token.pickle from older versions
     File is created automatically when the authorization flow completes for the first time
+    The access token is then kept fresh by a CredentialManager for the rest of the run
+
+    Args:
+    background_refresh (bool): Refresh the token from a background thread as well as before requests
 
     Returns:
     youtube (googleapiclient.discovery.Resource): Authenticated service for YouTube API
     '''
     scopes = ['https://www.googleapis.com/auth/youtube.force-ssl']
-    creds = None
 
-    # The file token.pickle stores the user's access and refresh tokens, and is
+    # The file token.json stores the user's access and refresh tokens, and is
     # created automatically when the authorization flow completes for the first time.
-
-    if os.path.exists(pickle_path):
-        with open(pickle_path, 'rb') as token:
-            creds = pickle.load(token)
-            print()
-            print("Loaded credentials from token.pickle")
+    creds = load_credentials(scopes)
+    if creds:
+        print()
+        print("Loaded credentials from token.json")
 
     # If there are no (valid) credentials available, let the user log in.
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
+            from google.auth.transport.requests import Request
             try:
                 creds.refresh(Request())  # Refresh the token, no need to ask for permission again
             except Exception as e:
                 creds = None
 
         if not creds:
+            from google_auth_oauthlib.flow import InstalledAppFlow
             flow = InstalledAppFlow.from_client_secrets_file(client_secrets_json, scopes)
             print('\n' +'-' * 50 )
             print("Starting local server for authentication...")
@@ -55,9 +88,14 @@ def get_authenticated_service():
             creds = flow.run_local_server(port=0)  # Open a web browser to authenticate the user
 
         # Save the credentials for the next run
-        with open(pickle_path, 'wb') as token:
-            pickle.dump(creds, token)
-            print()
-            print("Saved credentials to token.pickle")
+        save_credentials(creds)
+        print()
+        print("Saved credentials to token.json")
+
+    manager = CredentialManager(creds)
+    set_active_manager(manager)
+    if background_refresh and creds.refresh_token:
+        manager.start()
 
-    return build('youtube', 'v3', credentials=creds, cache_discovery=False)
+    from googleapiclient.discovery import build_from_document
+    return build_from_document(load_discovery_document(), credentials=creds)
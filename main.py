@@ -1,5 +1,25 @@
-from services.youtube_services import manage_youtube_playlist
+import argparse
+import sys
 
 
 if __name__ == '__main__':
-    manage_youtube_playlist()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Sync Spotify playlists to YouTube playlists.")
+    parser.add_argument('--manifest', help="Sync every pair in this manifest JSON file without prompting")
+    parser.add_argument('--summary', help="Write the JSON summary of a manifest run here instead of stdout")
+    parser.add_argument('--workers', type=int, help="The number of manifest pairs synced at once")
+    parser.add_argument('--preserve-order', action='store_true', default=None,
+                        help="Add songs to YouTube in Spotify playlist order, inserting one at a time")
+    parser.add_argument('--metrics-interval', type=float,
+                        help="Also write logs/metrics.prom and logs/metrics.json every this many seconds during the run")
+    args = parser.parse_args()
+
+    if args.metrics_interval:
+        from utils.metrics import metrics
+        metrics.start_periodic_flush(args.metrics_interval)
+
+    if args.manifest:
+        from services.sync_runner import main as run_manifest
+        sys.exit(run_manifest(args.manifest, args.summary, args.workers, args.preserve_order))
+
+    from services.youtube_services import manage_youtube_playlist
+    manage_youtube_playlist(preserve_order=bool(args.preserve_order))
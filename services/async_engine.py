@@ -0,0 +1,648 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import itertools
+import contextlib
+from collections import deque
+
+import aiohttp
+
+script_dir = os.path.dirname(__file__)
+sys.path.append(f'{script_dir}/..')
+
+from auth.spotify_auth import token_provider
+from auth.credential_manager import active_manager, refresh_if_needed
+from utils.metrics import metrics
+from utils.quota import quota_ledger, QuotaBudget, INSERT_COST
+from utils.retry import RetryPolicy, is_quota_error, error_status
+from utils.search_cache import SearchCache
+from utils.deferred_inserts import DeferredInserts
+from utils.insert_pool import InsertPool
+from utils.search_ranking import SEARCH_RESULTS, make_candidate, rank_candidates, parse_duration
+from utils.youtube_utils import (SEARCH_FIELDS, DURATION_FIELDS, PLAYLIST_ITEM_FIELDS, reserve_search, store_search,
+                                 snapshot_page, playlist_contents)
+from utils.playlist_snapshot import (SNAPSHOT_MAX_AGE, load_snapshot, save_snapshot, new_snapshot, is_fresh,
+                                     snapshot_items, load_checkpoint)
+from utils.playlist_target import PlaylistTarget, SyncStopped, SearchFailed, search_error, QUOTA_STOPPED_MESSAGE
+from services.spotify_services import (PAGE_SIZE, TRACK_FIELDS, MAX_PAGE_WORKERS, SpotifyApiError, spotify_retry,
+                                       make_track, start_track_changes, page_changes, finish_track_changes)
+from services.youtube_services import start_sync, record_sync
+
+SPOTIFY_API = 'https://api.spotify.com/v1'
+YOUTUBE_API = 'https://www.googleapis.com/youtube/v3'
+REQUEST_TIMEOUT = 60  # Seconds, like the connections googleapiclient builds
+MAX_RETRIES = 3
+SEARCH_CONCURRENCY = 8
+
+
+class YouTubeApiError(Exception):
+    '''
+    Raised when the YouTube Data API answers the async client with an error status, like googleapiclient's HttpError.
+    The message holds the error reasons, so quota errors and rate limits are told apart as they are for HttpError,
+    and the status and headers are kept for RetryPolicy.
+    '''
+
+    def __init__(self, status, headers, body):
+        try:
+            error = json.loads(body)['error']
+            reasons = ', '.join(item.get('reason', '') for item in error.get('errors', []))
+            message = f"{reasons}: {error.get('message', '')}"
+        except (ValueError, KeyError, TypeError, AttributeError):
+            message = body[:200]
+        super().__init__(f"<YouTubeApiError {status}: {message}>")
+        self.status = status
+        self.headers = headers
+
+
+class YouTubeClient:
+    '''
+    Async client for the YouTube Data API calls the sync makes, sent over an aiohttp session.
+    Like execute_request, every request is charged to the quota ledger, and the access token of the active
+    CredentialManager is refreshed first when it is about to expire and once more if the API rejects it.
+    '''
+
+    def __init__(self, session, credentials=None):
+        if credentials is None:
+            manager = active_manager()
+            if manager is None:
+                raise ValueError("No YouTube credentials, call get_authenticated_service first")
+            credentials = manager.credentials
+        self.session = session
+        self.credentials = credentials
+
+    async def request(self, http_method, path, method, params=None, body=None, headers=None):
+        '''
+        Send a request to the YouTube Data API, the async execute_request.
+
+        Args:
+        http_method (str): 'GET', 'POST' or 'DELETE'
+        path (str): The resource, e.g. 'search'
+        method (str): The API method, e.g. 'search.list', used to look up the cost
+        params (dict): The query parameters
+        body (dict): The JSON body
+        headers (dict): Extra headers, e.g. If-None-Match
+
+        Returns:
+        dict: The response, empty for a delete, or None for 304 Not Modified
+        '''
+        manager = active_manager()
+        if manager is not None and manager.needs_refresh():
+            await asyncio.to_thread(refresh_if_needed)  # The refresh blocks, keep it off the event loop
+        for attempt in range(2):
+            quota_ledger.charge(method)
+            try:
+                with metrics.timed(f'youtube.{method}'):
+                    return await self._send(http_method, path, params, body, headers)
+            except Exception as e:
+                if 'quota' in str(e):
+                    metrics.increment('quota_errors_total', call=f'youtube.{method}')
+                    quota_ledger.mark_exhausted()
+                if attempt == 0 and error_status(e) == 401 and await asyncio.to_thread(refresh_if_needed, True):
+                    logging.info(f"Access token rejected by {method}, retrying with a refreshed token")
+                    continue  # Revoked or expired early, retry once with the new token
+                raise
+
+    async def _send(self, http_method, path, params, body, headers):
+        request_headers = {'Authorization': f'Bearer {self.credentials.token}'}
+        request_headers.update(headers or {})
+        async with self.session.request(http_method, f'{YOUTUBE_API}/{path}', params=params, json=body,
+                                        headers=request_headers) as response:
+            if response.status == 304:
+                return None
+            if response.status >= 400:
+                raise YouTubeApiError(response.status, response.headers, await response.text())
+            if response.status == 204:
+                return {}
+            return await response.json()
+
+    async def search_candidates(self, song_name, artist, duration_ms=None):
+        '''
+        Search YouTube for a song and rank the results, see youtube_utils.search_candidates
+        Costs 100 units, plus 1 unit for the durations when duration_ms is given
+
+        Returns:
+        list: Candidate dicts with 'video_id', 'title', 'channel' and 'score', best first, empty if no video found
+        '''
+        response = await self.request('GET', 'search', 'search.list', params={
+            'q': f"{song_name} {artist}",
+            'part': 'snippet',
+            'maxResults': str(SEARCH_RESULTS),
+            'type': 'video',
+            'fields': SEARCH_FIELDS,
+        })
+        candidates = [make_candidate(item, rank) for rank, item in enumerate(response.get('items', []))]
+
+        if duration_ms and len(candidates) > 1:
+            try:
+                durations = await self.fetch_durations([candidate['video_id'] for candidate in candidates])  # 1 unit
+            except Exception as e:  # Ranking works without durations, don't lose the search over it
+                if is_quota_error(e):
+                    raise
+                logging.warning(f"Could not get video durations for {song_name} by {artist}: {e}")
+                durations = {}
+            for candidate in candidates:
+                candidate['duration'] = durations.get(candidate['video_id'])
+
+        return rank_candidates(candidates, song_name, artist, duration_ms)
+
+    async def fetch_durations(self, video_ids):
+        '''
+        Get the length of up to 50 videos, costs 1 unit
+
+        Returns:
+        dict: A dictionary mapping video IDs to their length in seconds
+        '''
+        response = await self.request('GET', 'videos', 'videos.list', params={
+            'part': 'contentDetails',
+            'id': ','.join(video_ids),
+            'maxResults': str(len(video_ids)),
+            'fields': DURATION_FIELDS,
+        })
+        return {item['id']: parse_duration(item['contentDetails']['duration']) for item in response.get('items', [])}
+
+    async def list_page(self, playlist_id, page_token=None, etag=None):
+        '''
+        Get one page of a playlist, costs 1 unit
+
+        Returns:
+        dict: The page, or None if etag is given and the page has not changed
+        '''
+        params = {'part': 'snippet', 'playlistId': playlist_id, 'maxResults': '50', 'fields': PLAYLIST_ITEM_FIELDS}
+        if page_token:
+            params['pageToken'] = page_token
+        return await self.request('GET', 'playlistItems', 'playlistItems.list', params=params,
+                                  headers={'If-None-Match': etag} if etag else None)
+
+    async def insert(self, playlist_id, video_id):
+        '''
+        Add a video to a playlist, costs 50 units
+
+        Returns:
+        dict: The inserted playlist item
+        '''
+        return await self.request('POST', 'playlistItems', 'playlistItems.insert', params={'part': 'snippet'}, body={
+            'snippet': {'playlistId': playlist_id, 'resourceId': {'kind': 'youtube#video', 'videoId': video_id}},
+        })
+
+    async def delete(self, playlist_item_id):
+        '''
+        Remove an item from a playlist, costs 50 units
+        '''
+        await self.request('DELETE', 'playlistItems', 'playlistItems.delete', params={'id': playlist_item_id})
+
+
+class AsyncInsertPool(InsertPool):
+    '''
+    InsertPool whose inserts are tasks on the running event loop, sent with YouTubeClient instead of on worker
+    threads. Quota reservations, retries, the rate limit and the deferred queue work as in InsertPool, and
+    max_workers bounds the inserts in flight. Created, used and closed with aclose inside the event loop.
+    '''
+
+    def __init__(self, client, playlist_id, max_workers=4, **kwargs):
+        super().__init__(client, playlist_id, max_workers=max_workers, **kwargs)  # Its thread pool is never used
+        self._slots = asyncio.Semaphore(max_workers)
+
+    async def aclose(self):
+        '''
+        Wait for every queued insert to finish.
+
+        Returns:
+        list: (song, artist, video_id, status) tuples, see InsertPool.close
+        '''
+        self._executor.shutdown(wait=False)
+        self.results = list(await asyncio.gather(*self._futures)) + self._refused
+        return self.results
+
+    def _schedule(self, ticket, song, artist, video_id):
+        previous = self._futures[-1] if self.preserve_order and self._futures else None
+        self._futures.append(asyncio.create_task(self._insert_async(previous, song, artist, video_id)))
+
+    async def _insert_async(self, previous, song, artist, video_id):
+        if previous is not None:  # Lands after the song submitted before it
+            await asyncio.wait([previous])
+        async with self._slots:
+            reservation = [INSERT_COST]  # Reserved by submit, pays for the first request
+
+            async def insert():
+                self._pay(reservation)
+                await self.bucket.acquire_async()
+                return await self.youtube.insert(self.playlist_id, video_id)  # 50 units
+
+            try:
+                response = await self.retry.run_async(insert, 'youtube.playlistItems.insert')
+            except Exception as e:
+                return (song, artist, video_id, self._failed(song, artist, video_id, e, reservation[0]))
+            return (song, artist, video_id, self._added(song, artist, video_id, response))
+
+
+async def fetch_yt_playlist_contents(client, playlist_id, max_age=SNAPSHOT_MAX_AGE):
+    '''
+    Async version of youtube_utils.fetch_yt_playlist_contents, sharing its local snapshot and ETag revalidation.
+
+    Returns:
+    dict: A dictionary mapping video titles to video IDs
+    dict: A dictionary mapping video IDs to tuples of playlist item IDs, in playlist order
+    '''
+    snapshot = load_snapshot(playlist_id)
+    if is_fresh(snapshot, max_age):
+        logging.info(f"Using local snapshot of playlist {playlist_id}")
+    else:
+        snapshot = await revalidate_snapshot(client, playlist_id, snapshot)
+        save_snapshot(snapshot)
+    return playlist_contents(snapshot_items(snapshot))
+
+
+async def revalidate_snapshot(client, playlist_id, snapshot=None):
+    '''
+    Async version of youtube_utils.revalidate_snapshot, costs 1 unit per page
+
+    Returns:
+    dict: A new snapshot of the playlist
+    '''
+    cached_pages = {page['page_token']: page for page in snapshot['pages']} if snapshot else {}
+    new = new_snapshot(playlist_id)
+    next_page_token = None
+    not_modified = 0
+    while True:
+        cached_page = cached_pages.get(next_page_token)
+        response = await client.list_page(playlist_id, next_page_token, cached_page and cached_page.get('etag'))
+        if response is None:  # 304 Not Modified, the cached page is still current
+            page = cached_page
+            not_modified += 1
+        else:
+            page = snapshot_page(response, next_page_token)
+        new['pages'].append(page)
+        next_page_token = page['next_page_token']
+        if not next_page_token:
+            break
+    new['synced_at'] = time.time()
+    logging.info(f"Revalidated playlist {playlist_id}: {len(new['pages'])} pages, {not_modified} not modified")
+    return new
+
+
+async def spotify_get(session, url, params=None, error_message="Spotify API request failed."):
+    '''
+    Async version of spotify_services.spotify_get, with the same cached token, 401 handling and spotify_retry.
+
+    Returns:
+    dict: The JSON of the successful response
+    '''
+    async def request():
+        for attempt in range(2):
+            access_token = await asyncio.to_thread(token_provider.get_token)  # May fetch a new one
+            with metrics.timed('spotify.get'):
+                async with session.get(url, params=params, headers={'Authorization': f'Bearer {access_token}'}) as response:
+                    status, headers = response.status, response.headers
+                    data = await response.json() if status == 200 else None
+            if status != 401:
+                break
+            metrics.increment('retries_total', call='spotify.get')
+            token_provider.invalidate(access_token)
+        if status != 200:
+            raise SpotifyApiError(error_message, status, headers)
+        return data
+
+    return await spotify_retry.run_async(request, 'spotify.get')
+
+
+async def get_tracks_page(session, playlist_id, offset):
+    return await spotify_get(session, f'{SPOTIFY_API}/playlists/{playlist_id}/tracks', params={
+        'offset': str(offset),
+        'limit': str(PAGE_SIZE),
+        'fields': TRACK_FIELDS,
+    }, error_message="Failed to retrieve playlist tracks from Spotify API.")
+
+
+async def get_playlist_snapshot_id(session, playlist_id):
+    response = await spotify_get(session, f'{SPOTIFY_API}/playlists/{playlist_id}', params={'fields': 'snapshot_id'},
+                                 error_message="Failed to retrieve playlist snapshot from Spotify API.")
+    return response['snapshot_id']
+
+
+async def iter_playlist_pages(session, playlist_id, start=0):
+    '''
+    Async version of spotify_services.iter_playlist_pages, yielding the pages in playlist order while the
+    next MAX_PAGE_WORKERS pages are fetched.
+
+    Yields:
+    list: The track items of each page
+    '''
+    first_page = await get_tracks_page(session, playlist_id, start)
+    yield first_page['items']
+
+    offsets = iter(range(start + PAGE_SIZE, first_page['total'], PAGE_SIZE))
+    in_flight = deque(asyncio.create_task(get_tracks_page(session, playlist_id, offset))
+                      for offset in itertools.islice(offsets, MAX_PAGE_WORKERS))
+    try:
+        while in_flight:
+            page = await in_flight.popleft()
+            for offset in itertools.islice(offsets, 1):  # Keep the window full
+                in_flight.append(asyncio.create_task(get_tracks_page(session, playlist_id, offset)))
+            yield page['items']
+    finally:  # The consumer may stop early, don't fetch pages nobody will read
+        for task in in_flight:
+            task.cancel()
+
+
+async def iter_playlist_tracks(session, playlist_id, start=0):
+    '''
+    Async version of spotify_services.iter_playlist_tracks.
+
+    Yields:
+    Track: The track, which unpacks as (track name, artist)
+    '''
+    position = start
+    async with contextlib.aclosing(iter_playlist_pages(session, playlist_id, start)) as pages:
+        async for items in pages:
+            for item in items:
+                if item.get('track'):  # Tracks removed from Spotify come back as null
+                    yield make_track(item['track'], position)
+                position += 1
+
+
+async def get_playlist_tracks(session, playlist_id):
+    '''
+    Async version of spotify_services.get_playlist_tracks.
+
+    Returns:
+    list: The Track records in playlist order
+    '''
+    return [track async for track in iter_playlist_tracks(session, playlist_id)]
+
+
+async def spotify_track_changes(session, spotify_playlist_id, youtube_playlist_id, checkpoint=None):
+    '''
+    Async version of spotify_services.spotify_track_changes, 'added' is an async generator.
+
+    Returns:
+    dict: The changes, see spotify_services.spotify_track_changes
+    '''
+    snapshot_id = await get_playlist_snapshot_id(session, spotify_playlist_id)
+    changes, previous_keys = start_track_changes(spotify_playlist_id, youtube_playlist_id, snapshot_id, checkpoint)
+    if changes['unchanged']:
+        return changes
+
+    async def added_tracks():
+        position = changes['start']
+        async with contextlib.aclosing(iter_playlist_pages(session, spotify_playlist_id, position)) as pages:
+            async for items in pages:
+                for track in page_changes(changes, previous_keys, items, position):
+                    yield track
+                position += len(items)
+        finish_track_changes(changes, previous_keys)
+
+    changes['added'] = added_tracks()
+    return changes
+
+
+async def resolve_song(client, song, artist, cache, budget, retry, duration_ms=None, inserts=1):
+    '''
+    Async version of playlist_target.resolve_song, costs 100 units on a cache miss.
+
+    Returns:
+    str: The video ID, or None if no video was found
+    '''
+    async def search():
+        found, video_id = cache.get(song, artist)
+        if found:
+            return video_id
+        candidates = await client.search_candidates(song, artist, reserve_search(budget, duration_ms, inserts))
+        return store_search(cache, candidates, song, artist)
+
+    try:
+        return await retry.run_async(search, 'youtube.search.list')
+    except Exception as e:
+        error = search_error(song, artist, e)
+        if error is None:
+            raise
+        raise error from e
+
+
+async def iterate_tracks(tracks):
+    '''
+    Yield the tracks of an async iterable, or of a plain one, whose blocking reads then run on a worker thread.
+
+    Args:
+    tracks (iterable): Song and artist pairs, an iterable or an async iterable
+
+    Yields:
+    Track: The tracks
+    '''
+    if hasattr(tracks, '__aiter__'):
+        async for track in tracks:
+            yield track
+        return
+    iterator = iter(tracks)
+    end = object()
+    while True:
+        track = await asyncio.to_thread(next, iterator, end)
+        if track is end:
+            return
+        yield track
+
+
+async def song_adder(client, playlist_id, tracks, concurrency=SEARCH_CONCURRENCY, max_workers=4, preserve_order=False,
+                     chosen_count=None, budget=None):
+    '''
+    Async version of youtube_services.song_adder, searching up to concurrency songs at once while the tracks are
+    still streaming in and earlier songs are being inserted, all on one event loop. Songs go through the same
+    PlaylistTarget, search cache, retry policy and deferred queue as the threaded song_adder.
+    The quota of a song's insert is reserved before it is searched for, so searches in flight can never use up
+    the quota the songs they find need.
+
+    Args:
+    client (YouTubeClient): The async YouTube client
+    playlist_id (str): The ID of the YouTube playlist
+    tracks (iterable): Song and artist pairs, an iterable or an async iterable
+    concurrency (int): The most songs searched at once
+    max_workers (int): The most inserts in flight
+    preserve_order (bool): Insert songs in the same order as tracks, at the cost of insert concurrency
+    chosen_count (int): The most songs to add, by default as many as the quota allows
+    budget (QuotaBudget): A quota budget shared with other runs, by default today's remaining quota
+
+    Returns:
+    dict: The summary returned by the threaded song_adder
+    '''
+    if budget is None:
+        budget = QuotaBudget(quota_ledger.remaining())
+    search_cache = SearchCache()
+    deferred = DeferredInserts()
+    retry = RetryPolicy(max_attempts=MAX_RETRIES)
+    existing_video_ids = (await fetch_yt_playlist_contents(client, playlist_id))[0]  # 1 unit per 50 videos
+    target = PlaylistTarget(client, playlist_id, budget, retry, deferred, cap=chosen_count, max_workers=max_workers,
+                            preserve_order=preserve_order, existing_video_ids=existing_video_ids,
+                            pool_class=AsyncInsertPool)
+
+    searching = {}  # Search task -> the track it is for
+    unhandled = []  # Positions of the tracks not handled, the next run resumes from the first
+    submitted_keys = {}  # (song, artist) -> the key of the track submitted, to report failed inserts
+    unresolved_keys = []
+    stop_messages = []
+
+    def search(track):
+        song, artist = track
+        return asyncio.create_task(resolve_song(client, song, artist, search_cache, budget, retry,
+                                                getattr(track, 'duration_ms', None), inserts=0))
+
+    def finish(task):
+        track = searching.pop(task)
+        song, artist = track
+        try:
+            video_id = task.result()
+        except (SearchFailed, SyncStopped) as e:
+            budget.refund(INSERT_COST)
+            if isinstance(e, SyncStopped):
+                stop_messages.append(str(e))
+            unhandled.append(getattr(track, 'position', None))
+            return
+        except Exception:
+            budget.refund(INSERT_COST)
+            raise
+        if not video_id:
+            budget.refund(INSERT_COST)
+            print(f"Could not find YouTube video for {song} by {artist}")
+            logging.error(f"Could not find YouTube video for {song} by {artist}")
+            unresolved_keys.append(getattr(track, 'key', None))
+        elif target.submit(song, artist, video_id, reserved=True):
+            submitted_keys[(song, artist)] = getattr(track, 'key', None)
+        elif target.stopped:
+            unhandled.append(getattr(track, 'position', None))
+
+    async def wait_for_search():
+        if preserve_order:  # Submit in track order, a song found early waits for the searches before it
+            await asyncio.wait([next(iter(searching))])
+            done = list(itertools.takewhile(lambda task: task.done(), searching))
+        else:
+            done, _ = await asyncio.wait(searching, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            finish(task)
+
+    stopped_early = False
+    stream = iterate_tracks(tracks)
+    try:
+        if not target.drain_deferred():
+            stopped_early = True
+            stream = iterate_tracks(())  # Nothing more fits in this run, don't start downloading the tracks
+        async for track in stream:
+            # Songs being searched may all be submitted, so they count towards the cap
+            while searching and (len(searching) >= concurrency or
+                                 (chosen_count is not None and target.submitted + len(searching) >= chosen_count)):
+                await wait_for_search()
+            if target.full or target.stopped or stop_messages:
+                if target.stopped and not stop_messages:
+                    stop_messages.append(QUOTA_STOPPED_MESSAGE)
+                stopped_early = True
+                unhandled.append(getattr(track, 'position', None))
+                break
+            song, artist = track
+            if target.has_song(song, artist):
+                continue
+            if target.has_title(song):
+                logging.info(f"{song}  is already in the playlist.")
+                continue
+            if not budget.spend(INSERT_COST):  # Reserved for the song's insert before it is searched for
+                stop_messages.append(QUOTA_STOPPED_MESSAGE)
+                stopped_early = True
+                unhandled.append(getattr(track, 'position', None))
+                break
+            searching[search(track)] = track
+        while searching:
+            await wait_for_search()
+    finally:
+        await stream.aclose()
+        if hasattr(tracks, 'aclose'):
+            await tracks.aclose()  # Stops fetching pages nobody will read
+        if searching:  # Something raised, let the other searches finish before the pool closes
+            await asyncio.wait(searching)
+            budget.refund(INSERT_COST * len(searching))
+        results = await target.aclose()
+        deferred.close()
+        search_cache.close()
+
+    if stop_messages:
+        print(stop_messages[0])
+    stopped_early = stopped_early or bool(unhandled)
+    positions = [position for position in unhandled if position is not None]
+    added = sum(1 for result in results if result[3] == 'added')
+    print(f"Added {added} of {target.submitted} songs to the playlist.")
+    unresolved_keys.extend(submitted_keys.get((song, artist)) for song, artist, _, status in results
+                           if status == 'failed')
+    return {'added': added, 'submitted': target.submitted, 'complete': not stopped_early and added == target.submitted,
+            'resume_position': min(positions) if positions else None,
+            'unresolved_keys': [key for key in unresolved_keys if key is not None]}
+
+
+async def sync_spotify_playlist(session, client, spotify_playlist_id, youtube_playlist_id, chosen_count=None,
+                                budget=None, preserve_order=False, concurrency=SEARCH_CONCURRENCY):
+    '''
+    Async version of youtube_services.sync_spotify_playlist, with the same snapshot check, checkpoints and
+    sync state. Spotify pages are fetched ahead on the same event loop and fed straight into song_adder.
+
+    Args:
+    session (ClientSession): The aiohttp session the Spotify requests are sent on
+    client (YouTubeClient): The async YouTube client
+    spotify_playlist_id (str): The ID of the Spotify playlist
+    youtube_playlist_id (str): The ID of the YouTube playlist
+    chosen_count (int): The most songs to add
+    budget (QuotaBudget): A quota budget shared with other runs
+    preserve_order (bool): Add the songs in Spotify playlist order
+    concurrency (int): The most songs searched at once
+
+    Returns:
+    dict: The summary returned by song_adder, or None if the playlist was unchanged
+    '''
+    checkpoint = load_checkpoint(spotify_playlist_id, youtube_playlist_id)
+    changes = await spotify_track_changes(session, spotify_playlist_id, youtube_playlist_id, checkpoint)
+    if not start_sync(spotify_playlist_id, youtube_playlist_id, changes):
+        return None
+    summary = await song_adder(client, youtube_playlist_id, changes['added'], concurrency=concurrency,
+                               preserve_order=preserve_order, chosen_count=chosen_count, budget=budget)
+    record_sync(spotify_playlist_id, youtube_playlist_id, changes, summary)
+    return summary
+
+
+def open_session():
+    return aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT))
+
+
+def song_adder_async(youtube, playlist_id, tracks, chosen_count=None, budget=None, preserve_order=False):
+    '''
+    Thin sync wrapper running the async song_adder, a drop in for youtube_services.song_adder.
+    youtube is not used, the async client sends its requests with the active credentials.
+
+    Returns:
+    dict: The summary returned by song_adder
+    '''
+    async def run():
+        async with open_session() as session:
+            return await song_adder(YouTubeClient(session), playlist_id, tracks, preserve_order=preserve_order,
+                                    chosen_count=chosen_count, budget=budget)
+
+    return asyncio.run(run())
+
+
+def sync_spotify_playlist_async(youtube, spotify_playlist_id, youtube_playlist_id, chosen_count=None, budget=None,
+                                preserve_order=False):
+    '''
+    Thin sync wrapper running the async sync_spotify_playlist, a drop in for youtube_services.sync_spotify_playlist.
+
+    Args:
+    youtube (Resource): Not used, the async client sends its requests with the active credentials
+    spotify_playlist_id (str): The ID of the Spotify playlist
+    youtube_playlist_id (str): The ID of the YouTube playlist
+    chosen_count (int): The most songs to add
+    budget (QuotaBudget): A quota budget shared with other runs
+    preserve_order (bool): Add the songs in Spotify playlist order
+
+    Returns:
+    dict: The summary returned by song_adder, or None if the playlist was unchanged
+    '''
+    async def run():
+        async with open_session() as session:
+            return await sync_spotify_playlist(session, YouTubeClient(session), spotify_playlist_id,
+                                               youtube_playlist_id, chosen_count, budget, preserve_order)
+
+    return asyncio.run(run())
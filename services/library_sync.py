@@ -0,0 +1,250 @@
+import os
+import sys
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+script_dir = os.path.dirname(__file__)
+sys.path.append(f'{script_dir}/..')
+
+from utils.playlist_utils import normalize_title
+from utils.search_cache import SearchCache
+from utils.deferred_inserts import DeferredInserts
+from utils.retry import RetryPolicy
+from utils.playlist_target import PlaylistTarget, SyncStopped, SearchFailed, resolve_song, QUOTA_STOPPED_MESSAGE
+from utils.playlist_snapshot import save_sync_state, clear_checkpoint
+from services.spotify_services import spotify_track_changes, MAX_PLAYLIST_WORKERS
+
+# Below this many (track, playlist) checks, starting a process pool costs more than it saves
+PROCESS_MATCH_THRESHOLD = 50000
+MATCH_CHUNK_SIZE = 2000
+
+_title_indexes = {}  # The title index of every YouTube playlist, set in each matching process
+
+
+def collect_library(pairs, max_workers=MAX_PLAYLIST_WORKERS):
+    '''
+    Download the new tracks of every pair's Spotify playlist and merge them into one set, keyed by
+    Spotify track ID, or ISRC for tracks without one. Each track lists the YouTube playlists it goes to,
+    and the pairs it came from.
+
+    Args:
+    pairs (list): {'spotify', 'youtube'} pairs
+    max_workers (int): The number of Spotify playlists downloaded at once, each fetches MAX_PAGE_WORKERS
+    pages at once over the shared Spotify session, whose connection pool is sized for MAX_PLAYLIST_WORKERS
+
+    Returns:
+    tuple: (library, changes), library maps track keys to {'track': Track, 'targets': [youtube playlist IDs],
+    'pairs': [indexes in pairs]}, changes maps each (spotify, youtube) pair to its spotify_track_changes result,
+    or to the exception that stopped it from downloading
+    '''
+    def fetch(pair):
+        try:
+            changes = spotify_track_changes(pair['spotify'], pair['youtube'])
+            return changes, list(changes['added'])  # Reads to the end, so track_keys and removed are complete
+        except Exception as e:
+            logging.error(f"Failed to download Spotify playlist {pair['spotify']}: {e}")
+            return e, []
+
+    library = {}
+    all_changes = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for index, (pair, (changes, tracks)) in enumerate(zip(pairs, executor.map(fetch, pairs))):
+            all_changes[(pair['spotify'], pair['youtube'])] = changes
+            for track in tracks:
+                entry = library.get(track.key)
+                if entry is None:
+                    entry = library[track.key] = {'track': track, 'targets': [], 'pairs': []}
+                if pair['youtube'] not in entry['targets']:
+                    entry['targets'].append(pair['youtube'])
+                if index not in entry['pairs']:
+                    entry['pairs'].append(index)
+
+    track_count = sum(len(entry['targets']) for entry in library.values())
+    logging.info(f"Library of {len(pairs)} playlists: {track_count} new tracks, {len(library)} unique")
+    return library, all_changes
+
+
+def _set_title_indexes(title_indexes):
+    global _title_indexes
+    _title_indexes = title_indexes
+
+
+def _missing_targets(chunk):
+    return [[target for target in targets if not _title_indexes[target].contains_song(normalize_title(song))]
+            for song, targets in chunk]
+
+
+def match_library(library, title_indexes, processes=None):
+    '''
+    Work out which of its YouTube playlists each library track is missing from, by title.
+    Large libraries are matched in chunks across a process pool.
+
+    Args:
+    library (dict): The library from collect_library
+    title_indexes (dict): The TitleIndex of every YouTube playlist, playlists without one are left out
+    processes (int): The number of matching processes, 1 to match in this process,
+    by default one per CPU once the library is large enough to be worth it
+
+    Returns:
+    list: The YouTube playlists each track is missing from, in library order
+    '''
+    work = [(entry['track'].name, [target for target in entry['targets'] if target in title_indexes])
+            for entry in library.values()]
+    checks = sum(len(targets) for _, targets in work)
+    if processes == 1 or (processes is None and checks < PROCESS_MATCH_THRESHOLD):
+        _set_title_indexes(title_indexes)
+        return _missing_targets(work)
+
+    chunks = [work[start:start + MATCH_CHUNK_SIZE] for start in range(0, len(work), MATCH_CHUNK_SIZE)]
+    with ProcessPoolExecutor(max_workers=processes, initializer=_set_title_indexes,
+                             initargs=(title_indexes,)) as executor:
+        return [missing for chunk in executor.map(_missing_targets, chunks) for missing in chunk]
+
+
+def sync_library(youtube, pairs, budget, processes=None, max_workers=4, preserve_order=False):
+    '''
+    Sync many Spotify playlists at once. Tracks shared by several playlists are matched and searched
+    only once, at 100 units, and the video found is inserted into every YouTube playlist missing it.
+    Songs found on an earlier run but not inserted are inserted first from the deferred queue.
+
+    A limit on every pair adding to a YouTube playlist caps the songs added to it at the sum of their limits.
+    A YouTube playlist that cannot be read, or a search failing for good, only fails the pairs it concerns.
+    Tracks no video was found for are left pending in the sync state of their pairs and tried again on the next sync.
+
+    Args:
+    youtube (Resource): The authenticated YouTube API client
+    pairs (list): {'spotify', 'youtube', 'limit'} pairs, as loaded by load_manifest
+    budget (QuotaBudget): The quota budget of the run
+    processes (int): The number of matching processes, see match_library
+    max_workers (int): The number of concurrent inserts per YouTube playlist
+    preserve_order (bool): Insert the songs of each YouTube playlist in library order, which follows the order of
+    the first pair each track was found in
+
+    Returns:
+    list: The result of each pair, like sync_pairs
+    '''
+    started = time.monotonic()
+    library, all_changes = collect_library(pairs)
+    changed_pairs = [pair for pair in pairs if isinstance(all_changes[(pair['spotify'], pair['youtube'])], dict)
+                     and not all_changes[(pair['spotify'], pair['youtube'])]['unchanged']]
+    playlist_ids = list(dict.fromkeys(pair['youtube'] for pair in changed_pairs))
+
+    caps = {}
+    for pair in pairs:
+        if pair['limit'] is None or caps.get(pair['youtube'], 0) is None:
+            caps[pair['youtube']] = None
+        else:
+            caps[pair['youtube']] = caps.get(pair['youtube'], 0) + pair['limit']
+    capped = set()
+    pair_videos = [set() for _ in pairs]  # The videos submitted for the tracks of each pair
+    pair_unresolved = [[] for _ in pairs]  # The keys of the tracks of each pair no video was found for
+    errors = {}  # Pair index -> the error that failed it
+
+    targets = {}
+    search_cache = SearchCache()
+    deferred = DeferredInserts()
+    retry = RetryPolicy(max_attempts=3)
+
+    searches = 0
+    stopped_early = False
+    try:
+        for playlist_id in playlist_ids:
+            try:
+                target = PlaylistTarget(youtube, playlist_id, budget, retry, deferred, cap=caps[playlist_id],
+                                        max_workers=max_workers, preserve_order=preserve_order)
+            except Exception as e:
+                logging.error(f"Failed to read YouTube playlist {playlist_id}: {e}")
+                for index, pair in enumerate(pairs):
+                    if pair['youtube'] == playlist_id:
+                        errors[index] = str(e)
+                continue
+            targets[playlist_id] = target
+            if not target.drain_deferred():
+                if target.full:
+                    capped.add(playlist_id)
+                else:
+                    stopped_early = True
+
+        missing = match_library(library, {playlist_id: target.title_index for playlist_id, target in targets.items()},
+                                processes)
+
+        for entry, missing_from in zip(library.values(), missing):
+            track = entry['track']
+            wanted = [targets[playlist_id] for playlist_id in missing_from
+                      if not targets[playlist_id].has_song(track.name, track.artist)]
+            for target in wanted:
+                if target.full:
+                    capped.add(target.playlist_id)
+            wanted = [target for target in wanted if not target.full]
+            if not wanted:
+                continue
+            if budget.exhausted:
+                print(QUOTA_STOPPED_MESSAGE)
+                stopped_early = True
+                break
+
+            try:
+                video_id = resolve_song(youtube, track.name, track.artist, search_cache, budget, retry,
+                                        track.duration_ms, len(wanted))  # Once for every playlist
+                searches += 1
+            except SearchFailed:
+                stopped_early = True
+                continue
+            except SyncStopped as e:
+                print(e)
+                stopped_early = True
+                break
+            except Exception as e:  # Would fail the same way again, fail the pairs wanting this track only
+                logging.error(f"Failed to search for {track.name} by {track.artist}: {e}")
+                for index in entry['pairs']:
+                    if pairs[index]['youtube'] in [target.playlist_id for target in wanted]:
+                        errors.setdefault(index, str(e))
+                continue
+            if not video_id:
+                logging.error(f"Could not find YouTube video for {track.name} by {track.artist}")
+                for index in entry['pairs']:
+                    if pairs[index]['youtube'] in [target.playlist_id for target in wanted]:
+                        pair_unresolved[index].append(track.key)
+                continue
+
+            for target in wanted:
+                if target.submit(track.name, track.artist, video_id):
+                    for index in entry['pairs']:
+                        if pairs[index]['youtube'] == target.playlist_id:
+                            pair_videos[index].add(video_id)
+    finally:
+        statuses = {playlist_id: target.close() for playlist_id, target in targets.items()}
+        deferred.close()
+        search_cache.close()
+
+    logging.info(f"Library sync: {len(library)} unique tracks, {searches} resolved, "
+                 f"{sum(len(target.inserted_items) for target in targets.values())} inserts")
+
+    results = []
+    for index, pair in enumerate(pairs):
+        result = {'spotify': pair['spotify'], 'youtube': pair['youtube'], 'limit': pair['limit']}
+        changes = all_changes[(pair['spotify'], pair['youtube'])]
+        if not isinstance(changes, dict):
+            result.update({'status': 'error', 'error': str(changes)})
+        elif changes['unchanged']:
+            result['status'] = 'unchanged'
+        else:
+            video_statuses = {video_id: status for _, _, video_id, status in statuses.get(pair['youtube'], [])}
+            pair_statuses = [video_statuses[video_id] for video_id in pair_videos[index]]
+            added = pair_statuses.count('added')
+            complete = (not stopped_early and index not in errors and pair['youtube'] not in capped
+                        and added == len(pair_statuses))
+            result.update({'new_tracks': changes['added_count'], 'added': added,
+                           'submitted': len(pair_statuses), 'complete': complete,
+                           'status': 'synced' if complete else 'partial'})
+            if index in errors:
+                result.update({'status': 'error', 'error': errors[index]})
+            if complete:  # Only skip these tracks next time once every one of them was handled
+                pending = set(pair_unresolved[index])
+                track_keys = [key for key in changes['track_keys'] if key is not None and key not in pending]
+                save_sync_state(pair['spotify'], pair['youtube'], changes['snapshot_id'], track_keys, pending)
+                clear_checkpoint(pair['spotify'], pair['youtube'])
+        result['seconds'] = round(time.monotonic() - started, 2)
+        results.append(result)
+    return results
@@ -1,66 +1,318 @@
 import requests
+import requests.adapters
 import sys
 import os
-from dotenv import load_dotenv
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 script_dir = os.path.dirname(__file__)
 sys.path.append(f'{script_dir}/..')
 
 from utils.playlist_utils import update_playlist_ids
-from auth.spotify_auth import get_access_token
+from auth.spotify_auth import token_provider
+from utils.metrics import metrics
+from utils.retry import RetryPolicy
+from utils.playlist_snapshot import load_sync_state
+from utils.records import Track
 
-load_dotenv(script_dir + "/../.env")
-client_id = os.getenv('SPOTIFY_CLIENT_ID')
-client_secret = os.getenv('SPOTIFY_CLIENT_SECRET')
 
+PAGE_SIZE = 100  # The most tracks Spotify returns per page
+MAX_PAGE_WORKERS = 8
+MAX_PLAYLIST_WORKERS = 4  # Playlists streamed at once, e.g. by a library sync, each fetching MAX_PAGE_WORKERS pages
+# Only the fields the sync uses, instead of full track objects with album art and market lists
+TRACK_FIELDS = 'total,items(track(id,name,duration_ms,external_ids(isrc),artists(name)))'
 
-def get_playlist_tracks(playlist_id, access_token):
+session = requests.Session()  # Keeps connections alive between pages and calls
+session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=1,
+                                                        pool_maxsize=MAX_PAGE_WORKERS * MAX_PLAYLIST_WORKERS))
+# Shared by every Spotify request, so a rate limit or an outage slows down all the pages in flight at once
+spotify_retry = RetryPolicy(max_attempts=5)
+
+
+class SpotifyApiError(Exception):
+    '''
+    Raised when the Spotify API answers with an error status. Carries the status and the response headers,
+    so RetryPolicy retries rate limits and server errors and waits as long as Retry-After asks.
+    '''
+
+    def __init__(self, message, status, headers):
+        super().__init__(f"{message} ({status})")
+        self.status = status
+        self.headers = headers
+
+
+def spotify_get(url, params=None, error_message="Spotify API request failed."):
+    '''
+    Send a GET request to the Spotify API with the shared cached access token.
+    If the token is rejected with a 401, a new one is fetched and the request is retried once.
+    Rate limits, server errors and dropped connections are retried by spotify_retry.
+
+    Args:
+    url (str): The URL of the Spotify API endpoint.
+    params (dict): The query parameters.
+    error_message (str): The message of the SpotifyApiError raised if the request fails.
+
+    Returns:
+    Response: The successful response of the request.
+    '''
+    def request():
+        for attempt in range(2):
+            access_token = token_provider.get_token()
+            with metrics.timed('spotify.get'):
+                response = session.get(url, params=params, headers={
+                    'Authorization': f'Bearer {access_token}',
+                    'Content-Type': 'application/json',
+                })
+            if response.status_code != 401:
+                break
+            metrics.increment('retries_total', call='spotify.get')
+            token_provider.invalidate(access_token)
+        if response.status_code != 200:
+            raise SpotifyApiError(error_message, response.status_code, response.headers)
+        return response
+
+    return spotify_retry.run(request, 'spotify.get')
+
+
+def get_tracks_page(playlist_id, offset):
     '''
-    Get the tracks from a Spotify playlist and return a list of dictionaries containing the track information.
+    Get one page of tracks from a Spotify playlist.
 
     Args:
     playlist_id (str): The ID of the Spotify playlist.
-    access_token (str): The access token for authenticating requests to the Spotify API.
+    offset (int): The index of the first track of the page.
 
     Returns:
-    list: The list of dictionaries containing the track information.
-    '''
-    url = f'https://api.spotify.com/v1/playlists/{playlist_id}/tracks'
-    tracks = []
-    while url:
-        response = requests.get(url, headers={
-            'Authorization': f'Bearer {access_token}',
-            'Content-Type': 'application/json',
-        })
-        
-        if response.status_code == 200:  # If request was successful
-            json_response = response.json()
-            tracks.extend(json_response['items'])  # Append the tracks from the current page
-            url = json_response.get('next')  # Update `url` for next page, if available
-        else:
-            raise Exception("Failed to retrieve playlist tracks from Spotify API.")
-    
-    return tracks
+    dict: The page, with 'total' and 'items' keys.
+    '''
+    response = spotify_get(f'https://api.spotify.com/v1/playlists/{playlist_id}/tracks', params={
+        'offset': offset,
+        'limit': PAGE_SIZE,
+        'fields': TRACK_FIELDS,
+    }, error_message="Failed to retrieve playlist tracks from Spotify API.")
+    return response.json()
+
+
+def iter_playlist_pages(playlist_id, start=0):
+    '''
+    Yield the pages of tracks of a Spotify playlist in playlist order, as soon as each one arrives.
+    The first page gives the total number of tracks, the next MAX_PAGE_WORKERS pages are then fetched
+    ahead concurrently, so only a bounded number of pages are held in memory at once.
+
+    Args:
+    playlist_id (str): The ID of the Spotify playlist.
+    start (int): The index of the first track, to resume part way through the playlist.
+
+    Yields:
+    list: The track items of each page.
+    '''
+    first_page = get_tracks_page(playlist_id, start)
+    yield first_page['items']
+
+    offsets = iter(range(start + PAGE_SIZE, first_page['total'], PAGE_SIZE))
+    executor = ThreadPoolExecutor(max_workers=MAX_PAGE_WORKERS)
+    try:
+        in_flight = deque(executor.submit(get_tracks_page, playlist_id, offset)
+                          for offset in itertools.islice(offsets, MAX_PAGE_WORKERS))
+        while in_flight:
+            page = in_flight.popleft().result()
+            for offset in itertools.islice(offsets, 1):  # Keep the window full
+                in_flight.append(executor.submit(get_tracks_page, playlist_id, offset))
+            yield page['items']
+    finally:  # The consumer may stop early, don't fetch pages nobody will read
+        executor.shutdown(cancel_futures=True)
+
+
+def iter_playlist_tracks(playlist_id, start=0):
+    '''
+    Yield the tracks of a Spotify playlist as compact Track records, streamed page by page.
+    The JSON of each page is dropped as soon as its records are made.
+
+    Args:
+    playlist_id (str): The ID of the Spotify playlist.
+    start (int): The index of the first track, to resume part way through the playlist.
+
+    Yields:
+    Track: The track, which unpacks as (track name, artist).
+    '''
+    position = start
+    for items in iter_playlist_pages(playlist_id, start):
+        for item in items:
+            if item.get('track'):  # Tracks removed from Spotify come back as null
+                yield make_track(item['track'], position)
+            position += 1
+
+
+def get_playlist_tracks(playlist_id):
+    '''
+    Get the tracks from a Spotify playlist as a list of compact Track records.
+
+    Args:
+    playlist_id (str): The ID of the Spotify playlist.
+
+    Returns:
+    list: The Track records in playlist order.
+    '''
+    return list(iter_playlist_tracks(playlist_id))
+
+
+def get_playlist_snapshot_id(playlist_id):
+    '''
+    Get the snapshot_id of a Spotify playlist, which changes whenever the playlist is modified.
+
+    Args:
+    playlist_id (str): The ID of the Spotify playlist.
+
+    Returns:
+    str: The snapshot_id of the playlist.
+    '''
+    response = spotify_get(f'https://api.spotify.com/v1/playlists/{playlist_id}', params={'fields': 'snapshot_id'},
+                           error_message="Failed to retrieve playlist snapshot from Spotify API.")
+    return response.json()['snapshot_id']
+
+
+def track_key(track):
+    '''
+    Get a stable key for a Spotify track, its ID, or its ISRC or name and artist for local files without an ID.
+
+    Args:
+    track (dict): The track object.
+
+    Returns:
+    str: The key of the track.
+    '''
+    if track.get('id'):
+        return track['id']
+    isrc = (track.get('external_ids') or {}).get('isrc')
+    if isrc:
+        return f"isrc:{isrc}"
+    return f"local:{track['name']}\x1f{track['artists'][0]['name']}"
+
+
+def make_track(track, position=None):
+    '''
+    Make a compact Track record from a Spotify track object, keeping the name, first artist, track key and length.
+
+    Args:
+    track (dict): The track object.
+    position (int): The index of the track in its playlist.
+
+    Returns:
+    Track: The track record.
+    '''
+    return Track(track['name'], track['artists'][0]['name'], track_key(track), position, track.get('duration_ms'))
 
 
 def spotify_track_lister(my_playlist_id):
     '''
-    Get the tracks from a Spotify playlist and return a list of tuples containing the track name and a list of artists.
+    Get the tracks from a Spotify playlist as Track records, which unpack as (track name, artist).
 
     Returns:
-    list: The list of tuples containing the track name and a list of artists.
-    '''
-    
-    access_token = get_access_token(client_id, client_secret)
-    tracks = get_playlist_tracks(my_playlist_id, access_token)
-
-    track_list = []
-    for item in tracks:
-        track = item['track']
-        track_name = track['name']
-        artist_names = track['artists'][0]['name']
-        track_list.append((track_name, artist_names))
-    return track_list
+    list: The list of Track records.
+    '''
+    return get_playlist_tracks(my_playlist_id)  # Uses the shared cached access token
+
+
+def spotify_track_changes(spotify_playlist_id, youtube_playlist_id, checkpoint=None):
+    '''
+    Work out which tracks were added to a Spotify playlist since it was last fully synced into a YouTube playlist.
+    If the playlist snapshot_id has not changed, the tracks are not downloaded at all.
+    Otherwise 'added' is a generator streaming the new tracks page by page, so they can be added while the
+    rest of the playlist is still downloading. 'track_keys', 'removed' and 'added_count' are filled in as it
+    is consumed, and are complete once it is exhausted.
+
+    Given the checkpoint of an interrupted sync of the same snapshot, the stream starts at its position
+    instead of the first track, so tracks already handled are neither downloaded nor matched again.
+    Tracks the last sync left pending are streamed again, even if the snapshot has not changed.
+
+    Args:
+    spotify_playlist_id (str): The ID of the Spotify playlist.
+    youtube_playlist_id (str): The ID of the YouTube playlist.
+    checkpoint (dict): The checkpoint loaded by load_checkpoint, or None.
+
+    Returns:
+    dict: {'unchanged': bool, 'snapshot_id': str, 'start': int, 'added': iterator of Track records,
+    'added_count': int, 'removed': list of track keys, 'track_keys': list of the key of every track in
+    playlist order, None for unavailable tracks so the list lines up with track positions, 'pending': list of
+    the keys of the tracks before start left pending by the checkpoint}
+    '''
+    snapshot_id = get_playlist_snapshot_id(spotify_playlist_id)
+    changes, previous_keys = start_track_changes(spotify_playlist_id, youtube_playlist_id, snapshot_id, checkpoint)
+    if changes['unchanged']:
+        return changes
+
+    def added_tracks():
+        position = changes['start']
+        for items in iter_playlist_pages(spotify_playlist_id, position):
+            yield from page_changes(changes, previous_keys, items, position)
+            position += len(items)
+        finish_track_changes(changes, previous_keys)
+
+    changes['added'] = added_tracks()
+    return changes
+
+
+def start_track_changes(spotify_playlist_id, youtube_playlist_id, snapshot_id, checkpoint=None):
+    '''
+    Compare the snapshot_id of a Spotify playlist with its last complete sync, the part of spotify_track_changes
+    the async engine shares before it streams the pages itself.
+
+    Args:
+    spotify_playlist_id (str): The ID of the Spotify playlist.
+    youtube_playlist_id (str): The ID of the YouTube playlist.
+    snapshot_id (str): The current snapshot_id of the Spotify playlist.
+    checkpoint (dict): The checkpoint loaded by load_checkpoint, or None.
+
+    Returns:
+    dict: The changes, see spotify_track_changes, with 'added' still to be set unless the playlist is unchanged.
+    set: The keys of the tracks the last complete sync handled.
+    '''
+    state = load_sync_state(spotify_playlist_id, youtube_playlist_id)
+    if state and state['snapshot_id'] == snapshot_id and not state.get('pending'):
+        return {'unchanged': True, 'snapshot_id': snapshot_id, 'start': 0, 'added': iter(()), 'added_count': 0,
+                'removed': [], 'track_keys': state['track_keys'], 'pending': []}, set()
+
+    previous_keys = set(state['track_keys']) if state else set()  # Pending tracks are not in it, so they come back
+    start, track_keys, pending = 0, [], []
+    if checkpoint and checkpoint['snapshot_id'] == snapshot_id:  # Positions only hold for the same snapshot
+        start, track_keys = checkpoint['position'], checkpoint['track_keys'][:checkpoint['position']]
+        pending = list(checkpoint.get('pending', []))
+    return {'unchanged': False, 'snapshot_id': snapshot_id, 'start': start, 'added': None, 'added_count': 0,
+            'removed': [], 'track_keys': track_keys, 'pending': pending}, previous_keys
+
+
+def page_changes(changes, previous_keys, items, position):
+    '''
+    Record the keys of a page of tracks in changes, and yield the tracks new since the last complete sync.
+
+    Args:
+    changes (dict): The changes from start_track_changes.
+    previous_keys (set): The keys of the tracks the last complete sync handled.
+    items (list): The track items of the page.
+    position (int): The index in the playlist of the first track of the page.
+
+    Yields:
+    Track: The new tracks, each recorded just before it is yielded.
+    '''
+    for item in items:
+        if not item.get('track'):  # Tracks removed from Spotify come back as null
+            changes['track_keys'].append(None)
+        else:
+            track = make_track(item['track'], position)
+            changes['track_keys'].append(track.key)
+            if track.key not in previous_keys:
+                changes['added_count'] += 1
+                yield track
+        position += 1
+
+
+def finish_track_changes(changes, previous_keys):
+    '''
+    Work out the tracks removed since the last complete sync, once every page has been read.
+    '''
+    current_keys = set(changes['track_keys'])
+    changes['removed'].extend(key for key in previous_keys if key not in current_keys)
 
 
 if __name__ == '__main__':
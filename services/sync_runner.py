@@ -0,0 +1,173 @@
+import os
+import sys
+import json
+import time
+import logging
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+script_dir = os.path.dirname(__file__)
+sys.path.append(f'{script_dir}/..')
+
+from auth.youtube_auth import get_authenticated_service
+from utils.playlist_utils import extract_playlist_id
+from utils.quota import quota_ledger, QuotaBudget
+from utils.metrics import metrics
+from services.youtube_services import sync_spotify_playlist
+
+
+def load_manifest(manifest_path):
+    '''
+    Load a manifest of Spotify to YouTube playlist pairs to sync. Playlists can be given as IDs or full URLs.
+    A manifest looks like:
+
+    {
+        "max_workers": 4,
+        "engine": "async",
+        "preserve_order": true,
+        "pairs": [
+            {"spotify": "https://open.spotify.com/playlist/...", "youtube": "https://music.youtube.com/playlist?list=...", "limit": 20},
+            {"spotify": "37i9dQZF1DXcBWIGoYBM5M", "youtube": "PLxxxxxxxx"}
+        ]
+    }
+
+    "engine" is optional, "async" syncs each pair with services/async_engine.py instead of the threaded code.
+    "mode" is optional, "library" syncs every pair together with services/library_sync.py, so tracks shared
+    by several playlists are searched once. "processes" then sets the number of matching processes.
+    "preserve_order" is optional, true adds the songs to each YouTube playlist in Spotify playlist order.
+
+    Args:
+    manifest_path (str): The path of the manifest JSON file
+
+    Returns:
+    dict: The manifest with 'pairs' holding {'spotify', 'youtube', 'limit'} dictionaries of playlist IDs
+    '''
+    with open(manifest_path, 'r') as f:
+        manifest = json.load(f)
+
+    pairs = []
+    for index, pair in enumerate(manifest.get('pairs', [])):
+        try:
+            spotify_id = extract_playlist_id(pair['spotify']) or pair['spotify']
+            youtube_id = extract_playlist_id(pair['youtube']) or pair['youtube']
+        except KeyError as e:
+            raise ValueError(f"Pair {index} of {manifest_path} is missing its {e} playlist")
+        pairs.append({'spotify': spotify_id, 'youtube': youtube_id, 'limit': pair.get('limit')})
+
+    manifest['pairs'] = pairs
+    return manifest
+
+
+def sync_pairs(youtube, pairs, budget, sync=sync_spotify_playlist, preserve_order=False):
+    '''
+    Sync pairs one after another, used for pairs sharing a YouTube playlist so they never insert into it at once.
+
+    Args:
+    youtube (Resource): The authenticated YouTube API client
+    pairs (list): The pairs to sync
+    budget (QuotaBudget): The quota budget shared by every pair
+    sync (function): The function syncing one pair
+    preserve_order (bool): Add the songs of each pair in Spotify playlist order
+
+    Returns:
+    list: The result of each pair
+    '''
+    results = []
+    for pair in pairs:
+        result = {'spotify': pair['spotify'], 'youtube': pair['youtube'], 'limit': pair['limit']}
+        started = time.monotonic()
+        try:
+            summary = sync(youtube, pair['spotify'], pair['youtube'], chosen_count=pair['limit'], budget=budget,
+                           preserve_order=preserve_order)
+            if summary is None:
+                result['status'] = 'unchanged'
+            else:
+                result.update(summary)
+                result['status'] = 'synced' if summary['complete'] else 'partial'
+        except Exception as e:
+            logging.error(f"Failed to sync {pair['spotify']} to {pair['youtube']}: {e}")
+            result['status'] = 'error'
+            result['error'] = str(e)
+        result['seconds'] = round(time.monotonic() - started, 2)
+        results.append(result)
+    return results
+
+
+def run_manifest(manifest_path, max_workers=None, preserve_order=None):
+    '''
+    Sync every pair of a manifest without asking anything, pairs run concurrently with one shared
+    YouTube client and one shared quota budget.
+
+    Args:
+    manifest_path (str): The path of the manifest JSON file
+    max_workers (int): The number of pairs synced at once, overrides the manifest's max_workers
+    preserve_order (bool): Add songs in Spotify playlist order, overrides the manifest's preserve_order
+
+    Returns:
+    dict: A summary of the run, with the result of every pair
+    '''
+    manifest = load_manifest(manifest_path)
+    max_workers = max_workers or manifest.get('max_workers', 4)
+    library_mode = manifest.get('mode') == 'library'
+    if preserve_order is None:
+        preserve_order = bool(manifest.get('preserve_order', False))
+    sync = sync_spotify_playlist
+    if manifest.get('engine') == 'async':
+        from services.async_engine import sync_spotify_playlist_async as sync
+    youtube = get_authenticated_service()
+    budget = QuotaBudget(quota_ledger.remaining())
+    spent_before = quota_ledger.spent_today()
+    started_at = time.time()
+
+    if library_mode:
+        from services.library_sync import sync_library
+        try:
+            results = sync_library(youtube, manifest['pairs'], budget, processes=manifest.get('processes'),
+                                   max_workers=max_workers, preserve_order=preserve_order)
+        except Exception as e:  # Pairs it could not tell apart fail together, but the summary is still written
+            logging.error(f"Library sync of {manifest_path} failed: {e}")
+            results = [{'spotify': pair['spotify'], 'youtube': pair['youtube'], 'limit': pair['limit'],
+                        'status': 'error', 'error': str(e)} for pair in manifest['pairs']]
+    else:
+        # Pairs adding to the same YouTube playlist are synced in order by the same worker
+        groups = {}
+        for pair in manifest['pairs']:
+            groups.setdefault(pair['youtube'], []).append(pair)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            group_results = executor.map(lambda group: sync_pairs(youtube, group, budget, sync, preserve_order),
+                                         groups.values())
+            results = [result for group in group_results for result in group]
+
+    summary = {
+        'manifest': os.path.abspath(manifest_path),
+        'started_at': started_at,
+        'finished_at': time.time(),
+        'quota_spent': quota_ledger.spent_today() - spent_before,
+        'quota_remaining': quota_ledger.remaining(),
+        'pairs': results,
+    }
+    logging.info(f"Synced {len(results)} pairs from {manifest_path}, spent {summary['quota_spent']} units")
+    return summary
+
+
+def main(manifest_path, summary_path=None, max_workers=None, preserve_order=None):
+    '''
+    Run a manifest and write the summary as JSON to summary_path, or to stdout. When the summary goes
+    to stdout, the progress the sync prints goes to stderr, so stdout holds nothing but the JSON.
+
+    Returns:
+    int: The exit code, 1 if any pair failed
+    '''
+    if summary_path:
+        summary = run_manifest(manifest_path, max_workers, preserve_order)
+    else:
+        with contextlib.redirect_stdout(sys.stderr):
+            summary = run_manifest(manifest_path, max_workers, preserve_order)
+    metrics.write()
+    if summary_path:
+        with open(summary_path, 'w') as f:
+            json.dump(summary, f, indent=4)
+    else:
+        print(json.dumps(summary, indent=4))
+    return 1 if any(result['status'] == 'error' for result in summary['pairs']) else 0
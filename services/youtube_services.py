@@ -1,158 +1,295 @@
 import os
-import time
 import sys
 import logging
-import json
+from logging.handlers import RotatingFileHandler
 
 script_dir = os.path.dirname(__file__)
 sys.path.append(f'{script_dir}/..')
 if not os.path.exists(os.path.join(script_dir, '../logs')):
     os.makedirs(os.path.join(script_dir, '../logs'))
 log_file = os.path.join(script_dir, '../logs/youtube_services.log')
-logging.basicConfig(level=logging.INFO, filename = log_file, filemode= 'w',
+# Long unattended syncs log every song, keep the last few megabytes instead of growing the file forever
+log_handler = RotatingFileHandler(log_file, maxBytes=5 * 1024 * 1024, backupCount=3, encoding='utf-8')
+logging.basicConfig(level=logging.INFO, handlers=[log_handler],
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
 from auth.youtube_auth import get_authenticated_service
 
-from utils.playlist_utils import normalize_title, update_playlist_ids
-from utils.youtube_utils import search_song, fetch_yt_playlist_contents, add_song_to_playlist
-from services.spotify_services import spotify_track_lister
+from utils.playlist_utils import update_playlist_ids
+from utils.youtube_utils import fetch_yt_playlist_items, delete_playlist_items
+from utils.near_duplicates import find_near_duplicates
+from utils.search_cache import SearchCache
+from utils.deferred_inserts import DeferredInserts
+from utils.retry import RetryPolicy
+from utils.playlist_target import PlaylistTarget, SyncStopped, SearchFailed, resolve_song, QUOTA_STOPPED_MESSAGE
+from utils.quota import quota_ledger, QuotaBudget, plan_song_count
+from utils.metrics import metrics
+from utils.playlist_snapshot import record_deletes, save_sync_state, load_checkpoint, save_checkpoint, clear_checkpoint
 
 
-def remove_duplicates(youtube, playlist_id):
+def remove_duplicates(youtube, playlist_id, dry_run=False, near=False):
     '''
     Removes duplicate songs from a YouTube playlist, costs 50 units per removal
+    Deletes are sent in batch requests instead of one round trip per duplicate
 
     Args:
     youtube (Resource): The authenticated YouTube API client
     playlist_id (str): The ID of the YouTube playlist
+    dry_run (bool): Only list the duplicates that would be removed, without spending any delete quota
+    near (bool): Also remove different videos of the same song, e.g. the lyric video next to the official one,
+    see find_near_duplicates. The video added first is kept
 
     Returns:
     None
     '''
-    video_to_playlist_item_ids = fetch_yt_playlist_contents(youtube, playlist_id)[1]  # 1 unit per 50 videos
+    items = fetch_yt_playlist_items(youtube, playlist_id)  # 1 unit per 50 videos
+    item_to_video_id = {}
+    seen_video_ids = set()
+    for item in items:
+        if item.video_id in seen_video_ids:
+            item_to_video_id[item.item_id] = item.video_id
+        seen_video_ids.add(item.video_id)
+
+    clusters = find_near_duplicates(items) if near else []
+    near_video_ids = {item.video_id: cluster['keep'] for cluster in clusters for item in cluster['delete']}
+    for item in items:  # Every copy of a near duplicate video goes
+        if item.video_id in near_video_ids:
+            item_to_video_id[item.item_id] = item.video_id
+
+    if dry_run:
+        for cluster in clusters:
+            print(f"\nSame song ({cluster['similarity']:.0%} similar titles):")
+            print(f"  KEEP    {cluster['keep'].title} ({cluster['keep'].video_id})")
+            for item in cluster['delete']:
+                print(f"  DELETE  {item.title} ({item.video_id})")
+        for item_id, video_id in item_to_video_id.items():
+            if video_id not in near_video_ids:
+                print(f"Would remove playlist item {item_id} (duplicate of video ID {video_id})")
+        print("Dry run, nothing removed. Duplicates found: ", len(item_to_video_id))
+        logging.info(f"Dry run found {len(item_to_video_id)} duplicates, {len(clusters)} near duplicate clusters")
+        return
+
+    results = delete_playlist_items(youtube, list(item_to_video_id))  # 50 units per item
+    record_deletes(playlist_id, [item_id for item_id, status in results.items() if status == 'deleted'])
     count_removed = 0
-    for video_id, playlist_item_id in video_to_playlist_item_ids.items():
-        if len(playlist_item_id) > 1:
-            for item_id in playlist_item_id[1:]:
-                youtube.playlistItems().delete(id=item_id).execute() # 50 units per request
-                count_removed += 1
+    for item_id, status in results.items():
+        video_id = item_to_video_id[item_id]
+        if status == 'deleted':
+            count_removed += 1
+            if video_id in near_video_ids:
+                logging.info(f"Removed near duplicate with video ID {video_id}, "
+                             f"keeping {near_video_ids[video_id].title} ({near_video_ids[video_id].video_id})")
+            else:
                 logging.info(f"Removed duplicate song with video ID {video_id} from the playlist.")
+        else:
+            logging.error(f"Could not remove duplicate playlist item {item_id} with video ID {video_id}: {status}")
     print("Duplicates removed. Total removed: ", count_removed)
     logging.info(f"Total removed: {count_removed}")
+    if count_removed < len(results):
+        print(f"{len(results) - count_removed} duplicates could not be removed, see the log for details.")
     return
 
 
-def attempter(possible_tries, youtube, playlist_id, video_id, song, artist, songs_added_list):
+def song_adder(youtube, playlist_id, tracks, max_workers=4, preserve_order=False, chosen_count=None, budget=None):
     '''
-    Retry adding a song to a YouTube playlist if it fails, costs 50 units
-    
+    Add songs to a YouTube playlist if they are not already in the playlist, costs 100 units per song
+    The run is sized from the quota ledger, it stops before a search whose song could not also be inserted
+    Inserts run concurrently in an InsertPool while searching continues, a quota error stops both
+    Search results are cached on disk, so songs searched on a previous run cost nothing to look up again
+    Songs found on a previous run but not inserted, e.g. because the quota ran out, are inserted first from the
+    deferred queue, and songs that cannot be inserted now are added to it
+    Records songs added in a ledger to prevent re-adding them upon re-running the program
+    Works in tandem with song in playlist checker so first run may add duplicates second run will not
+
     Args:
     youtube (Resource): The authenticated YouTube API client
     playlist_id (str): The ID of the YouTube playlist
-    video_id (str): The ID of the YouTube video
-    song (str): The name of the song
-    artist (str): The artist of the song
+    tracks (iterable): Song and artist pairs, may be a generator streaming them as they are downloaded
+    max_workers (int): The number of concurrent inserts
+    preserve_order (bool): Insert songs in the same order as tracks, at the cost of insert concurrency
+    chosen_count (int): The most songs to add, by default as many as today's remaining quota allows
+    budget (QuotaBudget): A quota budget shared with other runs, by default today's remaining quota
 
     Returns:
-    None
+    dict: Counts of 'added' and 'submitted' songs, 'complete' which is True if every track was
+    processed without stopping early or failing an insert, 'resume_position', the playlist
+    position of the first track left unhandled, or None if there is none or tracks carry no positions,
+    and 'unresolved_keys', the keys of the tracks no video was found for or whose insert failed for good
     '''
-    for attempt in range(possible_tries):
-            try:
-                add_song_to_playlist(youtube, playlist_id, video_id)  # 50 units per request
-                logging.info(f"Added {song} by {artist} to the playlist.")
-                print(f"Added {song} by {artist} to the playlist.")
-                songs_added_list.append((song, artist))
+    MAX_RETRIES = 3
+
+    remaining_units = quota_ledger.remaining()
+    if budget is None:
+        budget = QuotaBudget(remaining_units)
+    print(f"Quota left today: {remaining_units} units, enough to search and add at least "
+          f"{plan_song_count(min(remaining_units, budget.remaining))} songs (songs searched before cost less).")
+    logging.info(f"Quota planner: {remaining_units} units left, {quota_ledger.spent_today()} spent today")
+
+    search_cache = SearchCache()
+    deferred = DeferredInserts()
+    retry = RetryPolicy(max_attempts=MAX_RETRIES)
+    target = PlaylistTarget(youtube, playlist_id, budget, retry, deferred, cap=chosen_count,
+                            max_workers=max_workers, preserve_order=preserve_order)
+
+    stopped_early = False
+    resume_position = None  # Playlist position of the first track not handled, for tracks that have one
+    submitted_keys = {}  # (song, artist) -> the key of the track submitted, to report failed inserts
+    unresolved_keys = []
+    try:
+        if not target.drain_deferred():
+            stopped_early = True
+            tracks = ()  # Nothing more fits in this run, don't start downloading the tracks
+        for track in tracks:
+            song, artist = track
+            position = getattr(track, 'position', None)
+            if target.full or target.stopped:
+                if target.stopped:
+                    print(QUOTA_STOPPED_MESSAGE)
+                stopped_early = True
+                resume_position = position if resume_position is None else resume_position
                 break
+            if target.has_song(song, artist):
+                continue
 
-            except Exception as e:
-                if 'quota' in str(e):
-                    return
-                else:
-                    print(f"Failed to add {song} by {artist} to the playlist. On attempt {attempt + 1} of {possible_tries}")
-                    print('-' * 50)
-                    print(f"Error message: {e}")
-                    logging.error(f"Failed to add {song} by {artist} to the playlist. On attempt {attempt + 1} of {possible_tries}")
-                    print('-' * 50)
-
-                    if attempt < possible_tries - 1:
-                        sleep_time = 4 * (attempt + 1)
-                        print(f"Retrying in {sleep_time} seconds...")
-                        print()
-                        time.sleep(sleep_time)  # Wait before trying again
-                    else:
-                        print("Failed to add song to playlist. Please try again later.")
-                        return
-
-
-def song_adder(youtube, playlist_id, tracks):
+            if target.has_title(song):
+                logging.info(f"{song}  is already in the playlist.")
+                continue
+        
+            try:
+                video_id = resolve_song(youtube, song, artist, search_cache, budget, retry,
+                                        getattr(track, 'duration_ms', None))
+            except SearchFailed:
+                stopped_early = True
+                resume_position = position if resume_position is None else resume_position
+                continue
+            except SyncStopped as e:
+                print(e)
+                stopped_early = True
+                resume_position = position if resume_position is None else resume_position
+                break
+            if not video_id:
+                print(f"Could not find YouTube video for {song} by {artist}")
+                logging.error(f"Could not find YouTube video for {song} by {artist}")
+                unresolved_keys.append(getattr(track, 'key', None))
+                continue
+            if target.submit(song, artist, video_id):
+                submitted_keys[(song, artist)] = getattr(track, 'key', None)
+    finally:
+        results = target.close()
+        deferred.close()
+
+    logging.info(f"Search cache: {search_cache.hits} hits, {search_cache.misses} misses")
+    search_cache.close()
+
+    added = sum(1 for result in results if result[3] == 'added')
+    print(f"Added {added} of {target.submitted} songs to the playlist.")
+    deferred_count = sum(1 for result in results if result[3] == 'deferred')
+    if deferred_count:
+        print(f"{deferred_count} songs were found but could not be added now, they will be added first on the next run.")
+    unresolved_keys.extend(submitted_keys.get((song, artist)) for song, artist, _, status in results
+                           if status == 'failed')
+    return {'added': added, 'submitted': target.submitted, 'complete': not stopped_early and added == target.submitted,
+            'resume_position': resume_position, 'unresolved_keys': [key for key in unresolved_keys if key is not None]}
+
+
+def sync_spotify_playlist(youtube, spotify_playlist_id, youtube_playlist_id, chosen_count=None, budget=None,
+                          adder=song_adder, preserve_order=False):
     '''
-    Add songs to a YouTube playlist if they are not already in the playlist, costs 100 units per song
-    Adds songs added to a list to prevent re-adding them upon re-running the program
-    Works in tandem with song in playlist checker so first run may add duplicates second run will not
+    Add the songs of a Spotify playlist to a YouTube playlist, only looking at tracks added since the last complete sync
+    Nothing is downloaded or searched if the Spotify playlist has not changed
+    A sync that stops early leaves a checkpoint, the next run resumes from the first track it did not handle
+    Tracks no video was found for, or whose insert failed, are left pending and tried again on the next sync
 
     Args:
     youtube (Resource): The authenticated YouTube API client
-    playlist_id (str): The ID of the YouTube playlist
-    tracks (list): A list of tuples containing song and artist pairs
+    spotify_playlist_id (str): The ID of the Spotify playlist
+    youtube_playlist_id (str): The ID of the YouTube playlist
+    chosen_count (int): The most songs to add, see song_adder
+    budget (QuotaBudget): A quota budget shared with other runs, see song_adder
+    adder (function): Adds the new tracks, song_adder or a drop in for it such as the async engine's
+    preserve_order (bool): Add the songs in Spotify playlist order, see song_adder
 
     Returns:
-    None
+    dict: The summary returned by adder, or None if the playlist was unchanged
     '''
-    existing_video_ids = fetch_yt_playlist_contents(youtube, playlist_id)[0]  # 1 unit per 50 videos
-    processed_keys_list = [normalize_title(key) for key in existing_video_ids]
-    count = 0
-    chosen_count = None
-    MAX_RETRIES = 3
-
-    while not chosen_count:
-        chosen_count = input("How many songs do you want to add to the playlist? (Beware of quota limits): ")
-        if chosen_count.isdigit():
-            chosen_count = int(chosen_count)
-        else:
-            print("Please enter a valid number.")
-            chosen_count = None
-
-    songs_add_list_path = os.path.join(script_dir, '../data/songs_added_list.json')
-    try:
-        with open(songs_add_list_path, 'r') as f:
-            songs_added_list = json.load(f)
-    except FileNotFoundError:
-        songs_added_list = []
-
-    for song, artist in tracks:
-        if count == chosen_count:
-            break
-        if [song, artist] in songs_added_list:
-            continue
-
-        song_words = normalize_title(song).split(" ")
-        score = 0.0
-        for word in song_words:
-            if any(word in key for key in processed_keys_list):
-                score += 1
-        if score / len(song_words) == 1.0:
-            logging.info(f"{song}  is already in the playlist.")
-            continue
-        
-        video_id = search_song(youtube, song, artist)  # 100 units per request
-        if not video_id:
-            print(f"Could not find YouTube video for {song} by {artist}")
-            logging.error(f"Could not find YouTube video for {song} by {artist}")
-            continue
-
-        count += 1
-        attempter(MAX_RETRIES, youtube, playlist_id, video_id, song, artist, songs_added_list)
+    from services.spotify_services import spotify_track_changes  # Removing duplicates never loads the Spotify client
+    checkpoint = load_checkpoint(spotify_playlist_id, youtube_playlist_id)
+    changes = spotify_track_changes(spotify_playlist_id, youtube_playlist_id, checkpoint)
+    if not start_sync(spotify_playlist_id, youtube_playlist_id, changes):
+        return None
+    summary = adder(youtube, youtube_playlist_id, changes['added'], chosen_count=chosen_count, budget=budget,
+                    preserve_order=preserve_order)
+    record_sync(spotify_playlist_id, youtube_playlist_id, changes, summary)
+    return summary
+
+
+def start_sync(spotify_playlist_id, youtube_playlist_id, changes):
+    '''
+    Tell the user what a sync is about to do, shared with the async engine
 
-    with open(songs_add_list_path, 'w') as f:
-        json.dump(songs_added_list, f)
+    Args:
+    spotify_playlist_id (str): The ID of the Spotify playlist
+    youtube_playlist_id (str): The ID of the YouTube playlist
+    changes (dict): The changes from spotify_track_changes
 
-    print(f"Added {count} songs to the playlist.")
+    Returns:
+    bool: False if the Spotify playlist has not changed and there is nothing to add
+    '''
+    if changes['unchanged']:
+        clear_checkpoint(spotify_playlist_id, youtube_playlist_id)
+        print("The Spotify playlist has not changed since the last sync, nothing to add.")
+        logging.info(f"Spotify playlist {spotify_playlist_id} unchanged at snapshot {changes['snapshot_id']}")
+        return False
+    if changes['start']:
+        print(f"Resuming the last sync from track {changes['start'] + 1}.")
+        logging.info(f"Resuming sync of {spotify_playlist_id} into {youtube_playlist_id} at position {changes['start']}")
+    return True
+
+
+def record_sync(spotify_playlist_id, youtube_playlist_id, changes, summary):
+    '''
+    Save the sync state once every new track was handled, or a checkpoint for the next run to resume from,
+    shared with the async engine
 
+    Args:
+    spotify_playlist_id (str): The ID of the Spotify playlist
+    youtube_playlist_id (str): The ID of the YouTube playlist
+    changes (dict): The changes from spotify_track_changes, after the adder has read its tracks
+    summary (dict): The summary returned by the adder
 
-def manage_youtube_playlist():
+    Returns:
+    None
+    '''
+    if summary['complete']:
+        print(f"{changes['added_count']} new tracks and {len(changes['removed'])} removed tracks since the last sync.")
+    else:  # The stream was not read to the end
+        print(f"Stopped after reading {changes['added_count']} new tracks, the rest are added on the next sync.")
+    logging.info(f"Spotify playlist {spotify_playlist_id}: {changes['added_count']} added, {len(changes['removed'])} removed")
+
+    pending = set(changes['pending']).union(summary['unresolved_keys'])
+    if pending:
+        print(f"{len(pending)} tracks could not be added, they are tried again on the next sync.")
+    if summary['complete']:  # Only skip these tracks next time once every one of them was handled
+        track_keys = [key for key in changes['track_keys'] if key is not None and key not in pending]
+        save_sync_state(spotify_playlist_id, youtube_playlist_id, changes['snapshot_id'], track_keys, pending)
+        clear_checkpoint(spotify_playlist_id, youtube_playlist_id)
+    else:
+        # Every track read before the first unhandled one was handled, songs found but not inserted wait in the deferred queue
+        position = summary['resume_position']
+        if position is None:
+            position = len(changes['track_keys'])
+        track_keys = changes['track_keys'][:position]
+        handled = set(track_keys)
+        save_checkpoint(spotify_playlist_id, youtube_playlist_id, changes['snapshot_id'], position, track_keys,
+                        [key for key in pending if key in handled])
+
+
+def manage_youtube_playlist(preserve_order=False):
     '''
     Tries authentication, then gets playlist IDs and asks user what they want to do
+
+    Args:
+    preserve_order (bool): Add songs from Spotify in playlist order, see song_adder
     '''
     try:
         youtube = get_authenticated_service()
@@ -169,20 +306,33 @@ def manage_youtube_playlist():
     spotify_playlist_id, youtube_playlist_id = update_playlist_ids()
 
     choice = '1'
-    while choice in ['1', '2']:
+    while choice in ['1', '2', '3', '4', '5']:
         choice = input("\nDo you want to \n"
                     "1: remove duplicates from the playlist? Or \n"
-                    "2: add songs to the playlist from spotify? \n"
-                    "Enter 1 or 2, or any other key to exit\n: ")
+                    "2: add songs to the playlist from spotify? Or \n"
+                    "3: list the duplicates that would be removed? Or \n"
+                    "4: list near duplicates, other videos of the same song, that would be removed? Or \n"
+                    "5: remove duplicates and near duplicates from the playlist? \n"
+                    "Enter 1, 2, 3, 4 or 5, or any other key to exit\n: ")
         
         try:
             if choice == '1':
                 print("Removing duplicates from the playlist...")
                 remove_duplicates(youtube, youtube_playlist_id)
 
+            if choice == '3':
+                remove_duplicates(youtube, youtube_playlist_id, dry_run=True)
+
+            if choice == '4':
+                remove_duplicates(youtube, youtube_playlist_id, dry_run=True, near=True)
+
+            if choice == '5':
+                print("Removing duplicates and near duplicates from the playlist...")
+                remove_duplicates(youtube, youtube_playlist_id, near=True)
+
             if choice == '2':
                 print("\nLoading...\n")
-                song_adder(youtube, youtube_playlist_id, spotify_track_lister(spotify_playlist_id))
+                sync_spotify_playlist(youtube, spotify_playlist_id, youtube_playlist_id, preserve_order=preserve_order)
 
         except Exception as e:
             if 'quota' in str(e):
@@ -192,6 +342,7 @@ def manage_youtube_playlist():
                 logging.error(f"An error occurred: {e}")
                 print("\nIf the problem persists, perhaps your playist ID is incorrect. Please check and try again.")
 
+    metrics.write()
     print("\nClosing program. Bye!")
     return
 
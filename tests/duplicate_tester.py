@@ -1,118 +1,114 @@
 import json
 import os
 import sys
+import time
 
 script_dir = os.path.dirname(__file__)
 sys.path.append(f'{script_dir}/..')
-if not os.path.exists(os.path.join(script_dir, '../data')):
-    os.makedirs(os.path.join(script_dir, '../data'))
-test_file = os.path.join(script_dir, '../logs/song_log.json')
+if not os.path.exists(os.path.join(script_dir, '../logs')):
+    os.makedirs(os.path.join(script_dir, '../logs'))
+test_file = os.path.join(script_dir, '../logs/song_log.jsonl')
 
 from auth.youtube_auth import get_authenticated_service
-from utils.playlist_utils import normalize_title, update_playlist_ids
+from utils.playlist_utils import normalize_title, normalize_titles, update_playlist_ids, TitleIndex
 from utils.youtube_utils import fetch_yt_playlist_contents
-from services.spotify_services import spotify_track_lister
+from services.spotify_services import iter_playlist_tracks
 
 
-def create_missing_songs_dict():
+def find_missing_songs(tracks, youtube_titles):
     '''
-    Creates a dictionary of songs and titles that are missing from the YouTube playlist.
-    Assumes that both playlists are in the same order and have the same songs. Used for testing purposes.
+    Finds the songs that are missing from the YouTube playlist, by checking every word of each song
+    against a TitleIndex of the playlist titles instead of scanning every title for every word.
+    Tracks are consumed as they come, so a stream of Spotify pages is checked while it downloads.
+    Each missing song is paired with the title at the same position, assuming both playlists are in the
+    same order. Used for testing purposes.
+
+    Args:
+    tracks (iterable): Track records, or (song, artist) pairs, of the Spotify playlist
+    youtube_titles (iterable): The video titles of the YouTube playlist
 
     Returns:
-    dict: The dictionary of missing songs and titles
+    dict: The missing songs mapped to the YouTube title at their position, or None past the end of the playlist
+    int: The number of tracks checked
     '''
-    spotify_playlist_id, youtube_playlist_id = update_playlist_ids()
-    youtube = get_authenticated_service()
-    tracks = spotify_track_lister(spotify_playlist_id)
-    playlist_id = youtube_playlist_id
-    existing_video_ids = fetch_yt_playlist_contents(youtube, playlist_id)[0]
+    processed_titles = list(dict.fromkeys(normalize_titles(youtube_titles)))  # Ordered, without duplicates
+    title_index = TitleIndex(processed_titles)
 
-    processed_songs = [normalize_title(track[0]) for track in tracks]
-    processed_keys_list = []
+    song_not_in_title_dict = {}
+    track_count = 0
+    for index, (song, _) in enumerate(tracks):
+        track_count += 1
+        processed_song = normalize_title(song)
+        if processed_song in song_not_in_title_dict or title_index.contains_song(processed_song):
+            continue
+        song_not_in_title_dict[processed_song] = processed_titles[index] if index < len(processed_titles) else None
 
-    # Create a list of processed keys from the existing_video_ids dictionary removing duplicates
-    for key in existing_video_ids.keys():
-        processed_key = normalize_title(key)
-        if processed_key not in processed_keys_list:
-            processed_keys_list.append(processed_key)
+    return song_not_in_title_dict, track_count
 
-    # Create a dictionary of missing songs and titles
-    song_not_in_title_dict = {}
-    for index, song in enumerate(processed_songs):
-        song_words = song.split(" ")
-        score = 0.0
-        for word in song_words:  # for every word in your string
-            if any(word in key for key in processed_keys_list):  # if it is in your bigger string increase score
-                score += 1
-        if score / len(song_words) != 1.0:  # If not all words in the song are in a title
-            try:
-                song_not_in_title_dict[song] = processed_keys_list[index]  # Add the song and title to the dictionary
-            except IndexError:
-                pass
-
-    return song_not_in_title_dict
-
-
-def write_to_file(song_not_in_title_dict):
-    '''
-    Writes the missing songs and titles to a JSON file.
-    The file is named "song_log.json" and is written to the current working directory.
-    The file is updated with the missing songs and titles each time this function is called.
 
-    Args:
-    song_not_in_title_dict (dict): The dictionary of missing songs and titles
+def create_missing_songs_report():
+    '''
+    Downloads both playlists and builds the report of songs missing from the YouTube playlist.
 
     Returns:
-    int: The count of the current missing songs and titles dictionary in the JSON file
+    dict: The report, {'run_at', 'spotify_playlist_id', 'youtube_playlist_id', 'track_count',
+    'youtube_count', 'missing_count', 'seconds', 'missing'}
     '''
-
-    if os.path.exists(test_file) and os.path.getsize(test_file) > 0:
-        with open(test_file, 'r') as f:
-            existing_data = json.load(f)
-    else:
-        existing_data = {}
-
-    count = existing_data.get('count', 0) + 1
-
-    data = {
-        f"missing_songs_and_titles_{count}": song_not_in_title_dict,
-        "count": count
+    spotify_playlist_id, youtube_playlist_id = update_playlist_ids()
+    youtube = get_authenticated_service()
+    started = time.perf_counter()
+    existing_video_ids = fetch_yt_playlist_contents(youtube, youtube_playlist_id)[0]
+    missing, track_count = find_missing_songs(iter_playlist_tracks(spotify_playlist_id), existing_video_ids)
+
+    return {
+        'run_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'spotify_playlist_id': spotify_playlist_id,
+        'youtube_playlist_id': youtube_playlist_id,
+        'track_count': track_count,
+        'youtube_count': len(existing_video_ids),
+        'missing_count': len(missing),
+        'seconds': round(time.perf_counter() - started, 2),
+        'missing': missing,
     }
 
-    existing_data.update(data)
 
-    with open(test_file, 'w') as f:
-        json.dump(existing_data, f, indent=4)
+def write_to_file(report):
+    '''
+    Appends a report to logs/song_log.jsonl as one JSON line, so writing it takes the same time
+    however many runs the log already holds.
+
+    Args:
+    report (dict): The report from create_missing_songs_report
 
-    return count
+    Returns:
+    None
+    '''
+    with open(test_file, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(report) + '\n')
 
 
-def print_songs_and_titles(count):
+def print_songs_and_titles(report):
     '''
-    Prints the songs and titles that are missing from the YouTube playlist.
-    The count parameter is used to access the correct dictionary in the JSON file.
-    
+    Prints the songs that are missing from the YouTube playlist, next to the title at their position.
+
     Args:
-    count (int): The count of the current missing songs and titles dictionary in the JSON file
+    report (dict): The report from create_missing_songs_report
 
     Returns:
     None
     '''
-    with open(test_file, 'r') as f:
-        data = json.load(f)
-    
-    missing_songs_and_titles = data.get(f"missing_songs_and_titles_{count}", {})
-    for song, title in missing_songs_and_titles.items():
-        print(f"{song:<40} {title}")
+    for song, title in report['missing'].items():
+        print(f"{song:<40} {title or ''}")
+    print(f"\n{report['missing_count']} of {report['track_count']} songs missing, "
+          f"checked in {report['seconds']} seconds")
 
 
 def main():
     try:
-        song_not_in_title_dict = create_missing_songs_dict()
-        count = write_to_file(song_not_in_title_dict)  # Write to file and returns the count
+        report = create_missing_songs_report()
+        write_to_file(report)
         print("Finished writing to file")
-        print_songs_and_titles(count)
+        print_songs_and_titles(report)
 
     except Exception as e:
         if 'quota' in str(e):
@@ -0,0 +1,376 @@
+import json
+import random
+import socket
+import asyncio
+import threading
+import time
+import zlib
+
+from utils.quota import UNIT_COSTS
+
+
+class FakeHttpError(Exception):
+    '''
+    Stands in for googleapiclient's HttpError, with the status on .resp.status and the reason in the message.
+    '''
+
+    class Response:
+        def __init__(self, status):
+            self.status = status
+
+    def __init__(self, status, reason):
+        super().__init__(f"<HttpError {status}: {reason}>")
+        self.resp = self.Response(status)
+        self.reason = reason
+
+
+def make_spotify_playlist(track_count, artist_count=None, seed=0):
+    '''
+    Builds a synthetic Spotify playlist of track items in the shape the Spotify API returns them.
+    Track lengths match the studio recording FakeYouTube returns for each track, see fake_duration.
+
+    Args:
+    track_count (int): The number of tracks
+    artist_count (int): The number of distinct artists, by default one per 10 tracks
+    seed (int): The random seed
+
+    Returns:
+    list: The track items
+    '''
+    rng = random.Random(seed)
+    artist_count = artist_count or max(track_count // 10, 1)
+    words = ["love", "night", "fire", "dream", "heart", "summer", "rain", "gold", "wild", "echo", "blue", "home"]
+    items = []
+    for i in range(track_count):
+        name = f"{rng.choice(words).title()} {rng.choice(words).title()} {i}"
+        if rng.random() < 0.2:
+            name += f" (feat. Artist {rng.randrange(artist_count)})"
+        artist = f"Artist {rng.randrange(artist_count)}"
+        items.append({'track': {
+            'id': f"sp{i:07d}",
+            'name': name,
+            'duration_ms': fake_duration(f"{name} {artist}") * 1000,
+            'external_ids': {'isrc': f"QZ{i:010d}"},
+            'artists': [{'name': artist}],
+        }})
+    return items
+
+
+def video_id_for(query):
+    return f"v{zlib.crc32(query.encode('utf-8')):010d}"
+
+
+def fake_duration(query):
+    '''
+    The length in seconds of the studio recording of a song, between 2 and 6 minutes.
+
+    Args:
+    query (str): The song name and artist, as searched for
+
+    Returns:
+    int: The length in seconds
+    '''
+    return 120 + zlib.crc32(query.encode('utf-8')) % 240
+
+
+def search_results(query):
+    '''
+    Builds the results of a search the way YouTube returns them: the studio recording on a "- Topic" channel,
+    ranked below a live version and a cover, and a lyric video of a slightly different length after it.
+
+    Args:
+    query (str): The song name and artist, as searched for
+
+    Returns:
+    list: (video_id, title, channel, seconds) tuples in YouTube's order, the studio recording's video ID
+    is video_id_for(query)
+    '''
+    seconds = fake_duration(query)
+    return [
+        (video_id_for(f"{query} live"), f"{query} (Live)", "Concert Archive", seconds + 45),
+        (video_id_for(f"{query} cover"), f"{query} (Cover)", "Cover Nation", seconds - 20),
+        (video_id_for(query), query, "Fake - Topic", seconds),
+        (video_id_for(f"{query} lyrics"), f"{query} (Lyrics)", "Lyrics Hub", seconds + 9),
+    ]
+
+
+def format_duration(seconds):
+    return f"PT{seconds // 60}M{seconds % 60}S"
+
+
+def make_youtube_playlist(spotify_items, present_fraction=0.9, duplicate_fraction=0.02, seed=0):
+    '''
+    Builds a YouTube playlist holding some of the Spotify tracks, titled the way YouTube videos usually are.
+
+    Args:
+    spotify_items (list): The Spotify track items
+    present_fraction (float): The fraction of tracks already in the playlist
+    duplicate_fraction (float): The fraction of playlist items added a second time
+    seed (int): The random seed
+
+    Returns:
+    list: [playlist_item_id, video_id, title] lists
+    '''
+    rng = random.Random(seed)
+    suffixes = ["", " (Official Video)", " [Official Audio]", " (Lyrics)"]
+    items = []
+    for item in spotify_items:
+        track = item['track']
+        if rng.random() >= present_fraction:
+            continue
+        artist = track['artists'][0]['name']
+        video_id = video_id_for(f"{track['name']} {artist}")
+        items.append([f"pi{len(items):08d}", video_id, f"{artist} - {track['name']}{rng.choice(suffixes)}"])
+    for item in rng.sample(items, int(len(items) * duplicate_fraction)):
+        items.append([f"pi{len(items):08d}", item[1], item[2]])
+    return items
+
+
+class FakeRequest:
+    def __init__(self, youtube, method, handler):
+        self.youtube = youtube
+        self.method = method
+        self.handler = handler
+        self.headers = {}
+
+    def execute(self, http=None):
+        return self.youtube.call(self.method, self.handler, self.headers)
+
+
+class FakeBatch:
+    def __init__(self, callback):
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id):
+        self.requests.append((request_id, request))
+
+    def execute(self, http=None):
+        for request_id, request in self.requests:
+            try:
+                self.callback(request_id, request.execute(), None)
+            except FakeHttpError as e:
+                self.callback(request_id, None, e)
+
+
+class FakeResource:
+    def __init__(self, **methods):
+        self.__dict__.update(methods)
+
+
+class FakeYouTube:
+    '''
+    In-process stand-in for the googleapiclient YouTube resource, covering search, videos list, playlistItems
+    list/insert/delete and batch requests. Every call sleeps for latency seconds, fails with a 500
+    for error_rate of calls, is counted, and is charged against daily_quota like the real API.
+    Searches return several candidates, see search_results, so the ranking is exercised as well.
+    The default quota is large enough for the biggest benchmark, pass 10000 to measure running out of it.
+    '''
+
+    def __init__(self, playlists=None, latency=0.0, error_rate=0.0, daily_quota=10000000,
+                 missing_fraction=0.05, seed=0):
+        self.playlists = {playlist_id: [list(item) for item in items] for playlist_id, items in (playlists or {}).items()}
+        self.latency = latency
+        self.error_rate = error_rate
+        self.daily_quota = daily_quota
+        self.missing_fraction = missing_fraction
+        self.units = 0
+        self.calls = {}
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._next_item = 0
+        self._durations = {}  # Video ID -> length in seconds, of every video a search returned
+
+    def call(self, method, handler, headers):
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            if self.units + UNIT_COSTS[method] > self.daily_quota:
+                raise FakeHttpError(403, "quotaExceeded")
+            self.units += UNIT_COSTS[method]
+            failed = self._rng.random() < self.error_rate
+        if self.latency:
+            time.sleep(self.latency)
+        if failed:
+            raise FakeHttpError(500, "backendError")
+        with self._lock:
+            return handler(headers)
+
+    def search(self):
+        def list_(q, **kwargs):
+            def handler(headers):
+                if zlib.crc32(q.encode('utf-8')) % 1000 < self.missing_fraction * 1000:
+                    return {'items': []}
+                results = search_results(q)[:kwargs.get('maxResults', 5)]
+                self._durations.update((video_id, seconds) for video_id, _, _, seconds in results)
+                return {'items': [{'id': {'videoId': video_id}, 'snippet': {'title': title, 'channelTitle': channel}}
+                                  for video_id, title, channel, _ in results]}
+            return FakeRequest(self, 'search.list', handler)
+        return FakeResource(list=list_)
+
+    def videos(self):
+        def list_(part, id, **kwargs):
+            def handler(headers):
+                return {'items': [{'id': video_id, 'contentDetails': {'duration': format_duration(self._durations[video_id])}}
+                                  for video_id in id.split(',') if video_id in self._durations]}
+            return FakeRequest(self, 'videos.list', handler)
+        return FakeResource(list=list_)
+
+    def playlistItems(self):
+        def list_(playlistId, maxResults=50, pageToken=None, **kwargs):
+            def handler(headers):
+                items = self.playlists.setdefault(playlistId, [])
+                start = int(pageToken or 0)
+                page = items[start:start + maxResults]
+                etag = f"{zlib.crc32(json.dumps(page).encode('utf-8')):08x}"
+                if headers.get('If-None-Match') == etag:
+                    raise FakeHttpError(304, "notModified")
+                response = {'etag': etag, 'items': [
+                    {'id': item_id, 'snippet': {'title': title, 'resourceId': {'videoId': video_id}}}
+                    for item_id, video_id, title in page
+                ]}
+                if start + maxResults < len(items):
+                    response['nextPageToken'] = str(start + maxResults)
+                return response
+            return FakeRequest(self, 'playlistItems.list', handler)
+
+        def insert(part, body):
+            def handler(headers):
+                snippet = body['snippet']
+                video_id = snippet['resourceId']['videoId']
+                self._next_item += 1
+                item = [f"new{self._next_item:08d}", video_id, f"Video {video_id}"]
+                self.playlists.setdefault(snippet['playlistId'], []).append(item)
+                return {'id': item[0], 'snippet': {'title': item[2], 'resourceId': {'videoId': video_id}}}
+            return FakeRequest(self, 'playlistItems.insert', handler)
+
+        def delete(id):
+            def handler(headers):
+                for items in self.playlists.values():
+                    for index, item in enumerate(items):
+                        if item[0] == id:
+                            del items[index]
+                            return ''
+                raise FakeHttpError(404, "playlistItemNotFound")
+            return FakeRequest(self, 'playlistItems.delete', handler)
+
+        return FakeResource(list=list_, insert=insert, delete=delete)
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(callback)
+
+
+class FakeResponse:
+    def __init__(self, status_code, data, headers=None):
+        self.status_code = status_code
+        self._data = data
+        self.headers = headers or {}
+
+    def json(self):
+        return self._data
+
+
+class FakeSpotifySession:
+    '''
+    In-process stand-in for the requests.Session spotify_services sends its requests on,
+    serving the playlist tracks and snapshot_id endpoints with the given latency and error rate.
+    '''
+
+    def __init__(self, playlists, latency=0.0, error_rate=0.0, seed=0):
+        self.playlists = playlists
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def get(self, url, params=None, headers=None):
+        with self._lock:
+            self.calls += 1
+            failed = self._rng.random() < self.error_rate
+        if self.latency:
+            time.sleep(self.latency)
+        if failed:
+            return FakeResponse(500, {})
+
+        params = params or {}
+        parts = url.split('/playlists/')[1].split('/')
+        items = self.playlists.get(parts[0])
+        if items is None:
+            return FakeResponse(404, {})
+        if len(parts) == 1:
+            return FakeResponse(200, {'snapshot_id': f"{zlib.crc32(json.dumps(items).encode('utf-8')):08x}"})
+        offset = int(params.get('offset', 0))
+        limit = int(params.get('limit', 100))
+        return FakeResponse(200, {'total': len(items), 'items': items[offset:offset + limit]})
+
+
+class FakeApiServer:
+    '''
+    Serves a FakeYouTube and a FakeSpotifySession over HTTP on localhost, for the aiohttp client of the async engine.
+    Errors come back as the JSON bodies the real APIs send. Runs on its own thread and event loop while in a with block,
+    point async_engine.YOUTUBE_API and SPOTIFY_API at youtube_url and spotify_url.
+    '''
+
+    def __init__(self, youtube, spotify):
+        self.youtube = youtube
+        self.spotify = spotify
+        self._sock = socket.socket()
+        self._sock.bind(('127.0.0.1', 0))
+        port = self._sock.getsockname()[1]
+        self.youtube_url = f'http://127.0.0.1:{port}/youtube/v3'
+        self.spotify_url = f'http://127.0.0.1:{port}/v1'
+
+    def __enter__(self):
+        from aiohttp import web
+
+        self._loop = asyncio.new_event_loop()
+        app = web.Application()
+        app.router.add_route('*', '/youtube/v3/{resource}', self._youtube)
+        app.router.add_get('/v1/{path:.*}', self._spotify)
+        self._runner = web.AppRunner(app)
+        self._loop.run_until_complete(self._runner.setup())
+        self._loop.run_until_complete(web.SockSite(self._runner, self._sock).start())
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    async def _youtube(self, request):
+        from aiohttp import web
+
+        params = dict(request.query)
+        resource = request.match_info['resource']
+        if resource == 'search':
+            params['maxResults'] = int(params.get('maxResults', 5))
+            fake_request = self.youtube.search().list(**params)
+        elif resource == 'videos':
+            fake_request = self.youtube.videos().list(**params)
+        elif request.method == 'GET':
+            params['maxResults'] = int(params.get('maxResults', 50))
+            fake_request = self.youtube.playlistItems().list(**params)
+        elif request.method == 'POST':
+            fake_request = self.youtube.playlistItems().insert(params['part'], await request.json())
+        else:
+            fake_request = self.youtube.playlistItems().delete(params['id'])
+        fake_request.headers.update(request.headers)
+        try:
+            response = await asyncio.to_thread(fake_request.execute)  # FakeYouTube sleeps for its latency
+        except FakeHttpError as e:
+            if e.resp.status == 304:
+                return web.Response(status=304)
+            return web.json_response({'error': {'code': e.resp.status, 'message': e.reason,
+                                                'errors': [{'reason': e.reason}]}}, status=e.resp.status)
+        if response == '':
+            return web.Response(status=204)
+        return web.json_response(response)
+
+    async def _spotify(self, request):
+        from aiohttp import web
+
+        response = await asyncio.to_thread(self.spotify.get, request.path, dict(request.query))
+        return web.json_response(response.json(), status=response.status_code, headers=response.headers)
@@ -0,0 +1,112 @@
+import argparse
+import gc
+import json
+import os
+import sys
+import tracemalloc
+
+script_dir = os.path.dirname(__file__)
+sys.path.append(f'{script_dir}/..')
+
+from tests.fake_services import make_spotify_playlist, make_youtube_playlist
+from services.spotify_services import PAGE_SIZE, make_track, track_key
+from utils.records import PlaylistItem
+
+# Two letter codes of the markets a full Spotify track object lists in available_markets
+MARKETS = [a + b for a in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ' for b in 'ABCDEFG'][:180]
+
+
+def full_spotify_item(item):
+    '''
+    Pads a trimmed track item out to what Spotify returns without a fields filter, with the album, its
+    images and the available_markets arrays, as get_playlist_tracks used to keep in memory.
+    '''
+    track = item['track']
+    return {
+        'added_at': '2024-01-01T00:00:00Z',
+        'added_by': {'id': 'user', 'type': 'user', 'uri': 'spotify:user:user'},
+        'is_local': False,
+        'track': dict(track, **{
+            'album': {
+                'name': f"{track['name']} (Album)",
+                'available_markets': MARKETS,
+                'images': [{'url': f"https://i.scdn.co/image/{track['id']}{size}", 'height': size, 'width': size}
+                           for size in (640, 300, 64)],
+                'artists': track['artists'],
+                'release_date': '2024-01-01',
+            },
+            'available_markets': MARKETS,
+            'duration_ms': 200000,
+            'explicit': False,
+            'popularity': 50,
+            'preview_url': None,
+            'uri': f"spotify:track:{track['id']}",
+        }),
+    }
+
+
+def parsed_pages(items):
+    '''
+    Serialises items in pages of PAGE_SIZE and parses each page back, so every string is a separate
+    object like in a real API response.
+    '''
+    pages = [json.dumps(items[offset:offset + PAGE_SIZE]) for offset in range(0, len(items), PAGE_SIZE)]
+    for page in pages:
+        yield json.loads(page)
+
+
+def retained(build):
+    '''
+    Builds a structure under tracemalloc.
+
+    Returns:
+    tuple: (bytes still allocated once it is built, peak bytes while building)
+    '''
+    gc.collect()
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    del result
+    return current - before, peak - before
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the memory held by track and playlist item records.")
+    parser.add_argument('--tracks', type=int, default=50000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    spotify_items = make_spotify_playlist(args.tracks, seed=args.seed)
+    full_items = [full_spotify_item(item) for item in spotify_items]
+    youtube_items = make_youtube_playlist(spotify_items, seed=args.seed)
+
+    tracemalloc.start()
+    results = [
+        ('spotify: full JSON items', retained(lambda: [item for page in parsed_pages(full_items) for item in page])),
+        ('spotify: fields filtered JSON items', retained(
+            lambda: [item for page in parsed_pages(spotify_items) for item in page])),
+        ('spotify: (name, artist) tuples', retained(
+            lambda: [(item['track']['name'], item['track']['artists'][0]['name'])
+                     for page in parsed_pages(spotify_items) for item in page])),
+        ('spotify: tuples of the Track fields', retained(
+            lambda: [tuple(make_track(item['track'])) + (track_key(item['track']), None, item['track'].get('duration_ms'))
+                     for page in parsed_pages(spotify_items) for item in page])),
+        ('spotify: Track records', retained(
+            lambda: [make_track(item['track']) for page in parsed_pages(spotify_items) for item in page])),
+        ('youtube: item lists', retained(lambda: json.loads(json.dumps(youtube_items)))),
+        ('youtube: PlaylistItem records', retained(
+            lambda: [PlaylistItem(*item) for item in json.loads(json.dumps(youtube_items))])),
+    ]
+    tracemalloc.stop()
+
+    print(f"{args.tracks} tracks, {len(youtube_items)} playlist items")
+    print(f"{'structure':<40} {'retained MB':>12} {'peak MB':>10} {'bytes/item':>11}")
+    for name, (current, peak) in results:
+        count = len(youtube_items) if name.startswith('youtube') else args.tracks
+        print(f"{name:<40} {current / 2 ** 20:>12.2f} {peak / 2 ** 20:>10.2f} {current // count:>11}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+
+script_dir = os.path.dirname(__file__)
+sys.path.append(f'{script_dir}/..')
+
+from tests.fake_services import FakeYouTube, FakeSpotifySession, make_spotify_playlist, make_youtube_playlist
+
+import utils.playlist_snapshot as playlist_snapshot
+import utils.song_ledger as song_ledger
+import utils.search_cache as search_cache
+import utils.deferred_inserts as deferred_inserts
+import services.spotify_services as spotify_services
+from auth.spotify_auth import token_provider
+from utils.quota import quota_ledger
+from utils.playlist_utils import normalize_title, normalize_titles, TitleIndex
+from utils.youtube_utils import fetch_yt_playlist_contents
+from services.youtube_services import song_adder, remove_duplicates
+
+SPOTIFY_PLAYLIST_ID = 'benchspotify'
+YOUTUBE_PLAYLIST_ID = 'benchyoutube'
+
+
+def isolate_data(data_dir, daily_quota):
+    '''
+    Points every on-disk store at a scratch directory, so a benchmark never touches data/ or the real quota ledger.
+
+    Args:
+    data_dir (str): The scratch directory
+    daily_quota (int): The quota the ledger plans with
+    '''
+    playlist_snapshot.snapshot_dir = os.path.join(data_dir, 'snapshots')
+    song_ledger.ledger_dir = os.path.join(data_dir, 'songs_added')
+    song_ledger.legacy_ledger_paths = []
+    search_cache.cache_path = os.path.join(data_dir, 'search_cache.sqlite3')
+    deferred_inserts.deferred_path = os.path.join(data_dir, 'deferred_inserts.jsonl')
+    os.makedirs(playlist_snapshot.snapshot_dir)
+    os.makedirs(song_ledger.ledger_dir)
+
+    quota_ledger.path = os.path.join(data_dir, 'quota_ledger.json')
+    quota_ledger.days = {}
+    quota_ledger.daily_quota = daily_quota
+
+    token_provider.cache_path = None
+    token_provider.access_token = 'benchmark'
+    token_provider.expires_at = float('inf')
+
+
+def measure(name, function, youtube=None, spotify=None):
+    '''
+    Runs a function with its output silenced, recording wall time, CPU time, API calls and quota units.
+
+    Returns:
+    dict: The measurements
+    '''
+    calls_before = dict(youtube.calls) if youtube else {}
+    units_before = youtube.units if youtube else 0
+    spotify_before = spotify.calls if spotify else 0
+    wall, cpu = time.perf_counter(), time.process_time()
+    error = None
+    with contextlib.redirect_stdout(io.StringIO()):
+        try:
+            function()
+        except Exception as e:
+            error = str(e)
+    result = {
+        'operation': name,
+        'wall_seconds': round(time.perf_counter() - wall, 4),
+        'cpu_seconds': round(time.process_time() - cpu, 4),
+        'youtube_calls': sum(youtube.calls.values()) - sum(calls_before.values()) if youtube else 0,
+        'spotify_calls': spotify.calls - spotify_before if spotify else 0,
+        'quota_units': youtube.units - units_before if youtube else 0,
+    }
+    if error:
+        result['error'] = error
+    return result
+
+
+def benchmark_matcher(spotify_items, youtube_items):
+    '''
+    CPU time of the "already in playlist" check alone: building the title index and matching every track.
+    '''
+    cpu = time.process_time()
+    title_index = TitleIndex(normalize_titles(title for _, _, title in youtube_items))
+    matched = sum(1 for item in spotify_items if title_index.contains_song(normalize_title(item['track']['name'])))
+    return {'operation': 'matcher', 'cpu_seconds': round(time.process_time() - cpu, 4), 'matched': matched}
+
+
+def run_size(track_count, latency, error_rate, daily_quota, seed):
+    '''
+    Benchmarks every operation against a synthetic playlist pair of track_count tracks.
+
+    Returns:
+    list: The measurements of each operation
+    '''
+    spotify_items = make_spotify_playlist(track_count, seed=seed)
+    youtube_items = make_youtube_playlist(spotify_items, seed=seed)
+    spotify = FakeSpotifySession({SPOTIFY_PLAYLIST_ID: spotify_items}, latency=latency, error_rate=error_rate, seed=seed)
+    youtube = FakeYouTube({YOUTUBE_PLAYLIST_ID: youtube_items}, latency=latency, error_rate=error_rate,
+                          daily_quota=daily_quota, seed=seed)
+    results = []
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        isolate_data(data_dir, daily_quota)
+        spotify_services.session = spotify
+        tracks = []
+
+        results.append(measure('spotify_track_lister',
+                               lambda: tracks.extend(spotify_services.spotify_track_lister(SPOTIFY_PLAYLIST_ID)),
+                               spotify=spotify))
+        results.append(measure('fetch_yt_playlist_contents (cold)',
+                               lambda: fetch_yt_playlist_contents(youtube, YOUTUBE_PLAYLIST_ID), youtube))
+        results.append(measure('fetch_yt_playlist_contents (revalidate)',
+                               lambda: fetch_yt_playlist_contents(youtube, YOUTUBE_PLAYLIST_ID, max_age=0), youtube))
+        results.append(measure('fetch_yt_playlist_contents (fresh)',
+                               lambda: fetch_yt_playlist_contents(youtube, YOUTUBE_PLAYLIST_ID), youtube))
+        results.append(benchmark_matcher(spotify_items, youtube_items))
+        results.append(measure('song_adder', lambda: song_adder(youtube, YOUTUBE_PLAYLIST_ID, tracks), youtube))
+        results.append(measure('remove_duplicates', lambda: remove_duplicates(youtube, YOUTUBE_PLAYLIST_ID), youtube))
+
+    for result in results:
+        result['tracks'] = track_count
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the sync against in-process Spotify and YouTube fakes.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000],
+                        help="Playlist sizes to benchmark, e.g. 100 1000 10000 100000")
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds every fake API call takes")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of fake API calls failing with a 500")
+    parser.add_argument('--quota', type=int, default=10000000,
+                        help="Daily YouTube quota of the fake, 10000 like the real API to measure running out of it")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help="Also write the results to this file, to compare runs for regressions")
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        results.extend(run_size(size, args.latency, args.error_rate, args.quota, args.seed))
+
+    print(f"{'tracks':>7} {'operation':<40} {'wall s':>8} {'cpu s':>8} {'yt calls':>9} {'sp calls':>9} {'units':>7}")
+    for result in results:
+        print(f"{result['tracks']:>7} {result['operation']:<40} {result.get('wall_seconds', ''):>8} "
+              f"{result['cpu_seconds']:>8} {result.get('youtube_calls', ''):>9} {result.get('spotify_calls', ''):>9} "
+              f"{result.get('quota_units', ''):>7} {result.get('error', '')}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+import os
+import json
+import time
+import threading
+import logging
+
+script_dir = os.path.dirname(__file__)
+if not os.path.exists(os.path.join(script_dir, '../data')):
+    os.makedirs(os.path.join(script_dir, '../data'))
+deferred_path = os.path.join(script_dir, '../data/deferred_inserts.jsonl')
+
+
+_file_lock = threading.Lock()  # Every queue of the process writes the same file, runs of several pairs share it
+
+
+class DeferredInserts:
+    '''
+    Queue of songs already resolved to a video ID but not inserted, because the quota ran out or the
+    API kept failing. The next run inserts them first, without spending 100 units to search them again.
+
+    Kept as a JSON lines journal: every deferral is flushed to disk straight away, and entries that
+    were inserted since are dropped when the queue is closed. Pairs synced at once each have their own
+    queue over the same file, so closing merges with what is on disk instead of overwriting it, and
+    only drops the entries this queue discarded.
+    '''
+
+    def __init__(self, path=None):
+        self.path = path or deferred_path
+        self.entries = {}  # (playlist_id, video_id) -> entry, in the order they were deferred
+        self._added = set()  # Deferred by this queue
+        self._discarded = {}  # (playlist_id, video_id) -> when it was discarded
+        self._torn = False
+        self._lock = threading.Lock()
+        with _file_lock:
+            for entry in self._read():
+                self.entries[(entry['playlist_id'], entry['video_id'])] = entry
+
+    def __len__(self):
+        return len(self.entries)
+
+    def pending(self, playlist_id):
+        '''
+        List the songs waiting to be inserted into a playlist.
+
+        Args:
+        playlist_id (str): The ID of the YouTube playlist
+
+        Returns:
+        list: {'playlist_id', 'song', 'artist', 'video_id', 'deferred_at'} entries, oldest first
+        '''
+        with self._lock:
+            return [entry for (entry_playlist_id, _), entry in self.entries.items() if entry_playlist_id == playlist_id]
+
+    def add(self, playlist_id, song, artist, video_id):
+        '''
+        Defer inserting a resolved song to the next run, durably.
+
+        Args:
+        playlist_id (str): The ID of the YouTube playlist
+        song (str): The name of the song
+        artist (str): The artist of the song
+        video_id (str): The ID of the YouTube video it was resolved to
+
+        Returns:
+        None
+        '''
+        with self._lock:
+            if (playlist_id, video_id) in self._added:
+                return
+            self._added.add((playlist_id, video_id))  # Written again even if loaded, another queue may discard the old line
+            entry = {'playlist_id': playlist_id, 'song': song, 'artist': artist, 'video_id': video_id,
+                     'deferred_at': time.time()}
+            self.entries[(playlist_id, video_id)] = entry
+            with _file_lock:  # Opened per write, another queue may have replaced the file since
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(entry) + '\n')
+                    f.flush()
+                    os.fsync(f.fileno())
+        logging.info(f"Deferred inserting {song} by {artist} ({video_id}) to the next run")
+
+    def discard(self, playlist_id, video_id):
+        '''
+        Drop a song from the queue once it is in the playlist.
+
+        Args:
+        playlist_id (str): The ID of the YouTube playlist
+        video_id (str): The ID of the YouTube video
+
+        Returns:
+        None
+        '''
+        with self._lock:
+            if self.entries.pop((playlist_id, video_id), None) is not None:
+                self._discarded[(playlist_id, video_id)] = time.time()
+                self._added.discard((playlist_id, video_id))
+
+    def close(self):
+        '''
+        Rewrite the journal atomically without the entries this queue discarded, keeping every entry other
+        queues added to the file in the meantime, including songs deferred again after being discarded here.
+        '''
+        with self._lock, _file_lock:
+            if not self._discarded and not self._torn:
+                return
+            entries = {}
+            for entry in self._read():
+                key = (entry['playlist_id'], entry['video_id'])
+                if entry['deferred_at'] > self._discarded.get(key, float('-inf')):
+                    entries[key] = entry
+            with open(self.path + '.tmp', 'w', encoding='utf-8') as f:
+                for entry in entries.values():
+                    f.write(json.dumps(entry) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(self.path + '.tmp', self.path)
+            self._discarded = {}
+            self._torn = False
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return []
+        entries = []
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    self._torn = True  # A torn last line, rewrite the file without it on close
+        return entries
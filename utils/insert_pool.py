@@ -0,0 +1,222 @@
+import threading
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.youtube_utils import add_song_to_playlist
+from utils.quota import QuotaBudget, QuotaExceededError, INSERT_COST
+from utils.retry import RetryPolicy, CircuitOpenError, is_quota_error, is_retryable
+
+
+class TokenBucket:
+    '''
+    Token bucket rate limiter shared by worker threads, or by the tasks of an event loop with acquire_async.
+    Allows bursts of up to capacity requests, then rate requests per second on average.
+    '''
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        '''
+        Block until a token is available, then take it.
+        '''
+        wait = self._take()
+        while wait:
+            time.sleep(wait)
+            wait = self._take()
+
+    async def acquire_async(self):
+        '''
+        Wait until a token is available without blocking the event loop, then take it.
+        '''
+        wait = self._take()
+        while wait:
+            await asyncio.sleep(wait)
+            wait = self._take()
+
+    def _take(self):
+        '''
+        Take a token if one is available.
+
+        Returns:
+        float: 0 if a token was taken, otherwise the seconds until the next one is
+        '''
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+
+class InsertPool:
+    '''
+    Bounded pool of worker threads inserting songs into a YouTube playlist concurrently.
+    Songs are submitted as they are found and inserted in the background, every insert goes through
+    a shared rate limiter and quota budget, and the first quota error stops the whole pool.
+    The quota of an insert is reserved when the song is submitted, so searches made while it waits
+    for a worker can never spend it, and given back if the insert is never sent.
+
+    With preserve_order, each insert waits for the previous submission to finish, so songs land in
+    the playlist in submission order. Retry sleeps still only hold up their own worker.
+
+    Failed inserts are retried by a RetryPolicy shared by the workers, so its circuit breaker trips
+    for all of them at once. Songs that could not be inserted because of the quota, an open breaker
+    or errors still worth retrying go to the deferred queue, if one is given, to be inserted first
+    on the next run.
+    '''
+
+    def __init__(self, youtube, playlist_id, max_workers=4, rate=5.0, burst=5, budget=None,
+                 preserve_order=False, max_retries=3, on_added=None, retry=None, deferred=None):
+        self.youtube = youtube
+        self.playlist_id = playlist_id
+        self.retry = retry if retry is not None else RetryPolicy(max_attempts=max_retries)
+        self.deferred = deferred
+        self.preserve_order = preserve_order
+        self.on_added = on_added
+        self.bucket = TokenBucket(rate, burst)
+        self.budget = budget if budget is not None else QuotaBudget(float('inf'))
+        self.results = []
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._futures = []
+        self._refused = []  # Songs whose insert did not fit in the budget, deferred at submission
+        self._halted = False  # YouTube refused an insert for quota, no more are sent
+        self._turn = 0
+        self._turn_changed = threading.Condition()
+
+    @property
+    def stopped(self):
+        return self._halted or self.budget.exhausted
+
+    def submit(self, song, artist, video_id, reserved=False):
+        '''
+        Queue a song to be inserted, reserving the quota of its insert. A song whose insert does not fit
+        in the budget is put in the deferred queue instead.
+
+        Args:
+        song (str): The name of the song
+        artist (str): The artist of the song
+        video_id (str): The ID of the YouTube video
+        reserved (bool): The caller has reserved the quota of the insert already, it is given back if
+        the song is not queued
+
+        Returns:
+        bool: False if the pool has stopped or the insert does not fit, and the song was not queued
+        '''
+        if self._halted or not (reserved or self.budget.spend(INSERT_COST)):
+            if reserved:
+                self.budget.refund(INSERT_COST)
+            error = QuotaExceededError("Not enough quota left in this run to insert another song")
+            self._refused.append((song, artist, video_id, self._defer(song, artist, video_id, error)))
+            return False
+        self._schedule(len(self._futures), song, artist, video_id)
+        return True
+
+    def _schedule(self, ticket, song, artist, video_id):
+        self._futures.append(self._executor.submit(self._insert, ticket, song, artist, video_id))
+
+    def close(self):
+        '''
+        Wait for every queued insert to finish.
+
+        Returns:
+        list: (song, artist, video_id, status) tuples in submission order, followed by the songs refused at
+        submission, status is 'added', 'failed', 'deferred' for songs put in the deferred queue, or 'skipped'
+        if they could not be deferred
+        '''
+        self._executor.shutdown(wait=True)
+        self.results = [future.result() for future in self._futures] + self._refused
+        return self.results
+
+    def _wait_for_turn(self, ticket):
+        with self._turn_changed:
+            self._turn_changed.wait_for(lambda: self._turn == ticket)
+
+    def _finish_turn(self, ticket):
+        with self._turn_changed:
+            self._turn = ticket + 1
+            self._turn_changed.notify_all()
+
+    def _insert(self, ticket, song, artist, video_id):
+        if self.preserve_order:
+            self._wait_for_turn(ticket)
+        try:
+            return (song, artist, video_id, self._attempt(song, artist, video_id))
+        finally:
+            if self.preserve_order:
+                self._finish_turn(ticket)
+
+    def _attempt(self, song, artist, video_id):
+        reservation = [INSERT_COST]  # Reserved by submit, pays for the first request
+
+        def insert():
+            self._pay(reservation)
+            self.bucket.acquire()
+            return add_song_to_playlist(self.youtube, self.playlist_id, video_id)  # 50 units, on this worker's own connection per request
+
+        try:
+            response = self.retry.run(insert, 'youtube.playlistItems.insert')
+        except Exception as e:
+            return self._failed(song, artist, video_id, e, reservation[0])
+        return self._added(song, artist, video_id, response)
+
+    def _pay(self, reservation):
+        '''
+        Pay for an insert request about to be sent, with the reservation made at submission for the first one.
+
+        Args:
+        reservation (list): The units still reserved for the insert, in a list so it is updated in place
+        '''
+        if self._halted:
+            raise QuotaExceededError("YouTube refused an insert for quota, not sending another")
+        if not reservation[0] and not self.budget.try_spend(INSERT_COST):
+            raise QuotaExceededError("Not enough quota left in this run to retry the insert")
+        reservation[0] = 0
+
+    def _failed(self, song, artist, video_id, error, unspent):
+        '''
+        Handle an insert that failed for good.
+
+        Args:
+        unspent (int): The units reserved for the insert that were never spent
+
+        Returns:
+        str: The status of the song, see close
+        '''
+        if isinstance(error, (QuotaExceededError, CircuitOpenError)):
+            self.budget.refund(unspent)  # Never sent, the units go back to the run
+            return self._defer(song, artist, video_id, error)
+        if is_quota_error(error):
+            logging.error(f"Quota exceeded while adding {song} by {artist}, stopping all inserts.")
+            self._halted = True
+            self.budget.stop()
+            return self._defer(song, artist, video_id, error)
+        if is_retryable(error):  # Out of attempts, but it may well work on the next run
+            return self._defer(song, artist, video_id, error)
+        logging.error(f"Failed to add {song} by {artist} to the playlist: {error}")
+        print(f"Failed to add {song} by {artist} to the playlist. Please try again later.")
+        return 'failed'
+
+    def _added(self, song, artist, video_id, response):
+        logging.info(f"Added {song} by {artist} to the playlist.")
+        print(f"Added {song} by {artist} to the playlist.")
+        if self.deferred is not None:
+            self.deferred.discard(self.playlist_id, video_id)
+        if self.on_added:
+            self.on_added(song, artist, video_id, response)
+        return 'added'
+
+    def _defer(self, song, artist, video_id, error):
+        if self.deferred is None:
+            return 'skipped'
+        logging.info(f"Could not add {song} by {artist} now ({error}), deferring it to the next run.")
+        self.deferred.add(self.playlist_id, song, artist, video_id)
+        return 'deferred'
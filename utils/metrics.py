@@ -0,0 +1,175 @@
+import os
+import json
+import time
+import bisect
+import threading
+import logging
+from contextlib import contextmanager
+
+script_dir = os.path.dirname(__file__)
+if not os.path.exists(os.path.join(script_dir, '../logs')):
+    os.makedirs(os.path.join(script_dir, '../logs'))
+metrics_prom_path = os.path.join(script_dir, '../logs/metrics.prom')
+metrics_json_path = os.path.join(script_dir, '../logs/metrics.json')
+
+# Latency histogram bucket upper bounds, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    '''
+    Counters and latency histograms for API calls, safe to update from worker threads.
+    Metrics are identified by a name and labels, e.g. ('api_call_seconds', {'call': 'search.list'}).
+    '''
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+
+    def increment(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timed(self, call):
+        '''
+        Time a block as one API call, counting it as an error if it raises.
+
+        Args:
+        call (str): The call being timed, e.g. 'youtube.search.list'
+        '''
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            if getattr(getattr(e, 'resp', None), 'status', None) != 304:  # Not Modified is a successful revalidation
+                self.increment('api_errors_total', call=call)
+            raise
+        finally:
+            self.observe('api_call_seconds', time.perf_counter() - started, call=call)
+
+    def to_prometheus(self):
+        '''
+        Render every metric in the Prometheus text exposition format.
+
+        Returns:
+        str: The metrics
+        '''
+        def label_text(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ''
+            return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}'
+
+        lines = []
+        with self._lock:
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f'# TYPE playlist_sync_{name} counter')
+                for (metric, labels), value in sorted(self.counters.items()):
+                    if metric == name:
+                        lines.append(f'playlist_sync_{name}{label_text(labels)} {value}')
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f'# TYPE playlist_sync_{name} histogram')
+                for (metric, labels), histogram in sorted(self.histograms.items()):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(BUCKETS, histogram.counts):
+                        cumulative += count
+                        le = '+Inf' if bound == float('inf') else bound
+                        lines.append(f'playlist_sync_{name}_bucket{label_text(labels, [("le", le)])} {cumulative}')
+                    lines.append(f'playlist_sync_{name}_sum{label_text(labels)} {histogram.total:.6f}')
+                    lines.append(f'playlist_sync_{name}_count{label_text(labels)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def to_dict(self):
+        '''
+        Summarise every metric, with approximate latency percentiles from the histogram buckets.
+
+        Returns:
+        dict: The metrics
+        '''
+        def key_text(name, labels):
+            return name + ''.join(f'[{value}]' for _, value in labels)
+
+        def percentile(histogram, fraction):
+            target = fraction * histogram.count
+            cumulative = 0
+            for bound, count in zip(BUCKETS, histogram.counts):
+                cumulative += count
+                if cumulative >= target:
+                    return bound if bound != float('inf') else None
+            return None
+
+        with self._lock:
+            return {
+                'started_at': self.started_at,
+                'written_at': time.time(),
+                'counters': {key_text(name, labels): value for (name, labels), value in self.counters.items()},
+                'latency': {key_text(name, labels): {
+                    'count': histogram.count,
+                    'mean_seconds': histogram.total / histogram.count if histogram.count else 0,
+                    'p50_seconds': percentile(histogram, 0.5),
+                    'p95_seconds': percentile(histogram, 0.95),
+                    'p99_seconds': percentile(histogram, 0.99),
+                } for (name, labels), histogram in self.histograms.items()},
+            }
+
+    def write(self, prom_path=None, json_path=None):
+        '''
+        Write the metrics to logs/metrics.prom and logs/metrics.json, replacing the files atomically
+        so a scraper or a tail never sees half a file.
+        '''
+        for path, text in ((prom_path or metrics_prom_path, self.to_prometheus()),
+                           (json_path or metrics_json_path, json.dumps(self.to_dict(), indent=4))):
+            with open(path + '.tmp', 'w') as f:
+                f.write(text)
+            os.replace(path + '.tmp', path)
+
+    def start_periodic_flush(self, interval):
+        '''
+        Write the metrics every interval seconds from a background thread, to watch a long sync live.
+
+        Args:
+        interval (float): Seconds between writes
+
+        Returns:
+        Event: Set it to stop flushing
+        '''
+        stop = threading.Event()
+
+        def flush():
+            while not stop.wait(interval):
+                try:
+                    self.write()
+                except OSError as e:
+                    logging.error(f"Could not write metrics: {e}")
+
+        threading.Thread(target=flush, name='metrics-flush', daemon=True).start()
+        return stop
+
+
+metrics = MetricsRegistry()
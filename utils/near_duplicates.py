@@ -0,0 +1,151 @@
+import zlib
+import random
+
+from utils.playlist_utils import normalize_titles
+from utils.search_ranking import VARIANT_WORDS
+
+# Words YouTube uploads add around the song itself, dropped before titles are compared
+NOISE_WORDS = frozenset([
+    'official', 'video', 'audio', 'music', 'lyric', 'lyrics', 'visualizer', 'visualiser', 'mv', 'hd', 'hq', '4k',
+    'remastered', 'remaster', 'topic', 'version', 'explicit', 'clean', 'full', 'song', 'vevo',
+])
+SIMILARITY_THRESHOLD = 0.8  # Jaccard similarity of the remaining words for two titles to be the same song
+NUM_PERM = 32
+PRIME = (1 << 61) - 1
+BANDS = 8  # 8 bands of 4 rows: titles 80% alike are candidates 98% of the time, titles 20% alike almost never
+MAX_BUCKET_SIZE = 200  # Bigger LSH buckets hold very common words, not songs, and would make matching quadratic
+
+
+def title_tokens(processed_title):
+    '''
+    Get the words of a normalized title that identify the song.
+
+    Args:
+    processed_title (str): The title after normalize_title
+
+    Returns:
+    frozenset: The words, without noise words such as "official" or "lyrics"
+    '''
+    return frozenset(word for word in processed_title.split() if word not in NOISE_WORDS)
+
+
+def jaccard(tokens_a, tokens_b):
+    if not tokens_a or not tokens_b:
+        return 0.0
+    return len(tokens_a & tokens_b) / len(tokens_a | tokens_b)
+
+
+def minhash_signature(tokens, permutations, token_hashes):
+    '''
+    Get the MinHash signature of a title's words. Titles sharing more words agree on more of its values.
+
+    Args:
+    tokens (frozenset): The words of the title
+    permutations (list): (a, b) pairs of the hash permutations
+    token_hashes (dict): The permuted hashes of every word seen so far, filled in as words are met
+
+    Returns:
+    tuple: The least permuted hash of the words for each permutation
+    '''
+    columns = []
+    for token in tokens:
+        hashes = token_hashes.get(token)
+        if hashes is None:
+            # crc32 instead of hash(), which is salted per process, so a dry run plans the same clusters as the real run
+            value = zlib.crc32(token.encode('utf-8'))
+            hashes = token_hashes[token] = tuple((a * value + b) % PRIME for a, b in permutations)
+        columns.append(hashes)
+    return tuple(map(min, zip(*columns)))
+
+
+class _DisjointSet:
+    def __init__(self, size):
+        self.parent = list(range(size))
+
+    def find(self, index):
+        while self.parent[index] != index:
+            self.parent[index] = self.parent[self.parent[index]]
+            index = self.parent[index]
+        return index
+
+    def union(self, a, b):
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a != root_b:
+            self.parent[max(root_a, root_b)] = min(root_a, root_b)  # The earliest item stays the root
+
+
+def find_near_duplicates(items, threshold=SIMILARITY_THRESHOLD, seed=0):
+    '''
+    Group playlist items whose titles are the same song, e.g. the official video, the lyric video and
+    the audio upload of one song. Live, acoustic, remix and other versions, see VARIANT_WORDS, are different
+    recordings and are only grouped with titles marked as the same kind of version.
+    Titles with the same words in any order are grouped through a sorted
+    word signature, other near matches are found with MinHash LSH and checked with the Jaccard similarity,
+    so the work grows roughly linearly with the playlist instead of comparing every pair of titles.
+
+    Args:
+    items (list): (playlist_item_id, video_id, title) items or PlaylistItem records in playlist order
+    threshold (float): The least Jaccard similarity of two titles' words to count as the same song
+    seed (int): The seed of the MinHash permutations
+
+    Returns:
+    list: Clusters of more than one video, each {'keep': item, 'delete': [items], 'similarity': float},
+    keeping the title with the fewest version words, then the item added to the playlist first.
+    Items of the same video are left to exact duplicate removal.
+    '''
+    # One entry per video, exact duplicates are not near duplicates
+    first_items = {}
+    titles = {}
+    for item in items:
+        _, video_id, title = item
+        if video_id not in first_items:
+            first_items[video_id] = item
+            titles[video_id] = title
+    videos = list(first_items.values())
+    tokens = [title_tokens(title) for title in normalize_titles(titles.values())]
+    groups = _DisjointSet(len(videos))
+
+    signature_buckets = {}
+    for index, words in enumerate(tokens):
+        if words:
+            groups.union(index, signature_buckets.setdefault(' '.join(sorted(words)), index))
+
+    rng = random.Random(seed)
+    permutations = [(rng.randrange(1, PRIME), rng.randrange(PRIME)) for _ in range(NUM_PERM)]
+    rows = NUM_PERM // BANDS
+    band_buckets = {}
+    token_hashes = {}  # Artists and common words repeat across titles, their hashes are worked out once
+    for index, words in enumerate(tokens):
+        if len(words) < 2:  # One word titles match too much to be grouped on similarity alone
+            continue
+        signature = minhash_signature(words, permutations, token_hashes)
+        for band in range(BANDS):
+            band_buckets.setdefault((band, signature[band * rows:(band + 1) * rows]), []).append(index)
+
+    checked = set()
+    for bucket in band_buckets.values():
+        if len(bucket) < 2 or len(bucket) > MAX_BUCKET_SIZE:
+            continue
+        for position, a in enumerate(bucket):
+            for b in bucket[position + 1:]:
+                if (a, b) in checked:
+                    continue
+                checked.add((a, b))
+                if tokens[a] & VARIANT_WORDS == tokens[b] & VARIANT_WORDS and jaccard(tokens[a], tokens[b]) >= threshold:
+                    groups.union(a, b)
+
+    clusters = {}
+    for index in range(len(videos)):
+        clusters.setdefault(groups.find(index), []).append(index)
+
+    plan = []
+    for members in clusters.values():
+        if len(members) < 2:
+            continue
+        keep = min(members, key=lambda index: (len(tokens[index] & VARIANT_WORDS), index))  # Studio version first
+        plan.append({
+            'keep': videos[keep],
+            'delete': [videos[index] for index in members if index != keep],
+            'similarity': min(jaccard(tokens[keep], tokens[index]) for index in members if index != keep),
+        })
+    return plan
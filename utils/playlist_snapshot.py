@@ -0,0 +1,219 @@
+import os
+import json
+import time
+import threading
+
+from utils.records import PlaylistItem
+
+script_dir = os.path.dirname(__file__)
+snapshot_dir = os.path.join(script_dir, '../data/snapshots')
+if not os.path.exists(snapshot_dir):
+    os.makedirs(snapshot_dir)
+
+SNAPSHOT_MAX_AGE = 10 * 60  # Trust a snapshot without revalidating for 10 minutes, e.g. between menu options
+_lock = threading.Lock()
+
+
+def snapshot_path(playlist_id):
+    return os.path.join(snapshot_dir, f'youtube_{playlist_id}.json')
+
+
+def load_snapshot(playlist_id):
+    '''
+    Load the local snapshot of a YouTube playlist.
+
+    A snapshot looks like {'playlist_id': ..., 'synced_at': ..., 'pages': [...], 'added': [...], 'removed': [...]}
+    where each page is {'page_token', 'etag', 'next_page_token', 'items'} as last returned by the API,
+    items are [playlist_item_id, video_id, title] lists, and 'added'/'removed' patch in our own
+    inserts and deletes made since the pages were last fetched.
+
+    Args:
+    playlist_id (str): The ID of the YouTube playlist
+
+    Returns:
+    dict: The snapshot, or None if there is none
+    '''
+    try:
+        with open(snapshot_path(playlist_id), 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def save_snapshot(snapshot):
+    '''
+    Write a snapshot to disk, replacing the file atomically so a crash never leaves half a snapshot.
+
+    Args:
+    snapshot (dict): The snapshot to save
+
+    Returns:
+    None
+    '''
+    path = snapshot_path(snapshot['playlist_id'])
+    with open(path + '.tmp', 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(path + '.tmp', path)
+
+
+def new_snapshot(playlist_id):
+    return {'playlist_id': playlist_id, 'synced_at': 0, 'pages': [], 'added': [], 'removed': []}
+
+
+def is_fresh(snapshot, max_age=SNAPSHOT_MAX_AGE):
+    return snapshot is not None and time.time() - snapshot['synced_at'] < max_age
+
+
+def snapshot_items(snapshot):
+    '''
+    List the items of a snapshot with our local inserts and deletes applied.
+
+    Args:
+    snapshot (dict): The snapshot
+
+    Returns:
+    list: PlaylistItem records in playlist order
+    '''
+    removed = set(snapshot['removed'])
+    items = [PlaylistItem(*item) for page in snapshot['pages'] for item in page['items'] if item[0] not in removed]
+    items.extend(PlaylistItem(*item) for item in snapshot['added'] if item[0] not in removed)
+    return items
+
+
+def record_inserts(playlist_id, items):
+    '''
+    Patch the snapshot with items we inserted, so the next fetch does not need to go to the API to see them.
+
+    Args:
+    playlist_id (str): The ID of the YouTube playlist
+    items (list): [playlist_item_id, video_id, title] lists
+
+    Returns:
+    None
+    '''
+    if not items:
+        return
+    with _lock:
+        snapshot = load_snapshot(playlist_id)
+        if snapshot is None:  # Nothing to patch, the next fetch builds a full snapshot anyway
+            return
+        snapshot['added'].extend(list(item) for item in items)
+        save_snapshot(snapshot)
+
+
+def record_deletes(playlist_id, playlist_item_ids):
+    '''
+    Patch the snapshot with playlist items we deleted.
+
+    Args:
+    playlist_id (str): The ID of the YouTube playlist
+    playlist_item_ids (list): The IDs of the deleted playlist items
+
+    Returns:
+    None
+    '''
+    if not playlist_item_ids:
+        return
+    with _lock:
+        snapshot = load_snapshot(playlist_id)
+        if snapshot is None:
+            return
+        snapshot['removed'].extend(playlist_item_ids)
+        save_snapshot(snapshot)
+
+
+def sync_state_path(spotify_playlist_id, youtube_playlist_id):
+    return os.path.join(snapshot_dir, f'spotify_{spotify_playlist_id}_youtube_{youtube_playlist_id}.json')
+
+
+def load_sync_state(spotify_playlist_id, youtube_playlist_id):
+    '''
+    Load what the last complete sync of a Spotify playlist into a YouTube playlist saw.
+
+    Args:
+    spotify_playlist_id (str): The ID of the Spotify playlist
+    youtube_playlist_id (str): The ID of the YouTube playlist
+
+    Returns:
+    dict: {'snapshot_id': ..., 'track_keys': [...], 'pending': [...]}, or None if the pair was never fully synced
+    '''
+    try:
+        with open(sync_state_path(spotify_playlist_id, youtube_playlist_id), 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def save_sync_state(spotify_playlist_id, youtube_playlist_id, snapshot_id, track_keys, pending=()):
+    '''
+    Record the Spotify snapshot and tracks a sync has fully processed.
+    Tracks no video was found for, or whose insert failed, are pending instead, they are tried again on the
+    next sync even if the snapshot has not changed.
+
+    Args:
+    spotify_playlist_id (str): The ID of the Spotify playlist
+    youtube_playlist_id (str): The ID of the YouTube playlist
+    snapshot_id (str): The Spotify snapshot_id of the playlist
+    track_keys (list): The keys of every track in the playlist that was handled
+    pending (list): The keys of the tracks left to try again
+
+    Returns:
+    None
+    '''
+    path = sync_state_path(spotify_playlist_id, youtube_playlist_id)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'snapshot_id': snapshot_id, 'track_keys': list(track_keys), 'pending': list(pending),
+                   'synced_at': time.time()}, f)
+    os.replace(path + '.tmp', path)
+
+
+def checkpoint_path(spotify_playlist_id, youtube_playlist_id):
+    return os.path.join(snapshot_dir, f'checkpoint_spotify_{spotify_playlist_id}_youtube_{youtube_playlist_id}.json')
+
+
+def load_checkpoint(spotify_playlist_id, youtube_playlist_id):
+    '''
+    Load where an interrupted sync of a Spotify playlist into a YouTube playlist stopped.
+    Songs it had found but not inserted are kept in the deferred insert queue, not here.
+
+    Args:
+    spotify_playlist_id (str): The ID of the Spotify playlist
+    youtube_playlist_id (str): The ID of the YouTube playlist
+
+    Returns:
+    dict: {'snapshot_id': ..., 'position': ..., 'track_keys': [...], 'pending': [...]}, or None if the last sync finished
+    '''
+    try:
+        with open(checkpoint_path(spotify_playlist_id, youtube_playlist_id), 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def save_checkpoint(spotify_playlist_id, youtube_playlist_id, snapshot_id, position, track_keys, pending=()):
+    '''
+    Record where a sync stopped, so the next run resumes from there instead of from the first track.
+
+    Args:
+    spotify_playlist_id (str): The ID of the Spotify playlist
+    youtube_playlist_id (str): The ID of the YouTube playlist
+    snapshot_id (str): The Spotify snapshot_id the position applies to
+    position (int): The index in the Spotify playlist of the first track not handled yet
+    track_keys (list): The keys of the tracks before position, None for unavailable tracks
+    pending (list): The keys of the tracks before position left to try again, see save_sync_state
+
+    Returns:
+    None
+    '''
+    path = checkpoint_path(spotify_playlist_id, youtube_playlist_id)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'snapshot_id': snapshot_id, 'position': position, 'track_keys': list(track_keys),
+                   'pending': list(pending), 'saved_at': time.time()}, f)
+    os.replace(path + '.tmp', path)
+
+
+def clear_checkpoint(spotify_playlist_id, youtube_playlist_id):
+    try:
+        os.remove(checkpoint_path(spotify_playlist_id, youtube_playlist_id))
+    except FileNotFoundError:
+        pass
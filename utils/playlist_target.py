@@ -0,0 +1,207 @@
+import logging
+
+from utils.playlist_utils import normalize_title, normalize_titles, TitleIndex
+from utils.youtube_utils import cached_search_song, fetch_yt_playlist_contents
+from utils.insert_pool import InsertPool
+from utils.song_ledger import SongLedger, ledger_path
+from utils.retry import CircuitOpenError, is_quota_error, is_retryable
+from utils.quota import INSERT_COST
+from utils.playlist_snapshot import record_inserts
+
+QUOTA_STOPPED_MESSAGE = "Quota exceeded, no more songs will be added. Please try again at 8AM GMT tomorrow."
+
+
+class SyncStopped(Exception):
+    '''
+    Raised when a run cannot search for any more songs, because the quota is used up or YouTube keeps failing.
+    The message is the one shown to the user.
+    '''
+
+
+class SearchFailed(Exception):
+    '''
+    Raised when a song could not be searched for after every retry. The run carries on without it,
+    and the song is searched for again on the next run.
+    '''
+
+
+def resolve_song(youtube, song, artist, cache, budget, retry, duration_ms=None, inserts=1):
+    '''
+    Get the YouTube video ID of a song through the search cache, costs 100 units on a cache miss
+    Failed searches are retried by the RetryPolicy the inserts use, so a failing API stops searches and inserts alike
+
+    Args:
+    youtube (Resource): The authenticated YouTube API client
+    song (str): The name of the song
+    artist (str): The artist of the song
+    cache (SearchCache): The search result cache
+    budget (QuotaBudget): The quota budget of the run
+    retry (RetryPolicy): The retry policy shared with the inserts
+    duration_ms (int): The length of the Spotify track, if known
+    inserts (int): The number of playlists the song is inserted into, see cached_search_song
+
+    Returns:
+    str: The video ID, or None if no video was found
+    '''
+    try:
+        return retry.run(lambda: cached_search_song(youtube, song, artist, cache, budget, duration_ms, inserts),
+                         'youtube.search.list')
+    except Exception as e:
+        error = search_error(song, artist, e)
+        if error is None:
+            raise
+        raise error from e
+
+
+def search_error(song, artist, error):
+    '''
+    Work out what a search that failed after every retry means for the run, shared with the async engine.
+
+    Args:
+    song (str): The name of the song
+    artist (str): The artist of the song
+    error (Exception): The error the search failed with
+
+    Returns:
+    Exception: SyncStopped or SearchFailed to raise instead, or None to raise the error itself
+    '''
+    if isinstance(error, CircuitOpenError):
+        return SyncStopped("YouTube keeps failing, no more songs will be added. Please try again later.")
+    if is_retryable(error):  # Out of attempts, leave this song for the next run
+        logging.error(f"Failed to search for {song} by {artist}: {error}")
+        return SearchFailed(str(error))
+    if is_quota_error(error):
+        return SyncStopped("Today's quota is used up, no more songs will be added. "
+                           "Please try again at 8AM GMT tomorrow.")
+    return None
+
+
+class PlaylistTarget:
+    '''
+    A YouTube playlist songs are added to during a run, shared by every way of syncing into one.
+    Knows the videos and titles already in the playlist and the songs added to it on earlier runs,
+    and inserts the songs submitted to it concurrently in an InsertPool. Songs inserted are recorded
+    in the playlist's song ledger straight away, and in its local snapshot once it is closed.
+
+    Songs found on an earlier run but not inserted are submitted first from the deferred queue,
+    and songs that cannot be inserted now go back to it. A cap limits the songs submitted.
+
+    The async engine passes in the playlist contents it fetched itself and its own pool class,
+    and closes the target with aclose.
+    '''
+
+    def __init__(self, youtube, playlist_id, budget, retry, deferred, cap=None, max_workers=4, preserve_order=False,
+                 existing_video_ids=None, pool_class=InsertPool):
+        if existing_video_ids is None:
+            existing_video_ids = fetch_yt_playlist_contents(youtube, playlist_id)[0]  # 1 unit per 50 videos
+        self.playlist_id = playlist_id
+        self.budget = budget
+        self.title_index = TitleIndex(normalize_titles(existing_video_ids))
+        self.video_ids = set(existing_video_ids.values())
+        self.cap = cap
+        self.submitted = 0
+        self.drained = set()  # Songs of the deferred queue, resolved on an earlier run
+        self.inserted_items = []
+        self.deferred = deferred
+        self.ledger = SongLedger(ledger_path(playlist_id))  # Every add is written to disk immediately
+        self.pool = pool_class(youtube, playlist_id, max_workers=max_workers, budget=budget,
+                               preserve_order=preserve_order, on_added=self._on_added, retry=retry, deferred=deferred)
+
+    @property
+    def full(self):
+        return self.submitted == self.cap
+
+    @property
+    def stopped(self):
+        return self.pool.stopped
+
+    def has_song(self, song, artist):
+        '''
+        Check if a song was added on an earlier run or is waiting in the deferred queue, either way it needs no search.
+
+        Returns:
+        bool: True if the song is handled already
+        '''
+        return (song, artist) in self.ledger or (song, artist) in self.drained
+
+    def has_title(self, song):
+        return self.title_index.contains_song(normalize_title(song))
+
+    def drain_deferred(self):
+        '''
+        Submit the songs of the deferred queue first, they are resolved already so no search is needed.
+        Songs that are in the playlist by now are dropped from the queue.
+
+        Returns:
+        bool: False if the cap or the quota stopped it before the queue was empty
+        '''
+        for entry in self.deferred.pending(self.playlist_id):
+            song, artist, video_id = entry['song'], entry['artist'], entry['video_id']
+            self.drained.add((song, artist))
+            if (song, artist) in self.ledger or video_id in self.video_ids:
+                self.deferred.discard(self.playlist_id, video_id)
+                continue
+            if self.full or not self.submit(song, artist, video_id):
+                return False
+        if self.drained:
+            logging.info(f"Drained {len(self.drained)} deferred inserts for playlist {self.playlist_id}")
+        return True
+
+    def submit(self, song, artist, video_id, reserved=False):
+        '''
+        Queue a resolved song to be inserted, unless its video is in the playlist already.
+
+        Args:
+        song (str): The name of the song
+        artist (str): The artist of the song
+        video_id (str): The ID of the YouTube video
+        reserved (bool): The quota of the insert was reserved while the song was searched for,
+        it is given back if the song is not queued
+
+        Returns:
+        bool: True if the song was queued, False if the video is in the playlist, or the pool has stopped
+        or cannot fit the insert, in which case the song is in the deferred queue
+        '''
+        if video_id in self.video_ids:
+            logging.info(f"{song} by {artist} resolved to {video_id}, which is already in the playlist.")
+            if reserved:
+                self.budget.refund(INSERT_COST)
+            return False
+        if not self.pool.submit(song, artist, video_id, reserved):
+            return False
+        self.video_ids.add(video_id)
+        self.submitted += 1
+        return True
+
+    def close(self):
+        '''
+        Wait for every queued insert to finish, then close the ledger and update the local snapshot.
+        Called even if a search fails part way, so what was added is kept.
+
+        Returns:
+        list: (song, artist, video_id, status) tuples in submission order, see InsertPool.close
+        '''
+        try:
+            return self.pool.close()
+        finally:
+            self.finish()
+
+    async def aclose(self):
+        '''
+        Close a target whose pool inserts on the event loop, see close.
+
+        Returns:
+        list: (song, artist, video_id, status) tuples in submission order
+        '''
+        try:
+            return await self.pool.aclose()
+        finally:
+            self.finish()
+
+    def finish(self):
+        self.ledger.close()
+        record_inserts(self.playlist_id, self.inserted_items)  # Keeps the local snapshot current without a refetch
+
+    def _on_added(self, song, artist, video_id, response):
+        self.ledger.add(song, artist)
+        self.inserted_items.append([response['id'], video_id, response['snippet']['title']])
@@ -1,5 +1,6 @@
 import os
 import re
+import functools
 
 script_dir = os.path.dirname(__file__)
 if not os.path.exists(os.path.join(script_dir, '../data')):
@@ -7,9 +8,21 @@ if not os.path.exists(os.path.join(script_dir, '../data')):
 full_file_path = os.path.join(script_dir, '../data/playlist_ids.txt')
 
 
+# The lookahead lets the regex skip positions that cannot start a keyword without trying every alternative
+keywords_pattern = re.compile(r"(?=[\sfw])\s*(feat\.?|fts\.?|ft\.?|featuring|with)\s*", flags=re.IGNORECASE)
+punctuation_table = str.maketrans("", "", ".,$&!?’|@:-_/()'[]{}\"")  # Space removed
+BATCH_SEPARATOR = "\x00"  # Not whitespace, punctuation or a letter, so no keyword can match across it
+
+
+@functools.lru_cache(maxsize=65536)
+def _normalize(title):
+    return keywords_pattern.sub("", title).translate(punctuation_table).lower()
+
+
 def normalize_title(title):
     '''
     Normalizes the title by removing keywords and punctuation, then returning the title in lowercase.
+    Results are memoized, titles are normalized again and again across song_adder and the tester.
 
     Args:
     title (str): The title to be normalized
@@ -17,13 +30,82 @@ def normalize_title(title):
     Returns:
     str: The normalized title
     '''
-    keywords_pattern = r"\s*(feat\.?|fts\.?|ft\.?|featuring|with)\s*"
-    punctuation_pattern = r"[.,$&!?’|@:\-_/()'\[\]{}\"]"  # Space removed
+    return _normalize(str(title))
+
+
+def normalize_titles(titles):
+    '''
+    Normalizes many titles at once with a single regex pass over all of them joined together,
+    which avoids the per call overhead of normalize_title when there are thousands of titles.
+
+    Args:
+    titles (iterable): The titles to be normalized
+
+    Returns:
+    list: The normalized titles, in the same order
+    '''
+    titles = [str(title) for title in titles]
+    if not titles:
+        return []
+    joined = BATCH_SEPARATOR.join(titles)
+    if joined.count(BATCH_SEPARATOR) != len(titles) - 1:  # A title contains the separator itself
+        return [normalize_title(title) for title in titles]
+    return keywords_pattern.sub("", joined).translate(punctuation_table).lower().split(BATCH_SEPARATOR)
 
-    step1 = re.sub(keywords_pattern, "", str(title), flags=re.IGNORECASE)
-    step2 = re.sub(punctuation_pattern, "", step1, flags=re.IGNORECASE)
 
-    return step2.lower()
+class TitleIndex:
+    '''
+    Index over normalized YouTube titles answering "is this word a substring of any title"
+    in constant time, instead of scanning every title for every word.
+
+    Song words never contain spaces, so a word can only appear inside a single space separated
+    token of a title. Every substring of every distinct token is stored in a set, tokens longer
+    than MAX_TOKEN_LENGTH are kept aside and scanned, which keeps the set small for odd titles.
+    '''
+    MAX_TOKEN_LENGTH = 40
+
+    def __init__(self, processed_titles):
+        self.substrings = set()
+        self.long_tokens = set()
+        seen_tokens = set()
+        for title in processed_titles:
+            self.substrings.add("")  # The empty word is in every title
+            for token in title.split(" "):
+                if token in seen_tokens:
+                    continue
+                seen_tokens.add(token)
+                if len(token) > self.MAX_TOKEN_LENGTH:
+                    self.long_tokens.add(token)
+                    continue
+                for start in range(len(token)):
+                    for end in range(start + 1, len(token) + 1):
+                        self.substrings.add(token[start:end])
+
+    def contains_word(self, word):
+        '''
+        Check if a word appears in any of the indexed titles.
+
+        Args:
+        word (str): A single normalized word, without spaces
+
+        Returns:
+        bool: True if the word is a substring of at least one title
+        '''
+        if word in self.substrings:
+            return True
+        return any(word in token for token in self.long_tokens)
+
+    def contains_song(self, processed_song):
+        '''
+        Check if every word of a normalized song title appears in the indexed titles.
+
+        Args:
+        processed_song (str): The normalized song title
+
+        Returns:
+        bool: True if all words of the song are found
+        '''
+        return all(self.contains_word(word) for word in processed_song.split(" "))
 
 
 def get_playlist_url(service_name):
@@ -31,8 +113,6 @@ def get_playlist_url(service_name):
         url = input(f"Enter {service_name} playlist URL: ")
         playlist_id = extract_playlist_id(url)
         if playlist_id is not None:
-            global songs_list_wipe
-            songs_list_wipe = True
             print(f"Successfully extracted {playlist_id} for {service_name} \n")
             return playlist_id
 
@@ -72,8 +152,6 @@ def update_playlist_ids():
     Returns:
     None
     '''
-    global songs_list_wipe
-    songs_list_wipe = False
     response = '0'
     try:
         with open(full_file_path, 'r') as f:
@@ -111,11 +189,5 @@ def update_playlist_ids():
     with open(full_file_path, 'w') as f:
         f.write(spotify_id + '\n')
         f.write(youtube_id + '\n')
-    
-    if songs_list_wipe:
-        try:
-            os.remove(os.path.join(script_dir, 'songs_added_list.json'))
-        except FileNotFoundError:
-            pass
 
     return spotify_id, youtube_id
\ No newline at end of file
@@ -0,0 +1,191 @@
+import os
+import json
+import threading
+import logging
+from datetime import datetime, timedelta, timezone
+from dotenv import load_dotenv
+
+try:
+    from zoneinfo import ZoneInfo
+    pacific = ZoneInfo('America/Los_Angeles')
+except Exception:  # No zoneinfo or no tz database, Pacific standard time is close enough
+    pacific = timezone(timedelta(hours=-8))
+
+script_dir = os.path.dirname(__file__)
+if not os.path.exists(os.path.join(script_dir, '../data')):
+    os.makedirs(os.path.join(script_dir, '../data'))
+quota_ledger_path = os.path.join(script_dir, '../data/quota_ledger.json')
+
+load_dotenv(os.path.join(script_dir, '../.env'))
+DAILY_QUOTA = int(os.getenv('YOUTUBE_DAILY_QUOTA', 10000))
+
+# Units charged by the YouTube Data API per request
+UNIT_COSTS = {
+    'search.list': 100,
+    'playlistItems.list': 1,
+    'playlistItems.insert': 50,
+    'playlistItems.delete': 50,
+    'videos.list': 1,
+}
+SEARCH_COST = UNIT_COSTS['search.list']
+INSERT_COST = UNIT_COSTS['playlistItems.insert']
+DAYS_KEPT = 30
+
+
+class QuotaExceededError(Exception):
+    '''
+    Raised when the daily YouTube quota, or the budget given to a run, is used up.
+    '''
+
+
+def quota_day():
+    '''
+    The YouTube quota resets at midnight Pacific time, so days are counted in Pacific time.
+
+    Returns:
+    str: The current quota day, e.g. '2024-05-01'
+    '''
+    return datetime.now(pacific).date().isoformat()
+
+
+class QuotaLedger:
+    '''
+    Persistent count of the units spent on each YouTube API method per quota day.
+    Safe to share between threads.
+    '''
+
+    def __init__(self, path=quota_ledger_path, daily_quota=DAILY_QUOTA):
+        self.path = path
+        self.daily_quota = daily_quota
+        self._lock = threading.Lock()
+        try:
+            with open(self.path, 'r') as f:
+                self.days = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.days = {}
+
+    def charge(self, method, count=1):
+        '''
+        Record requests made to the API.
+
+        Args:
+        method (str): The API method, e.g. 'search.list'
+        count (int): The number of requests
+
+        Returns:
+        int: The units charged
+        '''
+        units = UNIT_COSTS[method] * count
+        with self._lock:
+            day = self.days.setdefault(quota_day(), {})
+            day[method] = day.get(method, 0) + units
+            self._save()
+        return units
+
+    def mark_exhausted(self):
+        '''
+        Record that the API refused a request for quota, whatever our own count says.
+        '''
+        with self._lock:
+            day = self.days.setdefault(quota_day(), {})
+            day['exhausted'] = self.daily_quota
+            self._save()
+        logging.error("YouTube quota exhausted for today")
+
+    def spent_today(self):
+        with self._lock:
+            day = self.days.get(quota_day(), {})
+            return max(sum(units for method, units in day.items() if method != 'exhausted'), day.get('exhausted', 0))
+
+    def remaining(self):
+        return max(self.daily_quota - self.spent_today(), 0)
+
+    def _save(self):
+        for day in sorted(self.days)[:-DAYS_KEPT]:
+            del self.days[day]
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.days, f, indent=4)
+        os.replace(self.path + '.tmp', self.path)
+
+
+class QuotaBudget:
+    '''
+    Quota units a run is allowed to spend, shared by worker threads.
+    Once a spend is refused, or stop() is called, the budget stays exhausted so every worker winds down.
+    '''
+
+    def __init__(self, units):
+        self.remaining = units
+        self.spent = 0
+        self.exhausted = False
+        self._lock = threading.Lock()
+
+    def spend(self, units, keep=0):
+        '''
+        Reserve units for a request.
+
+        Args:
+        units (int): The cost of the request
+        keep (int): Units that must still be left afterwards, e.g. to insert the song a search finds
+
+        Returns:
+        bool: True if the units were reserved, False if the budget is exhausted
+        '''
+        if self.try_spend(units, keep):
+            return True
+        self.stop()
+        return False
+
+    def try_spend(self, units, keep=0):
+        '''
+        Reserve units for an optional request, e.g. the durations of a search's results,
+        leaving the budget usable for the requests that matter if they are not there.
+
+        Args:
+        units (int): The cost of the request
+        keep (int): Units that must still be left afterwards
+
+        Returns:
+        bool: True if the units were reserved
+        '''
+        with self._lock:
+            if self.exhausted or units + keep > self.remaining:
+                return False
+            self.remaining -= units
+            self.spent += units
+            return True
+
+    def refund(self, units):
+        '''
+        Give back units reserved for a request that was never sent, e.g. an insert deferred to the next run.
+
+        Args:
+        units (int): The units to give back
+
+        Returns:
+        None
+        '''
+        with self._lock:
+            self.remaining += units
+            self.spent -= units
+
+    def stop(self):
+        with self._lock:
+            self.exhausted = True
+
+
+def plan_song_count(remaining_units):
+    '''
+    Estimate how many songs fit in the remaining quota, assuming each one needs a search and an insert.
+    Songs found in the search cache only need the insert, so the real number is usually higher.
+
+    Args:
+    remaining_units (int): The quota units left today
+
+    Returns:
+    int: The number of songs
+    '''
+    return remaining_units // (SEARCH_COST + INSERT_COST)
+
+
+quota_ledger = QuotaLedger()
@@ -0,0 +1,235 @@
+import time
+import random
+import asyncio
+import logging
+import threading
+from email.utils import parsedate_to_datetime
+
+from utils.quota import QuotaExceededError
+from utils.metrics import metrics
+
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+# 403 reasons that mean "slow down" rather than "not allowed", unlike quotaExceeded or forbidden
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+# Libraries whose exceptions without a status are connection problems worth retrying
+NETWORK_ERROR_MODULES = ('httplib2', 'requests', 'urllib3', 'ssl', 'socket', 'aiohttp')
+
+
+class CircuitOpenError(Exception):
+    '''
+    Raised instead of calling an API that has failed too often in a row, until the breaker's reset timeout passes.
+    '''
+
+
+def error_status(error):
+    '''
+    Get the HTTP status of an API error, from googleapiclient's HttpError or an error with a status attribute
+    such as SpotifyApiError.
+
+    Returns:
+    int: The status, or None for errors without one such as dropped connections
+    '''
+    status = getattr(getattr(error, 'resp', None), 'status', None) or getattr(error, 'status', None)
+    try:
+        return int(status)
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_after(error):
+    '''
+    Get the Retry-After delay an API error asked for, given either in seconds or as an HTTP date.
+
+    Returns:
+    float: The delay in seconds, or None if the error did not ask for one
+    '''
+    headers = getattr(error, 'resp', None) or getattr(error, 'headers', None)
+    if not hasattr(headers, 'get'):
+        return None
+    value = headers.get('retry-after') or headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def is_quota_error(error):
+    return isinstance(error, QuotaExceededError) or 'quota' in str(error)
+
+
+def is_retryable(error):
+    '''
+    Work out if a failed call is worth repeating: 5xx, 408 and 429 responses, 403 rate limits and network
+    errors are, quota errors and other 4xx responses would only fail the same way again.
+
+    Returns:
+    bool: True if the call should be retried
+    '''
+    if is_quota_error(error):
+        return False
+    status = error_status(error)
+    if status is None:
+        return isinstance(error, OSError) or type(error).__module__.split('.')[0] in NETWORK_ERROR_MODULES
+    if status == 403:
+        return any(reason in str(error) for reason in RATE_LIMIT_REASONS)
+    return status in RETRYABLE_STATUSES
+
+
+class CircuitBreaker:
+    '''
+    Stops calling an API after failure_threshold retryable failures in a row. Once reset_timeout seconds
+    have passed one trial call is let through, closing the breaker again if it succeeds.
+    Safe to share between worker threads.
+    '''
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        '''
+        Check if a call may go ahead.
+
+        Returns:
+        bool: False while the breaker is open
+        '''
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self._trial_running or time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self._trial_running = True  # Half open, only this call tests the API
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logging.error(f"{self.failures} failures in a row, pausing calls for {self.reset_timeout} seconds")
+                self.opened_at = time.monotonic()
+
+
+class RetryPolicy:
+    '''
+    Retries failed API calls with exponential backoff and full jitter, waiting as long as a
+    Retry-After header asks instead when there is one. Errors that are not retryable are raised
+    straight away, and a shared CircuitBreaker stops every caller once the API keeps failing.
+    run_async does the same for coroutines, so the async engine's calls share the breaker with the threads'.
+    '''
+
+    def __init__(self, max_attempts=5, base_delay=1.0, max_delay=60.0, breaker=None, sleep=time.sleep):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.sleep = sleep
+
+    def delay(self, attempt, error=None):
+        '''
+        Get how long to wait before retrying after a failed attempt.
+
+        Args:
+        attempt (int): The number of the attempt that failed, from 0
+        error (Exception): The error it failed with
+
+        Returns:
+        float: The delay in seconds
+        '''
+        requested = retry_after(error) if error is not None else None
+        if requested is not None:
+            return min(requested, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def run(self, function, call):
+        '''
+        Call function until it succeeds, raising its last error once it fails in a way not worth
+        retrying or runs out of attempts.
+
+        Args:
+        function (function): The call to make, without arguments
+        call (str): The name of the call, for logs and metrics, e.g. 'youtube.playlistItems.insert'
+
+        Returns:
+        The return value of function
+        '''
+        for attempt in range(self.max_attempts):
+            self._check_breaker(call)
+            try:
+                result = function()
+            except Exception as e:
+                wait = self._backoff(attempt, e, call)
+                if wait is None:
+                    raise
+                self.sleep(wait)
+                continue
+            self.breaker.record_success()
+            return result
+
+    async def run_async(self, function, call):
+        '''
+        Await function until it succeeds, like run, sleeping between attempts without blocking the event loop.
+
+        Args:
+        function (function): Makes the coroutine of the call, without arguments, called again for every attempt
+        call (str): The name of the call, for logs and metrics
+
+        Returns:
+        The result of the coroutine
+        '''
+        for attempt in range(self.max_attempts):
+            self._check_breaker(call)
+            try:
+                result = await function()
+            except Exception as e:
+                wait = self._backoff(attempt, e, call)
+                if wait is None:
+                    raise
+                await asyncio.sleep(wait)
+                continue
+            self.breaker.record_success()
+            return result
+
+    def _check_breaker(self, call):
+        if not self.breaker.allow():
+            raise CircuitOpenError(f"Not calling {call}, it failed too often in a row")
+
+    def _backoff(self, attempt, error, call):
+        '''
+        Record a failed attempt and work out how long to wait before the next one.
+
+        Returns:
+        float: The delay in seconds, or None if the error should be raised
+        '''
+        if not is_retryable(error):
+            self.breaker.record_success()  # The API is up, it is this request that cannot succeed
+            return None
+        self.breaker.record_failure()
+        if attempt == self.max_attempts - 1:
+            return None
+        wait = self.delay(attempt, error)
+        logging.warning(f"{call} failed on attempt {attempt + 1} of {self.max_attempts}, "
+                        f"retrying in {wait:.1f} seconds: {error}")
+        metrics.increment('retries_total', call=call)
+        return wait
@@ -0,0 +1,158 @@
+import os
+import sqlite3
+import threading
+import time
+import logging
+
+from utils.playlist_utils import punctuation_table
+
+script_dir = os.path.dirname(__file__)
+if not os.path.exists(os.path.join(script_dir, '../data')):
+    os.makedirs(os.path.join(script_dir, '../data'))
+cache_path = os.path.join(script_dir, '../data/search_cache.sqlite3')
+
+HIT_TTL = 60 * 60 * 24 * 90  # Found videos rarely disappear, keep them for 90 days
+MISS_TTL = 60 * 60 * 24 * 7  # Retry songs with no result after a week, they may have been uploaded since
+MAX_ENTRIES = 50000
+
+
+def make_search_key(song_name, artist):
+    '''
+    Builds the cache key for a song and artist pair, so that small differences in
+    punctuation and casing between runs still hit the same entry.
+    Words are kept whole, unlike normalize_title, which also strips "ft" or "with" from inside
+    words and would give different songs the same key, e.g. "Daft Punk" becomes "dapunk".
+
+    Args:
+    song_name (str): The name of the song
+    artist (str): The artist of the song
+
+    Returns:
+    str: The normalized key
+    '''
+    song_key = " ".join(str(song_name).translate(punctuation_table).casefold().split())
+    artist_key = " ".join(str(artist).translate(punctuation_table).casefold().split())
+    return f"{song_key}\x1f{artist_key}"
+
+
+class SearchCache:
+    '''
+    On-disk cache of search_song results, so a song is only searched once (100 units) per TTL.
+    Other songs by the same artist found by a search are stored too, so they need no search of their own.
+    Stores the resolved video ID, or None for searches that found nothing.
+    Least recently used entries are evicted once the cache grows past max_entries.
+    '''
+
+    def __init__(self, path=None, hit_ttl=HIT_TTL, miss_ttl=MISS_TTL, max_entries=MAX_ENTRIES):
+        self.path = path or cache_path
+        self.hit_ttl = hit_ttl
+        self.miss_ttl = miss_ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS search_results ("
+            "key TEXT PRIMARY KEY, "
+            "video_id TEXT, "  # NULL stores a negative result
+            "created_at REAL NOT NULL, "
+            "ttl REAL NOT NULL, "
+            "last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_used ON search_results (last_used)")
+        self._conn.commit()
+
+    def get(self, song_name, artist):
+        '''
+        Look up a song in the cache.
+
+        Args:
+        song_name (str): The name of the song
+        artist (str): The artist of the song
+
+        Returns:
+        tuple: (found, video_id), found is False on a miss or an expired entry,
+        video_id is None for a cached negative result
+        '''
+        key = make_search_key(song_name, artist)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT video_id, created_at, ttl FROM search_results WHERE key = ?", (key,)
+            ).fetchone()
+
+            if row is None or row[1] + row[2] < now:
+                if row is not None:
+                    self._conn.execute("DELETE FROM search_results WHERE key = ?", (key,))
+                    self._conn.commit()
+                self.misses += 1
+                logging.info(f"Search cache miss for {song_name} by {artist}")
+                return False, None
+
+            self._conn.execute("UPDATE search_results SET last_used = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+            logging.info(f"Search cache hit for {song_name} by {artist}: {row[0]}")
+            return True, row[0]
+
+    def put(self, song_name, artist, video_id, replace=True):
+        '''
+        Store the result of a search, video_id may be None to remember that nothing was found.
+
+        Args:
+        song_name (str): The name of the song
+        artist (str): The artist of the song
+        video_id (str): The YouTube video ID, or None
+        replace (bool): False keeps an entry that is still valid, for songs picked up from another song's search
+
+        Returns:
+        None
+        '''
+        key = make_search_key(song_name, artist)
+        now = time.time()
+        ttl = self.hit_ttl if video_id else self.miss_ttl
+        with self._lock:
+            if replace:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO search_results (key, video_id, created_at, ttl, last_used) "
+                    "VALUES (?, ?, ?, ?, ?)", (key, video_id, now, ttl, now)
+                )
+            else:
+                self._conn.execute(
+                    "INSERT INTO search_results (key, video_id, created_at, ttl, last_used) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT (key) DO UPDATE SET video_id = excluded.video_id, created_at = excluded.created_at, "
+                    "ttl = excluded.ttl, last_used = excluded.last_used "
+                    "WHERE search_results.created_at + search_results.ttl < excluded.created_at",
+                    (key, video_id, now, ttl, now)
+                )
+            self._conn.commit()
+        self.evict()
+
+    def evict(self):
+        '''
+        Drop expired entries, then the least recently used ones until the cache fits in max_entries.
+
+        Returns:
+        int: The number of entries removed
+        '''
+        with self._lock:
+            removed = self._conn.execute(
+                "DELETE FROM search_results WHERE created_at + ttl < ?", (time.time(),)
+            ).rowcount
+            count = self._conn.execute("SELECT COUNT(*) FROM search_results").fetchone()[0]
+            if count > self.max_entries:
+                removed += self._conn.execute(
+                    "DELETE FROM search_results WHERE key IN "
+                    "(SELECT key FROM search_results ORDER BY last_used ASC LIMIT ?)",
+                    (count - self.max_entries,)
+                ).rowcount
+            self._conn.commit()
+
+        if removed:
+            logging.info(f"Evicted {removed} entries from the search cache")
+        return removed
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
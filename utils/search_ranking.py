@@ -0,0 +1,146 @@
+import re
+
+from utils.playlist_utils import normalize_title
+
+SEARCH_RESULTS = 10  # A search costs 100 units however many results it returns
+# Words marking another recording of the song, penalised unless the Spotify title has them too
+VARIANT_WORDS = frozenset([
+    'live', 'cover', 'karaoke', 'instrumental', 'remix', 'acoustic', 'reaction', 'nightcore', 'sped', 'slowed',
+    'reverb', 'tutorial', 'lesson', '8d', 'piano', 'guitar', 'concert', 'session', 'demo', 'mashup', 'parody',
+])
+TOPIC_SUFFIX = ' - Topic'  # YouTube Music's auto generated artist channels, which upload the studio recordings
+DURATION_TOLERANCE = 3  # Seconds a video may differ from the Spotify track and still be the same recording
+duration_pattern = re.compile(r"P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?$")
+bracket_pattern = re.compile(r"\s*[\(\[].*?[\)\]]")
+
+
+def parse_duration(duration):
+    '''
+    Parse an ISO 8601 duration from videos.list, e.g. 'PT3M25S'.
+
+    Args:
+    duration (str): The duration
+
+    Returns:
+    int: The duration in seconds, or None if it cannot be parsed
+    '''
+    match = duration_pattern.match(duration or '')
+    if match is None:
+        return None
+    days, hours, minutes, seconds = (int(part or 0) for part in match.groups())
+    return ((days * 24 + hours) * 60 + minutes) * 60 + seconds
+
+
+def make_candidate(item, rank):
+    '''
+    Make a candidate from a search.list result.
+
+    Args:
+    item (dict): The result, with id/videoId, snippet/title and snippet/channelTitle
+    rank (int): Its position in YouTube's own ranking
+
+    Returns:
+    dict: {'video_id', 'title', 'channel', 'rank', 'duration'}, duration in seconds is filled in later if known
+    '''
+    snippet = item.get('snippet', {})
+    return {'video_id': item['id']['videoId'], 'title': snippet.get('title', ''),
+            'channel': snippet.get('channelTitle', ''), 'rank': rank, 'duration': None}
+
+
+def _words(text):
+    return set(normalize_title(text).split())
+
+
+def _fraction_found(words, found_in):
+    if not words:
+        return 1.0
+    return sum(word in found_in for word in words) / len(words)
+
+
+def score_candidate(candidate, song_name, artist, duration_ms=None):
+    '''
+    Score how likely a search result is the studio recording of a Spotify track.
+    Rewards the song and artist words found in the title and channel, YouTube Music "- Topic" channels and
+    a matching duration, penalises live versions, covers, remixes and the like, and keeps YouTube's own order
+    as the tie breaker.
+
+    Args:
+    candidate (dict): The candidate, see make_candidate
+    song_name (str): The name of the Spotify track
+    artist (str): The artist of the Spotify track
+    duration_ms (int): The length of the Spotify track, or None if unknown
+
+    Returns:
+    float: The score, higher is better
+    '''
+    title_words = _words(candidate['title'])
+    channel = candidate['channel']
+    is_topic = channel.endswith(TOPIC_SUFFIX)
+    channel_words = _words(channel[:-len(TOPIC_SUFFIX)] if is_topic else channel)
+    song_words = normalize_title(song_name).split()
+    artist_words = normalize_title(artist).split()
+
+    score = 3 * _fraction_found(song_words, title_words)
+    artist_in_channel = _fraction_found(artist_words, channel_words)
+    score += 2 * max(_fraction_found(artist_words, title_words), artist_in_channel)
+    if is_topic:
+        score += 1.5 if artist_in_channel == 1 else 0.5
+    elif artist_in_channel == 1 or 'vevo' in channel_words:
+        score += 0.5  # The artist's own channel
+
+    score -= 2 * len((title_words & VARIANT_WORDS) - set(song_words))
+
+    if duration_ms and candidate['duration'] is not None:
+        difference = abs(candidate['duration'] - duration_ms / 1000)
+        score += 1 if difference <= DURATION_TOLERANCE else -min(2, difference / 30)
+
+    return score - 0.05 * candidate['rank']
+
+
+def rank_candidates(candidates, song_name, artist, duration_ms=None):
+    '''
+    Order search results from most to least likely to be the Spotify track.
+
+    Args:
+    candidates (list): The candidates, see make_candidate
+    song_name (str): The name of the Spotify track
+    artist (str): The artist of the Spotify track
+    duration_ms (int): The length of the Spotify track, or None if unknown
+
+    Returns:
+    list: The candidates, best first, each with its 'score'
+    '''
+    for candidate in candidates:
+        candidate['score'] = score_candidate(candidate, song_name, artist, duration_ms)
+    return sorted(candidates, key=lambda candidate: candidate['score'], reverse=True)
+
+
+def candidate_song(candidate, artist):
+    '''
+    Work out which song of the searched artist another search result is, so it can be cached and the
+    song resolved later without spending 100 units on its own search. Only results that are clearly
+    the studio recording are used: uploads of the artist's "- Topic" channel, whose titles are the bare
+    song name, and "Artist - Song" titles, neither of them a live version, cover or the like.
+
+    Args:
+    candidate (dict): The candidate, see make_candidate
+    artist (str): The artist that was searched for
+
+    Returns:
+    str: The song name, or None if the result is not confidently a song by the artist
+    '''
+    title = candidate['title']
+    if _words(title) & VARIANT_WORDS:
+        return None
+    artist_key = normalize_title(artist).split()
+    channel = candidate['channel']
+    if channel.endswith(TOPIC_SUFFIX):
+        if normalize_title(channel[:-len(TOPIC_SUFFIX)]).split() == artist_key:
+            return title.strip() or None
+        return None
+    if ' - ' in title:
+        title_artist, song = title.split(' - ', 1)
+        song = bracket_pattern.sub('', song).strip()
+        if normalize_title(title_artist).split() == artist_key and song:
+            return song
+    return None
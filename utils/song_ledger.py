@@ -0,0 +1,159 @@
+import os
+import json
+import threading
+import logging
+
+from utils.playlist_utils import full_file_path as playlist_ids_path
+
+script_dir = os.path.dirname(__file__)
+if not os.path.exists(os.path.join(script_dir, '../data')):
+    os.makedirs(os.path.join(script_dir, '../data'))
+ledger_dir = os.path.join(script_dir, '../data/songs_added')
+if not os.path.exists(ledger_dir):
+    os.makedirs(ledger_dir)
+# Ledgers from before they were kept per playlist, imported into the ledger of the playlist they were for
+legacy_ledger_paths = [
+    os.path.join(script_dir, '../data/songs_added_list.json'),
+    os.path.join(script_dir, '../data/songs_added.jsonl'),
+]
+_migration_lock = threading.Lock()  # Pairs synced at once may open ledgers together
+
+
+def ledger_path(playlist_id):
+    return os.path.join(ledger_dir, f'{playlist_id}.jsonl')
+
+
+def legacy_playlist_id():
+    '''
+    Get the YouTube playlist the old global ledger was written for, the one saved in data/playlist_ids.txt.
+
+    Returns:
+    str: The YouTube playlist ID, or None if no playlist was saved
+    '''
+    try:
+        with open(playlist_ids_path, 'r') as f:
+            lines = f.readlines()
+        return lines[1].strip() or None
+    except (FileNotFoundError, IndexError):
+        return None
+
+
+class SongLedger:
+    '''
+    Record of every (song, artist) pair added to a YouTube playlist, so re-runs do not search for them again.
+    Kept as a JSON lines journal with an in-memory set: membership checks are constant time and every add
+    is written and flushed to disk straight away, so a crash or Ctrl-C only loses the song in flight.
+
+    The journal is compacted when it holds many more lines than unique songs, e.g. after torn writes
+    or several runs appending at once. An old songs_added_list.json is imported into the ledger of the
+    playlist saved in data/playlist_ids.txt, the only playlist those songs can have been added to.
+    '''
+
+    def __init__(self, path, legacy_paths=None, compact_ratio=2):
+        self.path = path
+        self.compact_ratio = compact_ratio
+        self.songs = set()
+        self.lines = 0
+        self._lock = threading.Lock()
+
+        if os.path.exists(self.path):
+            self._load()
+        if legacy_paths is None:
+            owner = legacy_playlist_id()
+            is_owner = owner is not None and os.path.abspath(self.path) == os.path.abspath(ledger_path(owner))
+            legacy_paths = legacy_ledger_paths if is_owner else []
+        for legacy_path in legacy_paths:
+            if os.path.exists(legacy_path):
+                self._migrate(legacy_path)
+        if self.lines > self.compact_ratio * max(len(self.songs), 1):
+            self.compact()
+        self._file = open(self.path, 'a', encoding='utf-8')
+        if self._file.tell() and not self._ends_with_newline():
+            self._file.write('\n')  # Don't glue the next entry onto a torn last line
+
+    def __contains__(self, song_and_artist):
+        return tuple(song_and_artist) in self.songs
+
+    def __len__(self):
+        return len(self.songs)
+
+    def add(self, song, artist):
+        '''
+        Record a song as added, durably.
+
+        Args:
+        song (str): The name of the song
+        artist (str): The artist of the song
+
+        Returns:
+        None
+        '''
+        with self._lock:
+            if (song, artist) in self.songs:
+                return
+            self.songs.add((song, artist))
+            self._file.write(json.dumps([song, artist]) + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.lines += 1
+
+    def compact(self):
+        '''
+        Rewrite the journal with one line per unique song, replacing the file atomically.
+
+        Returns:
+        None
+        '''
+        with open(self.path + '.tmp', 'w', encoding='utf-8') as f:
+            for song, artist in self.songs:
+                f.write(json.dumps([song, artist]) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.path + '.tmp', self.path)
+        self.lines = len(self.songs)
+        logging.info(f"Compacted song ledger to {self.lines} entries")
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def _ends_with_newline(self):
+        with open(self.path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b'\n'
+
+    def _load(self):
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                self.lines += 1
+                try:
+                    song, artist = json.loads(line)
+                except ValueError:  # A line torn by a crash mid-write, compaction drops it
+                    continue
+                self.songs.add((song, artist))
+
+    def _migrate(self, legacy_path):
+        with _migration_lock:
+            try:
+                with open(legacy_path, 'r', encoding='utf-8') as f:
+                    if legacy_path.endswith('.jsonl'):
+                        legacy_songs = [json.loads(line) for line in f if line.strip().endswith(']')]
+                    else:
+                        legacy_songs = json.load(f)
+            except FileNotFoundError:  # Another ledger of the same playlist migrated it first, pick up its songs
+                self.songs.clear()
+                self.lines = 0
+                if os.path.exists(self.path):
+                    self._load()
+                return
+            with open(self.path, 'a', encoding='utf-8') as f:
+                for song, artist in legacy_songs:
+                    if (song, artist) not in self.songs:
+                        self.songs.add((song, artist))
+                        f.write(json.dumps([song, artist]) + '\n')
+                        self.lines += 1
+            try:
+                os.replace(legacy_path, legacy_path + '.migrated')  # Keep a copy, but never import it twice
+            except FileNotFoundError:  # Moved by another process in the meantime
+                pass
+        logging.info(f"Migrated {len(legacy_songs)} songs from {legacy_path} to the song ledger")
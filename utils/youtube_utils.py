@@ -1,35 +1,267 @@
-def search_song(youtube, song_name, artist):
+import logging
+import threading
+import time
+
+from utils.metrics import metrics
+from auth.credential_manager import refresh_if_needed
+from utils.retry import RetryPolicy, is_retryable, is_quota_error, error_status
+from utils.quota import quota_ledger, QuotaExceededError, UNIT_COSTS, SEARCH_COST, INSERT_COST
+from utils.search_cache import make_search_key
+from utils.search_ranking import SEARCH_RESULTS, make_candidate, rank_candidates, candidate_song, parse_duration
+from utils.playlist_snapshot import (SNAPSHOT_MAX_AGE, load_snapshot, save_snapshot, new_snapshot, is_fresh,
+                                     snapshot_items)
+
+_thread_local = threading.local()
+DURATIONS_COST = UNIT_COSTS['videos.list']
+# Only the fields the sync reads, shared with the async engine's client
+SEARCH_FIELDS = "items(id/videoId,snippet/title,snippet/channelTitle)"
+DURATION_FIELDS = "items(id,contentDetails/duration)"
+PLAYLIST_ITEM_FIELDS = "etag,nextPageToken,items(id,snippet/title,snippet/resourceId/videoId)"
+
+
+def thread_http(client_http):
     '''
-    Get YouTube video ID for a song using name and artist
-    Costs 100 units per request, so maxResults=1 costs 100 units
+    Get an HTTP connection for the current thread, httplib2 connections are not thread safe
+    so every thread sharing the YouTube client needs its own
+
+    Args:
+    client_http (AuthorizedHttp): The YouTube client's own authorized connection
+
+    Returns:
+    AuthorizedHttp: An authorized HTTP connection owned by the calling thread, or None to use the client's own
+    '''
+    http = getattr(_thread_local, 'http', None)
+    credentials = getattr(client_http, 'credentials', None)
+    if credentials is None:  # Not an authorized googleapiclient connection, nothing to copy
+        return None
+    if http is None or http.credentials is not credentials:
+        from googleapiclient.http import build_http
+        from google_auth_httplib2 import AuthorizedHttp
+        http = AuthorizedHttp(credentials, http=build_http())  # The client's own timeout and redirect handling
+        _thread_local.http = http
+    return http
+
+
+def execute_request(request, method, http=None):
+    '''
+    Execute a YouTube API request, recording its cost in the quota ledger
+    Every API call the project makes goes through here, on a connection owned by the calling thread
+    The access token is refreshed first if it is about to expire, and once more if the API rejects it
+
+    Args:
+    request (HttpRequest): The request to execute
+    method (str): The API method, e.g. 'search.list', used to look up the cost
+    http (AuthorizedHttp): The connection to send the request on, defaults to the calling thread's own
+
+    Returns:
+    dict: The response
+    '''
+    refresh_if_needed()  # Before the token expires, not after a request fails with it
+    if http is None:
+        http = thread_http(getattr(request, 'http', None))
+    for attempt in range(2):
+        quota_ledger.charge(method)
+        try:
+            with metrics.timed(f'youtube.{method}'):
+                if http is not None:
+                    return request.execute(http=http)
+                return request.execute()
+        except Exception as e:
+            if 'quota' in str(e):
+                metrics.increment('quota_errors_total', call=f'youtube.{method}')
+                quota_ledger.mark_exhausted()
+            if attempt == 0 and error_status(e) == 401 and refresh_if_needed(force=True):
+                logging.info(f"Access token rejected by {method}, retrying with a refreshed token")
+                continue  # Revoked or expired early, retry once with the new token
+            raise
+
+
+def search_candidates(youtube, song_name, artist, duration_ms=None):
+    '''
+    Search YouTube for a song and rank the results, see rank_candidates
+    Costs 100 units per request whatever maxResults is, plus 1 unit for the durations when duration_ms is given
 
     Args:
     youtube (Resource): The authenticated YouTube API client
     song_name (str): The name of the song
     artist (str): The artist of the song
+    duration_ms (int): The length of the Spotify track, to prefer videos of the same length
 
     Returns:
-    video_id (str): YouTube video ID for the song, e.g. '2SUwOgmvzK4' or None if no video found
+    list: Candidate dicts with 'video_id', 'title', 'channel' and 'score', best first, empty if no video found
     '''
     request = youtube.search().list(
         q=f"{song_name} {artist}",  # Search query
         part="snippet",  # Part of the API to use
-        maxResults=1,  # Number of results to return
+        maxResults=SEARCH_RESULTS,  # Number of results to return, the cost is the same for 1 or 50
         type="video",  # Type of result to return
-        fields="items(id/videoId)",  # Fields to return
+        fields=SEARCH_FIELDS,  # Fields to return
+    )
+    response = execute_request(request, 'search.list')
+    candidates = [make_candidate(item, rank) for rank, item in enumerate(response.get('items', []))]
+
+    if duration_ms and len(candidates) > 1:
+        try:
+            durations = fetch_durations(youtube, [candidate['video_id'] for candidate in candidates])  # 1 unit
+        except Exception as e:  # Ranking works without durations, don't lose the search over it
+            if is_quota_error(e):
+                raise
+            logging.warning(f"Could not get video durations for {song_name} by {artist}: {e}")
+            durations = {}
+        for candidate in candidates:
+            candidate['duration'] = durations.get(candidate['video_id'])
+
+    return rank_candidates(candidates, song_name, artist, duration_ms)
+
+
+def fetch_durations(youtube, video_ids):
+    '''
+    Get the length of up to 50 videos, costs 1 unit per request
+
+    Args:
+    youtube (Resource): The authenticated YouTube API client
+    video_ids (list): The IDs of the videos
+
+    Returns:
+    dict: A dictionary mapping video IDs to their length in seconds
+    '''
+    request = youtube.videos().list(
+        part="contentDetails",
+        id=",".join(video_ids),
+        maxResults=len(video_ids),
+        fields=DURATION_FIELDS,
     )
-    response = request.execute()
+    response = execute_request(request, 'videos.list')
+    return {item['id']: parse_duration(item['contentDetails']['duration']) for item in response.get('items', [])}
+
+
+def search_song(youtube, song_name, artist, duration_ms=None):
+    '''
+    Get YouTube video ID for a song using name and artist
+    Costs 100 units per request, the best of several results is picked, see search_candidates
+
+    Args:
+    youtube (Resource): The authenticated YouTube API client
+    song_name (str): The name of the song
+    artist (str): The artist of the song
+    duration_ms (int): The length of the Spotify track, if known
 
-    if response['items']:
-        return response['items'][0]['id']['videoId']
+    Returns:
+    video_id (str): YouTube video ID for the song, e.g. '2SUwOgmvzK4' or None if no video found
+    '''
+    candidates = search_candidates(youtube, song_name, artist, duration_ms)
+    if candidates:
+        return candidates[0]['video_id']
     return None
 
 
-def add_song_to_playlist(youtube, playlist_id, video_id):
+def cache_other_songs(cache, candidates, song_name, artist):
+    '''
+    Keep the other songs by the same artist a search happened to return, so they are resolved from the
+    cache later instead of with another 100 unit search, see candidate_song
+
+    Args:
+    cache (SearchCache): The search result cache
+    candidates (list): The ranked candidates of the search
+    song_name (str): The song that was searched for
+    artist (str): The artist that was searched for
+
+    Returns:
+    int: The number of songs cached
+    '''
+    searched_key = make_search_key(song_name, artist)
+    songs = {}
+    for candidate in candidates[1:]:
+        other_song = candidate_song(candidate, artist)
+        if other_song is not None and make_search_key(other_song, artist) != searched_key:
+            songs.setdefault(other_song, candidate['video_id'])  # Best ranked upload of each song
+    for other_song, video_id in songs.items():
+        cache.put(other_song, artist, video_id, replace=False)
+    if songs:
+        logging.info(f"Cached {len(songs)} more songs by {artist} from the search for {song_name}")
+    return len(songs)
+
+
+def cached_search_song(youtube, song_name, artist, cache, budget=None, duration_ms=None, inserts=1):
+    '''
+    Get YouTube video ID for a song, checking the search cache before spending quota
+    Costs 100 units on a cache miss, nothing on a hit, plus 1 unit to compare durations when duration_ms is given
+    With a budget, a miss only searches if there is also quota left to insert the result into every playlist
+    it is for, inserts already queued have reserved theirs so a search can never spend it
+
+    Args:
+    youtube (Resource): The authenticated YouTube API client
+    song_name (str): The name of the song
+    artist (str): The artist of the song
+    cache (SearchCache): The search result cache
+    budget (QuotaBudget): The quota budget of the run
+    duration_ms (int): The length of the Spotify track, if known
+    inserts (int): The number of playlists the song is inserted into, 0 if their quota is reserved already
+
+    Returns:
+    video_id (str): YouTube video ID for the song or None if no video found
+    '''
+    found, video_id = cache.get(song_name, artist)
+    if found:
+        return video_id
+
+    duration_ms = reserve_search(budget, duration_ms, inserts)
+    candidates = search_candidates(youtube, song_name, artist, duration_ms)  # 100 units per request
+    return store_search(cache, candidates, song_name, artist)
+
+
+def reserve_search(budget, duration_ms=None, inserts=1):
+    '''
+    Reserve the quota of a search that missed the cache, see cached_search_song
+
+    Args:
+    budget (QuotaBudget): The quota budget of the run, or None
+    duration_ms (int): The length of the Spotify track, if known
+    inserts (int): The number of playlists the song is inserted into, 0 if their quota is reserved already
+
+    Returns:
+    int: duration_ms, or None if there is no quota left to compare durations
+    '''
+    if budget is not None and not budget.spend(SEARCH_COST, keep=INSERT_COST * inserts):
+        raise QuotaExceededError("Not enough quota left in this run to search and insert another song")
+    if duration_ms and budget is not None and not budget.try_spend(DURATIONS_COST, keep=INSERT_COST * inserts):
+        return None  # Rank without durations rather than give up the insert
+    return duration_ms
+
+
+def store_search(cache, candidates, song_name, artist):
+    '''
+    Cache the result of a search, and the other songs by the artist it returned
+
+    Args:
+    cache (SearchCache): The search result cache
+    candidates (list): The ranked candidates of the search
+    song_name (str): The song that was searched for
+    artist (str): The artist that was searched for
+
+    Returns:
+    video_id (str): The video ID of the best candidate, or None if there is none
+    '''
+    video_id = candidates[0]['video_id'] if candidates else None
+    cache.put(song_name, artist, video_id)
+    cache_other_songs(cache, candidates, song_name, artist)
+    return video_id
+
+
+def add_song_to_playlist(youtube, playlist_id, video_id, http=None):
     '''
     Add a song to a YouTube playlist, costs 50 units per request
+
+    Args:
+    youtube (Resource): The authenticated YouTube API client
+    playlist_id (str): The ID of the YouTube playlist
+    video_id (str): The ID of the YouTube video
+    http (AuthorizedHttp): The connection to send the request on, defaults to the calling thread's own
+
+    Returns:
+    dict: The inserted playlist item
     '''
-    youtube.playlistItems().insert(
+    request = youtube.playlistItems().insert(
         part="snippet",  # Part of the API to use
         body={
             'snippet': {  # Information about the video in here as dictionary
@@ -40,26 +272,98 @@ def add_song_to_playlist(youtube, playlist_id, video_id):
                     }
             }
         }
-    ).execute()
+    )
+    return execute_request(request, 'playlistItems.insert', http=http)
 
 
-def fetch_yt_playlist_contents(youtube, playlist_id):
+def fetch_yt_playlist_contents(youtube, playlist_id, use_snapshot=True, max_age=SNAPSHOT_MAX_AGE):
     """
     Fetches the contents of a YouTube playlist, the video IDs and the playlist item IDs
     costs 1 unit per page, so with maxResults=50, it costs 1 unit per 50 videos
     we are assuming video titles have the song and artist in them
 
+    The playlist is kept in a local snapshot. A snapshot younger than max_age is used as is, with our own
+    inserts and deletes patched in. Older snapshots are revalidated page by page with the page ETags,
+    unchanged pages come back as 304 Not Modified without their items.
+
     Args:
     youtube (Resource): The authenticated YouTube API client
     playlist_id (str): The ID of the YouTube playlist
+    use_snapshot (bool): Read and update the local snapshot, False always fetches every page in full
+    max_age (int): Seconds a snapshot is trusted without going to the API
 
     Returns:
     dict: A dictionary mapping song and artist pairs to video IDs in the youtube music playlist currently
-    dict: A dictionary mapping video IDs to playlist item IDs
+    dict: A dictionary mapping video IDs to tuples of playlist item IDs, in playlist order
     """
+    return playlist_contents(fetch_yt_playlist_items(youtube, playlist_id, use_snapshot, max_age))
+
+
+def playlist_contents(items):
+    '''
+    Index the items of a playlist the way fetch_yt_playlist_contents returns them
+
+    Args:
+    items (list): PlaylistItem records in playlist order
+
+    Returns:
+    dict: A dictionary mapping video titles to video IDs
+    dict: A dictionary mapping video IDs to tuples of playlist item IDs, in playlist order
+    '''
     existing_video_ids = {}
     video_to_playlist_item_ids = {}
+    for playlist_item_id, video_id, video_title in items:
+        if video_id not in video_to_playlist_item_ids:
+            video_to_playlist_item_ids[video_id] = (playlist_item_id,)  # Tuples, most videos are in the playlist once
+        else:
+            video_to_playlist_item_ids[video_id] += (playlist_item_id,)
+
+        existing_video_ids[video_title] = video_id
+
+    return existing_video_ids, video_to_playlist_item_ids
+
+
+def fetch_yt_playlist_items(youtube, playlist_id, use_snapshot=True, max_age=SNAPSHOT_MAX_AGE):
+    """
+    Fetches every item of a YouTube playlist in playlist order, through the local snapshot like fetch_yt_playlist_contents
+    costs 1 unit per page that is not served from the snapshot
+
+    Args:
+    youtube (Resource): The authenticated YouTube API client
+    playlist_id (str): The ID of the YouTube playlist
+    use_snapshot (bool): Read and update the local snapshot, False always fetches every page in full
+    max_age (int): Seconds a snapshot is trusted without going to the API
+
+    Returns:
+    list: PlaylistItem records of the playlist
+    """
+    snapshot = load_snapshot(playlist_id) if use_snapshot else None
+    if is_fresh(snapshot, max_age):
+        logging.info(f"Using local snapshot of playlist {playlist_id}")
+    else:
+        snapshot = revalidate_snapshot(youtube, playlist_id, snapshot)
+        if use_snapshot:
+            save_snapshot(snapshot)
+    return snapshot_items(snapshot)
+
+
+def revalidate_snapshot(youtube, playlist_id, snapshot=None):
+    """
+    Walks the pages of a YouTube playlist, sending each cached page's ETag so unchanged pages are not downloaded again
+    costs 1 unit per page
+
+    Args:
+    youtube (Resource): The authenticated YouTube API client
+    playlist_id (str): The ID of the YouTube playlist
+    snapshot (dict): The previous snapshot of the playlist, or None to fetch everything
+
+    Returns:
+    dict: A new snapshot of the playlist
+    """
+    cached_pages = {page['page_token']: page for page in snapshot['pages']} if snapshot else {}
+    new = new_snapshot(playlist_id)
     next_page_token = None
+    not_modified = 0
 
     while True:
         request = youtube.playlistItems().list(
@@ -67,25 +371,110 @@ def fetch_yt_playlist_contents(youtube, playlist_id):
             playlistId=playlist_id,
             maxResults=50,  # Maximum number of results to return per page, can be between 1 and 50, cost is 1 unit per page
             pageToken=next_page_token,  
-            fields="nextPageToken,items(id,snippet/title,snippet/resourceId/videoId)"
+            fields=PLAYLIST_ITEM_FIELDS
         )
-        response = request.execute()
-        # response is a dictionary looking like {'nextPageToken': '...', 'items': [{'snippet': {'resourceId': {'videoId': '...'}}}, ...]}
-
-        for item in response.get('items', []):  # returns value of 'items' key if it exists, else returns an empty list
-            video_title = item['snippet']['title']  # Will give the youtube video title
-            video_id = item['snippet']['resourceId']['videoId']
-            playlist_item_id = item['id']
+        cached_page = cached_pages.get(next_page_token)
+        if cached_page and cached_page.get('etag'):
+            request.headers['If-None-Match'] = cached_page['etag']
 
-            if video_id not in video_to_playlist_item_ids:
-                video_to_playlist_item_ids[video_id] = [playlist_item_id]
-            else:
-                video_to_playlist_item_ids[video_id].append(playlist_item_id)
+        try:
+            response = execute_request(request, 'playlistItems.list')
+            page = snapshot_page(response, next_page_token)
+        except Exception as e:
+            if cached_page is None or getattr(getattr(e, 'resp', None), 'status', None) != 304:
+                raise
+            page = cached_page  # 304 Not Modified, the cached page is still current
+            not_modified += 1
 
-            existing_video_ids[video_title] = video_id 
-        next_page_token = response.get('nextPageToken')  
+        new['pages'].append(page)
+        next_page_token = page['next_page_token']
 
         if not next_page_token:  # If there are no more pages
             break
 
-    return existing_video_ids, video_to_playlist_item_ids
+    new['synced_at'] = time.time()
+    logging.info(f"Revalidated playlist {playlist_id}: {len(new['pages'])} pages, {not_modified} not modified")
+    return new
+
+
+def snapshot_page(response, page_token):
+    '''
+    Make a snapshot page from a playlistItems.list response
+
+    Args:
+    response (dict): The response, looking like {'etag': '...', 'nextPageToken': '...', 'items': [{'snippet': {'resourceId': {'videoId': '...'}}}, ...]}
+    page_token (str): The page token the page was requested with, None for the first page
+
+    Returns:
+    dict: {'page_token', 'etag', 'next_page_token', 'items'}, items are [playlist_item_id, video_id, title] lists
+    '''
+    return {
+        'page_token': page_token,
+        'etag': response.get('etag'),
+        'next_page_token': response.get('nextPageToken'),
+        'items': [[item['id'], item['snippet']['resourceId']['videoId'], item['snippet']['title']]
+                  for item in response.get('items', [])],  # returns value of 'items' key if it exists, else returns an empty list
+    }
+
+
+def delete_playlist_items(youtube, playlist_item_ids, batch_size=50, max_retries=2):
+    '''
+    Delete playlist items using batch HTTP requests, costs 50 units per item
+    Items that fail inside a batch are retried on their own, a quota error stops everything
+
+    Args:
+    youtube (Resource): The authenticated YouTube API client
+    playlist_item_ids (list): The IDs of the playlist items to delete
+    batch_size (int): The number of deletes sent per batch request, YouTube accepts up to 50
+    max_retries (int): The number of individual attempts for items that failed in a batch with a retryable error
+
+    Returns:
+    dict: A dictionary mapping each playlist item ID to 'deleted', 'failed' or 'skipped' if quota ran out first
+    '''
+    results = {item_id: 'skipped' for item_id in playlist_item_ids}
+    errors = {}
+    quota_exceeded = False
+
+    def callback(request_id, response, exception):
+        if exception is None:
+            results[request_id] = 'deleted'
+        else:
+            results[request_id] = 'failed'
+            errors[request_id] = exception
+
+    for start in range(0, len(playlist_item_ids), batch_size):
+        batch = youtube.new_batch_http_request(callback=callback)
+        batch_ids = playlist_item_ids[start:start + batch_size]
+        for item_id in batch_ids:
+            batch.add(youtube.playlistItems().delete(id=item_id), request_id=item_id)
+        quota_ledger.charge('playlistItems.delete', len(batch_ids))  # Batched calls cost the same as separate ones
+        refresh_if_needed()  # Batches bypass execute_request
+        with metrics.timed('youtube.batch'):
+            batch.execute()
+
+        if any('quota' in str(error) for error in errors.values()):
+            metrics.increment('quota_errors_total', call='youtube.batch')
+            quota_ledger.mark_exhausted()
+            quota_exceeded = True
+            break
+
+    retry = RetryPolicy(max_attempts=max_retries)
+    for item_id, error in list(errors.items()):
+        if quota_exceeded:
+            break
+        if not is_retryable(error):  # e.g. the item was already removed
+            logging.error(f"Failed to delete playlist item {item_id}: {error}")
+            continue
+        try:
+            retry.run(lambda: execute_request(youtube.playlistItems().delete(id=item_id), 'playlistItems.delete'),
+                      'youtube.playlistItems.delete')  # 50 units per request
+            results[item_id] = 'deleted'
+        except Exception as e:
+            if is_quota_error(e):
+                quota_exceeded = True
+                break
+            logging.error(f"Failed to delete playlist item {item_id} after {max_retries} attempts: {e}")
+
+    if quota_exceeded:
+        logging.error("Quota exceeded while deleting playlist items.")
+    return results